@@ -30,6 +30,15 @@ target_metadata = db.metadata
 # ... etc.
 
 
+def database_url():
+    """Use -x db_url=... to migrate somewhere other than sqlalchemy.url,
+    e.g. alembic -x db_url=sqlite:///budget.db upgrade head
+
+    """
+    return context.get_x_argument(as_dictionary=True).get(
+        'db_url', config.get_main_option("sqlalchemy.url"))
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -42,9 +51,10 @@ def run_migrations_offline():
     script output.
 
     """
-    url = config.get_main_option("sqlalchemy.url")
+    url = database_url()
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True)
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        render_as_batch=url.startswith('sqlite'))
 
     with context.begin_transaction():
         context.run_migrations()
@@ -57,15 +67,20 @@ def run_migrations_online():
     and associate a connection with the context.
 
     """
+    section = config.get_section(config.config_ini_section)
+    section['sqlalchemy.url'] = database_url()
+
     connectable = engine_from_config(
-        config.get_section(config.config_ini_section),
+        section,
         prefix='sqlalchemy.',
         poolclass=pool.NullPool)
 
     with connectable.connect() as connection:
         context.configure(
             connection=connection,
-            target_metadata=target_metadata
+            target_metadata=target_metadata,
+            # SQLite can only change most things by rebuilding the table
+            render_as_batch=connection.dialect.name == 'sqlite'
         )
 
         with context.begin_transaction():
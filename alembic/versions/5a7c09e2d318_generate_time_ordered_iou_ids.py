@@ -0,0 +1,44 @@
+"""Generate time ordered iou ids
+
+Revision ID: 5a7c09e2d318
+Revises: d3a8f51c6e07
+Create Date: 2026-10-18 18:41:37.502214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a7c09e2d318'
+down_revision = 'd3a8f51c6e07'
+branch_labels = None
+depends_on = None
+
+
+# The same layout as budget.models.uuid7, for rows inserted by hand or by
+# anything else that doesn't go through the app. Existing ids stay as they
+# are; both kinds are valid UUIDs.
+UUID_GENERATE_V7 = '''
+CREATE FUNCTION uuid_generate_v7() RETURNS uuid AS $$
+    SELECT (lpad(to_hex(floor(extract(epoch FROM clock_timestamp()) * 1000)::bigint), 12, '0')
+            || '7' || substr(md5(random()::text), 1, 3)
+            || to_hex(8 + floor(random() * 4)::int) || substr(md5(random()::text), 1, 15))::uuid
+$$ LANGUAGE SQL VOLATILE
+'''
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute(UUID_GENERATE_V7)
+    op.alter_column('iou', 'id', server_default=sa.text('uuid_generate_v7()'))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.alter_column('iou', 'id', server_default=None)
+    op.execute('DROP FUNCTION uuid_generate_v7()')
@@ -17,6 +17,10 @@ depends_on = None
 
 
 def upgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        upgrade_sqlite()
+        return
+
     # ### commands auto generated by Alembic - please adjust! ###
 
     op.execute('''
@@ -39,14 +43,7 @@ def upgrade():
         ALTER TABLE person ADD CONSTRAINT unique_phone_number UNIQUE (phone_number)
     ''')
 
-    op.create_table('person_to_person',
-    sa.Column('from_phone', sa.String(length=15), nullable=False),
-    sa.Column('to_phone', sa.String(length=15), nullable=False),
-    sa.Column('alias', sa.String(), nullable=True),
-    sa.ForeignKeyConstraint(['from_phone'], ['person.phone_number'], ),
-    sa.ForeignKeyConstraint(['to_phone'], ['person.phone_number'], ),
-    sa.PrimaryKeyConstraint('from_phone', 'alias')
-    )
+    create_person_to_person()
 
     op.execute('''
         ALTER TABLE iou ALTER COLUMN owee_id TYPE VARCHAR
@@ -98,6 +95,72 @@ def upgrade():
     # ### end Alembic commands ###
 
 
+def create_person_to_person():
+    op.create_table('person_to_person',
+    sa.Column('from_phone', sa.String(length=15), nullable=False),
+    sa.Column('to_phone', sa.String(length=15), nullable=False),
+    sa.Column('alias', sa.String(), nullable=True),
+    sa.ForeignKeyConstraint(['from_phone'], ['person.phone_number'], ),
+    sa.ForeignKeyConstraint(['to_phone'], ['person.phone_number'], ),
+    sa.PrimaryKeyConstraint('from_phone', 'alias')
+    )
+
+
+def upgrade_sqlite():
+    # SQLite can't swap a primary key or retarget a foreign key in place,
+    # so move the old tables aside, build the new ones and copy across
+    op.rename_table('iou', 'iou_old')
+    op.rename_table('person', 'person_old')
+
+    op.create_table('person',
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('phone_number', sa.String(length=15), nullable=False),
+    sa.Column('admin', sa.Boolean(), nullable=True),
+    sa.PrimaryKeyConstraint('phone_number'),
+    sa.UniqueConstraint('phone_number', name='unique_phone_number')
+    )
+
+    op.execute('''
+        INSERT INTO person (name, phone_number, admin)
+        SELECT name, phone_number, admin FROM person_old
+    ''')
+
+    op.create_table('iou',
+    sa.Column('id', postgresql.UUID(), nullable=False),
+    sa.Column('ower_id', sa.String(), nullable=False),
+    sa.Column('owee_id', sa.String(), nullable=False),
+    sa.Column('amount', sa.Float(), nullable=True),
+    sa.Column('date_added', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('pending', sa.Boolean(), nullable=True),
+    sa.Column('reason', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['owee_id'], ['person.phone_number'], ),
+    sa.ForeignKeyConstraint(['ower_id'], ['person.phone_number'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+    op.execute('''
+        INSERT INTO iou (id, ower_id, owee_id, amount, date_added, pending, reason)
+        SELECT
+          iou_old.id,
+          ower.phone_number,
+          owee.phone_number,
+          iou_old.amount,
+          iou_old.date_added,
+          iou_old.pending,
+          iou_old.reason
+        FROM iou_old
+        JOIN person_old AS ower
+        ON ower.id = iou_old.ower_id
+        JOIN person_old AS owee
+        ON owee.id = iou_old.owee_id
+    ''')
+
+    op.drop_table('iou_old')
+    op.drop_table('person_old')
+
+    create_person_to_person()
+
+
 def downgrade():
     # ### commands auto generated by Alembic - please adjust! ###
     op.add_column('person', sa.Column('id', postgresql.UUID(), autoincrement=False, nullable=False))
@@ -0,0 +1,59 @@
+"""Add balance checkpoint
+
+Revision ID: b6e1d94a7c20
+Revises: 5a7c09e2d318
+Create Date: 2026-10-18 19:12:08.661045
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e1d94a7c20'
+down_revision = '5a7c09e2d318'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Every IOU is uncompacted until compact-balances first runs, so building
+    # the partial indexes holds off writes to the whole of iou for as long as
+    # it takes. Alembic runs migrations in one transaction, where that can't
+    # be done CONCURRENTLY. Where it would take too long, run this by hand
+    # instead, building the indexes with CREATE INDEX CONCURRENTLY, then
+    # alembic stamp b6e1d94a7c20.
+    op.create_table('balance_checkpoint',
+    sa.Column('low_phone', sa.String(length=15), nullable=False),
+    sa.Column('high_phone', sa.String(length=15), nullable=False),
+    sa.Column('amount', sa.BigInteger(), nullable=False),
+    sa.Column('iou_count', sa.Integer(), nullable=False),
+    sa.Column('through_date', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('through_id', postgresql.UUID(), nullable=True),
+    sa.Column('updated', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['high_phone'], ['person.phone_number'], ),
+    sa.ForeignKeyConstraint(['low_phone'], ['person.phone_number'], ),
+    sa.PrimaryKeyConstraint('low_phone', 'high_phone')
+    )
+
+    # Nullable without a default, so adding it doesn't rewrite iou
+    op.add_column('iou', sa.Column('compacted_at', sa.DateTime(timezone=True), nullable=True))
+
+    op.create_index('ix_iou_uncompacted', 'iou', ['date_added', 'id'], unique=False,
+                    postgresql_where=sa.text('compacted_at IS NULL'),
+                    sqlite_where=sa.text('compacted_at IS NULL'))
+    op.create_index('ix_iou_uncompacted_pair', 'iou', ['ower_id', 'owee_id', 'amount'],
+                    unique=False,
+                    postgresql_where=sa.text('compacted_at IS NULL'),
+                    sqlite_where=sa.text('compacted_at IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_iou_uncompacted_pair', table_name='iou')
+    op.drop_index('ix_iou_uncompacted', table_name='iou')
+
+    with op.batch_alter_table('iou') as batch_op:
+        batch_op.drop_column('compacted_at')
+
+    op.drop_table('balance_checkpoint')
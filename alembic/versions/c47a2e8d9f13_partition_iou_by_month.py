@@ -0,0 +1,179 @@
+"""Partition iou by month
+
+Revision ID: c47a2e8d9f13
+Revises: b6e1d94a7c20
+Create Date: 2026-10-18 20:26:41.093857
+
+"""
+from datetime import datetime
+
+from alembic import context, op
+import sqlalchemy as sa
+from pytz import timezone
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47a2e8d9f13'
+down_revision = 'b6e1d94a7c20'
+branch_labels = None
+depends_on = None
+
+
+# Month boundaries are local midnight, as in budget.partitions
+TIMEZONE = timezone('America/Chicago')
+
+COLUMNS = 'id, ower_id, owee_id, amount, date_added, pending, reason, compacted_at'
+
+INDEXES = [
+    'CREATE INDEX ix_iou_ower_id_owee_id_date_added_amount ON iou (ower_id, owee_id, date_added, amount)',
+    'CREATE INDEX ix_iou_ower_id_date_added ON iou (ower_id, date_added)',
+    'CREATE INDEX ix_iou_owee_id_date_added ON iou (owee_id, date_added)',
+    'CREATE INDEX ix_iou_date_added ON iou (date_added)',
+    'CREATE INDEX ix_iou_uncompacted ON iou (date_added, id) WHERE compacted_at IS NULL',
+    'CREATE INDEX ix_iou_uncompacted_pair ON iou (ower_id, owee_id, amount) '
+    'WHERE compacted_at IS NULL',
+]
+
+
+def partitioning():
+    '''
+    Declarative partitioning needs PostgreSQL 11 for primary keys and
+    indexes on the partitioned table. Anywhere else iou stays as it is.
+    '''
+    bind = op.get_bind()
+
+    if bind.dialect.name != 'postgresql':
+        return False
+
+    if context.is_offline_mode():
+        # Which partitions to make depends on the dates already in iou
+        raise RuntimeError('Partitioning iou has to run against the database, not with --sql')
+
+    return bind.dialect.server_version_info >= (11,)
+
+
+def months(first, last):
+    first = first.astimezone(TIMEZONE)
+    month = TIMEZONE.localize(datetime(first.year, first.month, 1))
+
+    while month <= last:
+        years, index = divmod(month.month, 12)
+        following = TIMEZONE.localize(datetime(month.year + years, index + 1, 1))
+        yield month, following
+        month = following
+
+
+def createTables():
+    op.create_table('iou_archive',
+    sa.Column('partition', sa.String(length=32), nullable=False),
+    sa.Column('start', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('end', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('iou_count', sa.Integer(), nullable=False),
+    sa.Column('path', sa.Text(), nullable=True),
+    sa.Column('detached_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('archived_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('partition')
+    )
+    op.create_table('archived_balance',
+    sa.Column('partition', sa.String(length=32), nullable=False),
+    sa.Column('low_phone', sa.String(length=15), nullable=False),
+    sa.Column('high_phone', sa.String(length=15), nullable=False),
+    sa.Column('amount', sa.BigInteger(), nullable=False),
+    sa.Column('iou_count', sa.Integer(), nullable=False),
+    sa.Column('last_updated', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['high_phone'], ['person.phone_number'], ),
+    sa.ForeignKeyConstraint(['low_phone'], ['person.phone_number'], ),
+    sa.ForeignKeyConstraint(['partition'], ['iou_archive.partition'], ),
+    sa.PrimaryKeyConstraint('partition', 'low_phone', 'high_phone')
+    )
+
+
+def upgrade():
+    createTables()
+
+    if not partitioning():
+        return
+
+    bind = op.get_bind()
+
+    # This copies iou, so it holds the table for as long as that takes. A
+    # partitioned table's primary key has to include the partition key,
+    # which can't be null, so the odd IOU without a date gets the oldest one.
+    op.execute('UPDATE iou SET date_added = (SELECT coalesce(min(date_added), now()) FROM iou) '
+               'WHERE date_added IS NULL')
+
+    for name in ['iou_pkey'] + [statement.split()[2] for statement in INDEXES]:
+        op.execute('ALTER INDEX IF EXISTS {0} RENAME TO {0}_unpartitioned'.format(name))
+
+    op.execute('ALTER TABLE iou RENAME TO iou_unpartitioned')
+
+    op.execute('''
+        CREATE TABLE iou (
+            id UUID NOT NULL DEFAULT uuid_generate_v7(),
+            ower_id VARCHAR(15) NOT NULL REFERENCES person (phone_number),
+            owee_id VARCHAR(15) NOT NULL REFERENCES person (phone_number),
+            amount BIGINT,
+            date_added TIMESTAMP WITH TIME ZONE NOT NULL,
+            pending BOOLEAN,
+            reason TEXT,
+            compacted_at TIMESTAMP WITH TIME ZONE,
+            CONSTRAINT iou_pkey PRIMARY KEY (id, date_added)
+        ) PARTITION BY RANGE (date_added)
+    ''')
+
+    op.execute('CREATE TABLE iou_default PARTITION OF iou DEFAULT')
+
+    # A partition for every month there are IOUs for and the next three;
+    # budget create-partitions keeps it going from there
+    first = bind.execute(sa.text('SELECT min(date_added) FROM iou_unpartitioned')).scalar()
+    now = datetime.now(TIMEZONE)
+    years, index = divmod(now.month + 2, 12)
+    last = TIMEZONE.localize(datetime(now.year + years, index + 1, 1))
+
+    for start, end in months(first or now, last):
+        op.execute("CREATE TABLE iou_y{0:04d}m{1:02d} PARTITION OF iou "
+                   "FOR VALUES FROM ('{2}') TO ('{3}')".format(start.year, start.month,
+                                                                start.isoformat(),
+                                                                end.isoformat()))
+
+    op.execute('INSERT INTO iou ({0}) SELECT {0} FROM iou_unpartitioned'.format(COLUMNS))
+    op.execute('DROP TABLE iou_unpartitioned')
+
+    # On the partitioned table these cascade to every partition, and to
+    # the ones made later
+    for statement in INDEXES:
+        op.execute(statement)
+
+    op.execute('ANALYZE iou')
+
+
+def downgrade():
+    if partitioning():
+        # Months that were archived stay in their files
+        for name in ['iou_pkey'] + [statement.split()[2] for statement in INDEXES]:
+            op.execute('ALTER INDEX {0} RENAME TO {0}_partitioned'.format(name))
+
+        op.execute('ALTER TABLE iou RENAME TO iou_partitioned')
+
+        op.execute('''
+            CREATE TABLE iou (
+                id UUID NOT NULL DEFAULT uuid_generate_v7(),
+                ower_id VARCHAR(15) NOT NULL REFERENCES person (phone_number),
+                owee_id VARCHAR(15) NOT NULL REFERENCES person (phone_number),
+                amount BIGINT,
+                date_added TIMESTAMP WITH TIME ZONE,
+                pending BOOLEAN,
+                reason TEXT,
+                compacted_at TIMESTAMP WITH TIME ZONE,
+                CONSTRAINT iou_pkey PRIMARY KEY (id)
+            )
+        ''')
+
+        op.execute('INSERT INTO iou ({0}) SELECT {0} FROM iou_partitioned'.format(COLUMNS))
+        op.execute('DROP TABLE iou_partitioned')
+
+        for statement in INDEXES:
+            op.execute(statement)
+
+    op.drop_table('archived_balance')
+    op.drop_table('iou_archive')
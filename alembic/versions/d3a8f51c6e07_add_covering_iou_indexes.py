@@ -0,0 +1,50 @@
+"""Add covering iou indexes
+
+Revision ID: d3a8f51c6e07
+Revises: 0b9e4c7f1d25
+Create Date: 2026-10-18 18:05:12.417530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a8f51c6e07'
+down_revision = '0b9e4c7f1d25'
+branch_labels = None
+depends_on = None
+
+
+def createIndex(name, columns):
+    '''
+    Build an index unless it's already there, which it is on PostgreSQL if
+    it was built CONCURRENTLY by hand before upgrading (see upgrade).
+    '''
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE INDEX IF NOT EXISTS {0} ON iou ({1})'.format(name, ', '.join(columns)))
+    else:
+        op.create_index(name, 'iou', columns, unique=False)
+
+
+def upgrade():
+    # Alembic runs every migration in one transaction, which CONCURRENTLY
+    # can't be used in, so this holds off writes to iou while the indexes
+    # build. Where that takes too long, build them first with:
+    #
+    #   CREATE INDEX CONCURRENTLY ix_iou_ower_id_owee_id_date_added_amount
+    #       ON iou (ower_id, owee_id, date_added, amount);
+    #   CREATE INDEX CONCURRENTLY ix_iou_ower_id_date_added ON iou (ower_id, date_added);
+
+    # amount on the end lets the pair total be answered from the index alone
+    createIndex('ix_iou_ower_id_owee_id_date_added_amount',
+                ['ower_id', 'owee_id', 'date_added', 'amount'])
+    createIndex('ix_iou_ower_id_date_added', ['ower_id', 'date_added'])
+    op.drop_index('ix_iou_ower_id_owee_id_date_added', table_name='iou')
+
+
+def downgrade():
+    op.create_index('ix_iou_ower_id_owee_id_date_added', 'iou',
+                    ['ower_id', 'owee_id', 'date_added'], unique=False)
+    op.drop_index('ix_iou_ower_id_date_added', table_name='iou')
+    op.drop_index('ix_iou_ower_id_owee_id_date_added_amount', table_name='iou')
@@ -0,0 +1,54 @@
+"""Store amounts in cents
+
+Revision ID: e5b7d2a09c31
+Revises: c27b5e08d4a1
+Create Date: 2026-10-18 15:11:07.218350
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b7d2a09c31'
+down_revision = 'c27b5e08d4a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        op.execute('UPDATE iou SET amount = ROUND(amount * 100)')
+        op.execute('UPDATE pair_balance SET amount = ROUND(amount * 100)')
+
+    with op.batch_alter_table('iou') as batch_op:
+        batch_op.alter_column('amount',
+                              type_=sa.BigInteger(),
+                              existing_type=sa.Float(),
+                              postgresql_using='round(amount * 100)::bigint')
+
+    with op.batch_alter_table('pair_balance') as batch_op:
+        batch_op.alter_column('amount',
+                              type_=sa.BigInteger(),
+                              existing_type=sa.Float(),
+                              existing_nullable=False,
+                              postgresql_using='round(amount * 100)::bigint')
+
+
+def downgrade():
+    with op.batch_alter_table('pair_balance') as batch_op:
+        batch_op.alter_column('amount',
+                              type_=sa.Float(),
+                              existing_type=sa.BigInteger(),
+                              existing_nullable=False,
+                              postgresql_using='amount / 100.0')
+
+    with op.batch_alter_table('iou') as batch_op:
+        batch_op.alter_column('amount',
+                              type_=sa.Float(),
+                              existing_type=sa.BigInteger(),
+                              postgresql_using='amount / 100.0')
+
+    if op.get_bind().dialect.name != 'postgresql':
+        op.execute('UPDATE iou SET amount = amount / 100.0')
+        op.execute('UPDATE pair_balance SET amount = amount / 100.0')
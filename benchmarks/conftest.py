@@ -0,0 +1,150 @@
+'''
+pytest-benchmark suite for the IOU hot paths on synthetic ledgers. It
+isn't part of the regular test run; run it explicitly and keep the JSON
+so that runs can be compared:
+
+    pytest benchmarks --benchmark-autosave
+    pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:10%
+
+or --benchmark-json=results.json for a one-off file. By default it uses a
+SQLite file as an embedded stand-in. Point BENCHMARK_DATABASE_URI at a
+local Postgres (e.g. postgresql://postgres:@localhost:5432/budget_benchmark)
+to measure the real thing. BENCHMARK_DATASETS picks which of
+benchmarks.datasets.DATASETS to run, e.g. "sparse,dense,large" (the
+default leaves out "large"). On PostgreSQL 11 and later iou is partitioned
+by month, as the migrations leave it.
+'''
+import os
+
+import pytest
+from twilio.rest import Client
+
+from budget import create_app
+from budget.database import db as _db
+from budget.importer import importLedger
+from budget.models import IOU
+from budget.partitions import PARTITIONING_VERSION, createPartitions
+from budget.utils import IOUHandler
+
+from .datasets import DATASETS, FIRST_DATE, ledgerRecords, phoneNumber
+
+
+SELECTED = os.environ.get('BENCHMARK_DATASETS', 'sparse,dense').split(',')
+
+
+class FakeMessages(object):
+    def create(self, **kwargs):
+        self.kwargs = kwargs
+
+
+@pytest.fixture(scope='session', autouse=True)
+def twilio_mock():
+    original = Client.messages
+    Client.messages = FakeMessages()
+
+    yield
+
+    Client.messages = original
+
+
+PARTITIONED_IOU = '''
+    CREATE TABLE iou (
+        id UUID NOT NULL,
+        ower_id VARCHAR(15) NOT NULL REFERENCES person (phone_number),
+        owee_id VARCHAR(15) NOT NULL REFERENCES person (phone_number),
+        amount BIGINT,
+        date_added TIMESTAMP WITH TIME ZONE NOT NULL,
+        pending BOOLEAN,
+        reason TEXT,
+        compacted_at TIMESTAMP WITH TIME ZONE,
+        PRIMARY KEY (id, date_added)
+    ) PARTITION BY RANGE (date_added)
+'''
+
+
+def partitionLedger():
+    '''
+    Swap the empty iou table create_all made for a partitioned one like
+    the migrations make.
+    '''
+    _db.session.execute('DROP TABLE iou')
+    _db.session.execute(PARTITIONED_IOU)
+    _db.session.execute('CREATE TABLE iou_default PARTITION OF iou DEFAULT')
+    _db.session.commit()
+
+    for index in IOU.__table__.indexes:
+        index.create(_db.engine)
+
+    createPartitions(months_ahead=0, first=FIRST_DATE)
+
+
+@pytest.fixture(scope='session', params=[dataset for dataset in DATASETS
+                                         if dataset.name in SELECTED],
+                ids=lambda dataset: dataset.name)
+def ledger(request, tmpdir_factory):
+    '''
+    An app with the dataset loaded, shared by every benchmark for that
+    dataset.
+    '''
+    dataset = request.param
+
+    uri = os.environ.get('BENCHMARK_DATABASE_URI')
+
+    if uri is None:
+        path = str(tmpdir_factory.mktemp('benchmark').join('{}.db'.format(dataset.name)))
+        uri = 'sqlite:///{}'.format(path)
+
+    app = create_app(__name__, {
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': uri,
+        'RATE_LIMIT_BACKEND': None,
+    })
+
+    ctx = app.app_context()
+    ctx.push()
+
+    _db.drop_all()
+    _db.create_all()
+
+    if _db.engine.dialect.name == 'postgresql' \
+            and _db.engine.dialect.server_version_info >= PARTITIONING_VERSION:
+        partitionLedger()
+
+    importLedger(ledgerRecords(dataset), format='jsonl')
+
+    # Statistics for the planner, as autovacuum would eventually gather
+    _db.session.execute('ANALYZE')
+    _db.session.commit()
+
+    yield app, dataset
+
+    _db.session.remove()
+    _db.drop_all()
+    ctx.pop()
+
+
+@pytest.fixture
+def client(ledger):
+    app, dataset = ledger
+    return app.test_client()
+
+
+@pytest.fixture
+def handler(ledger):
+    '''
+    An IOUHandler for the busiest person in the dataset and the name of one
+    of their friends.
+    '''
+    from budget.cache import sender_cache
+
+    app, dataset = ledger
+    profile = sender_cache.get(phoneNumber(0))
+
+    return IOUHandler('', profile.phone_number), sorted(profile.friends)[0]
+
+
+@pytest.fixture(autouse=True)
+def describe(request):
+    if 'benchmark' in request.fixturenames and 'ledger' in request.fixturenames:
+        app, dataset = request.getfixturevalue('ledger')
+        request.getfixturevalue('benchmark').extra_info.update(dataset._asdict())
@@ -0,0 +1,90 @@
+'''
+Synthetic ledgers for the benchmark suite. People are numbered from
++13122000000 up, person 0 is an admin, and IOUs are skewed so that a few
+pairs of friends account for most of them, the way a real group's ledger
+looks. The IOUs are spread evenly over two years starting at FIRST_DATE.
+'''
+import json
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+
+Dataset = namedtuple('Dataset', ['name', 'people', 'density', 'ious', 'skew'])
+
+DATASETS = [
+    Dataset('sparse', people=500, density=0.01, ious=20000, skew=1.2),
+    Dataset('dense', people=100, density=0.3, ious=20000, skew=1.2),
+    Dataset('large', people=5000, density=0.002, ious=200000, skew=1.1),
+]
+
+FIRST_DATE = datetime(2016, 1, 1)
+SPAN = timedelta(days=730)
+
+
+def phoneNumber(index):
+    return '+1312{0:03d}{1:04d}'.format(200 + index // 10000, index % 10000)
+
+
+def personName(index):
+    return 'person{}'.format(index)
+
+
+def friendGraph(dataset, rng):
+    '''
+    Each person's friends, as a dict of index -> list of indexes. Every
+    person has at least one friend and friendships go both ways.
+    '''
+    friends = {index: set() for index in range(dataset.people)}
+    per_person = max(1, int(dataset.density * (dataset.people - 1)))
+
+    for index in range(dataset.people):
+        while len(friends[index]) < per_person:
+            other = rng.randrange(dataset.people)
+
+            if other != index:
+                friends[index].add(other)
+                friends[other].add(index)
+
+    return {index: sorted(others) for index, others in friends.items()}
+
+
+def zipfWeights(count, skew):
+    return [1.0 / (rank + 1) ** skew for rank in range(count)]
+
+
+def ledgerRecords(dataset, seed=1234):
+    '''
+    Yield the dataset as JSON lines that importLedger can load.
+    '''
+    rng = random.Random(seed)
+    friends = friendGraph(dataset, rng)
+
+    for index in range(dataset.people):
+        yield json.dumps({'type': 'person',
+                          'phone_number': phoneNumber(index),
+                          'name': personName(index),
+                          'admin': index == 0})
+
+    for index, others in friends.items():
+        for other in others:
+            yield json.dumps({'type': 'alias',
+                              'from_phone': phoneNumber(index),
+                              'to_phone': phoneNumber(other),
+                              'alias': personName(other)})
+
+    people = list(range(dataset.people))
+    weights = zipfWeights(dataset.people, dataset.skew)
+
+    for number, ower in enumerate(rng.choices(people, weights=weights, k=dataset.ious)):
+        owee = rng.choice(friends[ower])
+        date_added = FIRST_DATE + SPAN * number / dataset.ious
+
+        yield json.dumps({'type': 'iou',
+                          'ower_id': phoneNumber(ower),
+                          'owee_id': phoneNumber(owee),
+                          'amount': '{0}.{1:02d}'.format(rng.randint(1, 200),
+                                                         rng.choice([0, 0, 50, 99])),
+                          'date_added': date_added.strftime('%Y-%m-%d %H:%M:%S'),
+                          'reason': 'benchmark',
+                          'pending': False})
@@ -0,0 +1,120 @@
+'''
+Insert throughput with random (version 4) against time ordered (version 7)
+primary keys, on a table shaped like iou. Each kind gets a table of its
+own, filled a batch at a time, and the rate is reported for every million
+rows so you can watch random keys slow down once the index outgrows the
+cache:
+
+    python -m benchmarks.key_order postgresql://postgres:@localhost:5432/budget_benchmark
+
+It defaults to 10,000,000 rows of each. On PostgreSQL it also reports the
+size of each primary key index and how much WAL the inserts wrote.
+'''
+import argparse
+import os
+import time
+import uuid
+
+from sqlalchemy import BigInteger, Column, MetaData, String, Table, create_engine, text
+
+from budget.models import uuid7
+from budget.types import UUID
+
+
+KINDS = {
+    'random': uuid.uuid4,
+    'ordered': uuid7,
+}
+
+
+def keyTable(metadata, kind):
+    return Table('key_order_{}'.format(kind), metadata,
+                 Column('id', UUID, primary_key=True),
+                 Column('ower_id', String(15), nullable=False),
+                 Column('owee_id', String(15), nullable=False),
+                 Column('amount', BigInteger))
+
+
+def walPosition(connection):
+    if connection.dialect.name != 'postgresql':
+        return None
+
+    if connection.dialect.server_version_info >= (10,):
+        return connection.execute(text('SELECT pg_current_wal_lsn()')).scalar()
+
+    return connection.execute(text('SELECT pg_current_xlog_location()')).scalar()
+
+
+def postgresReport(connection, table, wal_start):
+    if connection.dialect.name != 'postgresql':
+        return ''
+
+    if connection.dialect.server_version_info >= (10,):
+        diff = 'pg_wal_lsn_diff'
+    else:
+        diff = 'pg_xlog_location_diff'
+
+    index_size, wal_bytes = connection.execute(text(
+        "SELECT pg_relation_size(:index), {}(:now, :start)".format(diff)
+    ), index='{}_pkey'.format(table.name), now=walPosition(connection), start=wal_start).first()
+
+    return ', primary key {0:.0f}MB, WAL {1:.0f}MB'.format(index_size / 2 ** 20,
+                                                          float(wal_bytes) / 2 ** 20)
+
+
+def run(engine, table, make_id, rows, batch_size):
+    table.drop(engine, checkfirst=True)
+    table.create(engine)
+
+    with engine.connect() as connection:
+        wal_start = walPosition(connection)
+        started = lap = time.time()
+        statement = table.insert()
+
+        for offset in range(0, rows, batch_size):
+            batch = [{'id': str(make_id()),
+                      'ower_id': '+1312{:07d}'.format(n % 5000),
+                      'owee_id': '+1312{:07d}'.format((n * 7) % 5000),
+                      'amount': n % 20000}
+                     for n in range(offset, min(offset + batch_size, rows))]
+
+            with connection.begin():
+                connection.execute(statement, batch)
+
+            done = offset + len(batch)
+
+            if done % 1000000 == 0:
+                now = time.time()
+                print('  {0:>10,} rows  {1:>9,.0f} rows/s'.format(done, 1000000 / (now - lap)))
+                lap = now
+
+        elapsed = time.time() - started
+
+        print('  {0}: {1:,.0f} rows/s overall{2}'.format(
+            table.name, rows / elapsed, postgresReport(connection, table, wal_start)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('database_uri', nargs='?',
+                        default=os.environ.get('BENCHMARK_DATABASE_URI', 'sqlite:///key_order.db'))
+    parser.add_argument('-n', '--rows', type=int, default=10000000)
+    parser.add_argument('-b', '--batch-size', type=int, default=10000)
+    parser.add_argument('--keep', action='store_true', help="don't drop the tables afterwards")
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_uri)
+    metadata = MetaData()
+
+    for kind, make_id in sorted(KINDS.items()):
+        table = keyTable(metadata, kind)
+
+        print('{} keys'.format(kind))
+        run(engine, table, make_id, args.rows, args.batch_size)
+
+        if not args.keep:
+            table.drop(engine)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+'''
+Fires a burst of concurrent webhooks at a server and reports how many it
+handled at once. With --compare it starts a single gunicorn worker of each
+kind from configs/gunicorn.conf.py in turn, sync and then gthread, and
+fires the same burst at both to show what the threads get out of a process:
+
+    python -m benchmarks.load_test --compare -c 50 -n 2000
+
+or give it the URL of a server that's already running:
+
+    python -m benchmarks.load_test http://127.0.0.1:8000 -c 50 -n 2000
+
+Senders need to exist in the app's database (load one of
+benchmarks.datasets with "flask budget import"), and turn
+RATE_LIMIT_BACKEND off there or the burst is mostly rate limited.
+'''
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode, urlsplit
+
+from benchmarks.datasets import DATASETS, friendGraph, personName, phoneNumber
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+async def post(host, port, path, body):
+    reader, writer = await asyncio.open_connection(host, port)
+
+    try:
+        writer.write('POST {0} HTTP/1.1\r\n'
+                     'Host: {1}:{2}\r\n'
+                     'Content-Type: application/x-www-form-urlencoded\r\n'
+                     'Content-Length: {3}\r\n'
+                     'Connection: close\r\n\r\n'.format(path, host, port, len(body)).encode()
+                     + body)
+
+        status_line = await reader.readline()
+        await reader.read()
+    finally:
+        writer.close()
+
+    return int(status_line.split()[1])
+
+
+class Run(object):
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.in_flight = 0
+        self.peak = 0
+
+
+async def worker(run, url, messages, count):
+    parts = urlsplit(url)
+    path = parts.path.rstrip('/') + '/incoming/'
+
+    for body in itertools.islice(messages, count):
+        run.in_flight += 1
+        run.peak = max(run.peak, run.in_flight)
+        started = time.time()
+
+        try:
+            status = await post(parts.hostname, parts.port or 80, path, body)
+        except OSError as e:
+            status = type(e).__name__
+        finally:
+            run.in_flight -= 1
+
+        run.latencies.append(time.time() - started)
+        run.statuses[status] = run.statuses.get(status, 0) + 1
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def messages(dataset, people, body):
+    '''
+    Webhook bodies from the dataset's first few people in turn, each asking
+    about one of their friends.
+    '''
+    # The same friends ledgerRecords made
+    friends = friendGraph(dataset, random.Random(1234))
+    run_id = int(time.time())
+
+    for index in itertools.count():
+        sender = index % people
+        yield urlencode({'Body': body.format(friend=personName(friends[sender][0])),
+                         'From': phoneNumber(sender),
+                         'MessageSid': 'SMload{0}{1:012d}'.format(run_id, index)}).encode()
+
+
+def burst(url, source, requests, concurrency):
+    run = Run()
+    per_worker, extra = divmod(requests, concurrency)
+    workers = [worker(run, url, source, per_worker + (index < extra))
+               for index in range(concurrency)]
+
+    loop = asyncio.get_event_loop()
+    started = time.time()
+    loop.run_until_complete(asyncio.gather(*workers))
+
+    return run, time.time() - started
+
+
+def report(run, elapsed):
+    latencies = sorted(run.latencies)
+
+    print('{0} requests in {1:.2f}s, {2:.1f}/s'.format(len(latencies), elapsed,
+                                                      len(latencies) / elapsed))
+    print('statuses: {}'.format(', '.join('{0}: {1}'.format(status, count)
+                                          for status, count in sorted(run.statuses.items(),
+                                                                      key=str))))
+    print('latency p50 {0:.3f}s  p90 {1:.3f}s  p99 {2:.3f}s  max {3:.3f}s'.format(
+        percentile(latencies, 0.5), percentile(latencies, 0.9),
+        percentile(latencies, 0.99), latencies[-1]))
+
+    # Little's law: the average number of requests the server had in hand
+    print('concurrency: {0:.1f} average, {1} peak'.format(sum(latencies) / elapsed, run.peak))
+
+
+def startWorker(worker_class, port):
+    '''
+    One gunicorn worker of worker_class on port, configured as in
+    production otherwise.
+    '''
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn',
+                               '-c', 'configs/gunicorn.conf.py',
+                               '-w', '1', '-k', worker_class,
+                               '-b', '127.0.0.1:{}'.format(port),
+                               'runserver:app'], cwd=ROOT)
+
+    deadline = time.time() + 30
+
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise RuntimeError('gunicorn did not start listening on port {}'.format(port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('url', nargs='?')
+    parser.add_argument('--compare', action='store_true',
+                        help='start a sync and then a gthread gunicorn worker to test')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='where --compare starts them')
+    parser.add_argument('-c', '--concurrency', type=int, default=50)
+    parser.add_argument('-n', '--requests', type=int, default=1000)
+    parser.add_argument('--dataset', default='sparse',
+                        help='which of benchmarks.datasets is loaded on the target')
+    parser.add_argument('--people', type=int, default=100,
+                        help='how many of its people send messages')
+    parser.add_argument('--body', default='How much do I owe {friend}?')
+    args = parser.parse_args()
+
+    if not args.compare and not args.url:
+        parser.error('give a URL or --compare')
+
+    dataset = next(dataset for dataset in DATASETS if dataset.name == args.dataset)
+    source = messages(dataset, min(args.people, dataset.people), args.body)
+
+    if not args.compare:
+        report(*burst(args.url, source, args.requests, args.concurrency))
+        return
+
+    for worker_class in ('sync', 'gthread'):
+        server = startWorker(worker_class, args.port)
+
+        try:
+            print('one {} worker:'.format(worker_class))
+            report(*burst('http://127.0.0.1:{}'.format(args.port), source,
+                          args.requests, args.concurrency))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''
+Measure how many messages per second parseCommand gets through on a
+corpus shaped like the texts people actually send, errors included.
+
+    python -m benchmarks.parser [messages]
+'''
+import random
+import time
+
+from budget.parser import parseCommand, ParseError
+
+
+NAMES = ['eric', 'kristi', 'Kristi', 'Mom', 'dave', 'Jo', 'ANNA', 'me', 'I']
+REASONS = ['lunch', 'Cab home', 'rent for March', 'concert tickets', 'beer']
+
+
+def corpus(count, rng):
+    messages = []
+
+    for _ in range(count):
+        roll = rng.random()
+        ower, owee = rng.sample(NAMES, 2)
+        amount = rng.choice(['${}', '{}', '${}.50']).format(rng.randint(1, 500))
+
+        if roll < 0.55:
+            message = '{0} owe{1} {2} {3}'.format(ower,
+                                                  '' if ower in ('I', 'me') else 's',
+                                                  owee,
+                                                  amount)
+            if rng.random() < 0.6:
+                message += ' for ' + rng.choice(REASONS)
+        elif roll < 0.85:
+            message = 'How much does {0} owe {1}?'.format(ower, owee)
+        elif roll < 0.92:
+            message = 'Add {0} ({1}) 555-{2:04d}'.format(owee.title(),
+                                                         rng.randint(200, 999),
+                                                         rng.randint(0, 9999))
+        elif roll < 0.95:
+            message = 'Settle up'
+        else:
+            message = rng.choice(['Owes 300', 'How much floop', 'hi!',
+                                  'Eric owes Kristi lots', 'Add floop'])
+
+        messages.append('  ' + message + ' ' if rng.random() < 0.1 else message)
+
+    return messages
+
+
+if __name__ == "__main__":
+    import sys
+
+    try:
+        count = int(sys.argv[1])
+    except (IndexError, ValueError):
+        count = 100000
+
+    messages = corpus(count, random.Random(1234))
+
+    errors = 0
+    started = time.perf_counter()
+
+    for message in messages:
+        try:
+            parseCommand(message)
+        except ParseError:
+            errors += 1
+
+    elapsed = time.perf_counter() - started
+
+    print('{0} messages ({1} errors) in {2:.3f}s: {3:,.0f} messages/second'.format(
+        count, errors, elapsed, count / elapsed))
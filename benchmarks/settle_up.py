@@ -0,0 +1,48 @@
+'''
+Time settleTransfers on random net positions for groups of 10 to 10,000
+people and report how many payments it came up with.
+
+    python -m benchmarks.settle_up [repeats]
+'''
+import random
+import time
+
+from budget.settle import settleTransfers
+
+
+SIZES = [10, 100, 1000, 10000]
+
+
+def randomPositions(size, rng):
+    positions = {}
+
+    for index in range(size - 1):
+        positions['+1312{:07d}'.format(index)] = rng.randint(-50000, 50000)
+
+    # Whatever's left over makes the group sum to zero
+    positions['+1312{:07d}'.format(size - 1)] = -sum(positions.values())
+
+    return positions
+
+
+if __name__ == "__main__":
+    import sys
+
+    try:
+        repeats = int(sys.argv[1])
+    except (IndexError, ValueError):
+        repeats = 5
+
+    rng = random.Random(1234)
+
+    for size in SIZES:
+        positions = randomPositions(size, rng)
+        timings = []
+
+        for _ in range(repeats):
+            started = time.perf_counter()
+            transfers = settleTransfers(positions)
+            timings.append(time.perf_counter() - started)
+
+        print('{0:>6} people  best {1:9.3f}ms  {2:>6} transfers'.format(
+            size, 1000 * min(timings), len(transfers)))
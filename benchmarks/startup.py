@@ -0,0 +1,171 @@
+'''
+How long a worker takes to boot and how much memory each one costs, with
+and without gunicorn's preload_app:
+
+    python -m benchmarks.startup -w 4
+
+First it starts a fresh interpreter a few times and times importing budget,
+create_app() and the first text (which is when the lazily imported
+dependencies load). Then it forks workers the two ways gunicorn does: each
+importing and creating the app itself, or forked from a master that has
+already done that and run budget.preload.preload(). Every worker handles
+a first text and reports its resident, proportional (RSS with shared
+pages split between the processes sharing them) and private memory.
+Memory figures come from /proc, so they need Linux.
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SETTINGS = {'SQLALCHEMY_DATABASE_URI': 'sqlite://'}
+
+COLD_START = '''
+import json, sys, time
+started = time.time()
+from budget import create_app
+imported = time.time()
+app = create_app(settings_override={settings!r})
+created = time.time()
+from benchmarks.startup import firstText, memory
+firstText(app)
+print(json.dumps(dict(memory(), imported=imported - started, created=created - imported,
+                      first_text=time.time() - created)))
+'''
+
+
+def memory():
+    '''
+    This process's memory in bytes from /proc/self/smaps_rollup.
+    '''
+    totals = {'rss': 0, 'pss': 0, 'private': 0}
+    fields = {'Rss:': 'rss', 'Pss:': 'pss', 'Private_Clean:': 'private', 'Private_Dirty:': 'private'}
+
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            lines = f.readlines()
+    except IOError:
+        return totals
+
+    for line in lines:
+        parts = line.split()
+
+        if parts and parts[0] in fields:
+            totals[fields[parts[0]]] += int(parts[1]) * 1024
+
+    return totals
+
+
+def firstText(app):
+    '''
+    What a worker's first text needs besides the database: parsing the
+    sender's number and a Twilio client to reply with.
+    '''
+    from budget.utils import normalizePhoneNumber
+
+    normalizePhoneNumber('312 555 5555')
+    app.extensions['twilio'].client
+
+
+def coldStarts(runs):
+    script = COLD_START.format(settings=SETTINGS)
+    results = []
+
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT)
+        results.append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    return results
+
+
+def worker(app, ready, measured, results):
+    if app is None:
+        from budget import create_app
+        app = create_app(settings_override=SETTINGS)
+
+    firstText(app)
+
+    # Measure once every worker is up, so shared pages are split between
+    # all of them
+    ready.wait()
+    results.put(memory())
+    measured.wait()
+
+
+def forkWorkers(count, preloaded):
+    context = multiprocessing.get_context('fork')
+    app = None
+
+    if preloaded:
+        from budget import create_app
+        from budget.preload import preload
+
+        app = create_app(settings_override=SETTINGS)
+        preload(app)
+
+    ready = context.Barrier(count)
+    measured = context.Barrier(count + 1)
+    results = context.Queue()
+
+    processes = [context.Process(target=worker, args=(app, ready, measured, results))
+                 for _ in range(count)]
+
+    for process in processes:
+        process.start()
+
+    reports = [results.get() for _ in processes]
+    measured.wait()
+
+    for process in processes:
+        process.join()
+
+    return reports
+
+
+def megabytes(value):
+    return '{:.1f}MB'.format(value / 2 ** 20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('-r', '--runs', type=int, default=5,
+                        help='fresh interpreters to time')
+    args = parser.parse_args()
+
+    starts = coldStarts(args.runs)
+
+    print('cold start, median of {} runs:'.format(args.runs))
+    print('  import budget {0:.3f}s  create_app {1:.3f}s  first text {2:.3f}s  RSS {3}'.format(
+        statistics.median(start['imported'] for start in starts),
+        statistics.median(start['created'] for start in starts),
+        statistics.median(start['first_text'] for start in starts),
+        megabytes(statistics.median(start['rss'] for start in starts))))
+
+    # Forking the preloaded master last keeps the other run's imports out
+    # of the master
+    for preloaded in (False, True):
+        started = time.time()
+        reports = forkWorkers(args.workers, preloaded)
+        elapsed = time.time() - started
+
+        print('{0} workers {1} in {2:.2f}s:'.format(
+            args.workers, 'forked from a preloaded master' if preloaded else 'loading the app',
+            elapsed))
+
+        for index, report in enumerate(reports):
+            print('  worker {0}: RSS {1}  PSS {2}  private {3}'.format(
+                index, megabytes(report['rss']), megabytes(report['pss']),
+                megabytes(report['private'])))
+
+        print('  total PSS {}'.format(megabytes(sum(report['pss'] for report in reports))))
+
+
+if __name__ == '__main__':
+    main()
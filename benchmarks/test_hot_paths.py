@@ -0,0 +1,63 @@
+'''
+IOUHandler end to end through the Flask test client, and the pieces of it
+that run on every message. See conftest.py for how to run these.
+'''
+import itertools
+
+from budget.cache import sender_cache
+
+from .datasets import phoneNumber
+
+
+def post(client, body):
+    rv = client.post('/incoming/', data={'Body': body, 'From': phoneNumber(0)})
+    assert rv.status_code == 200
+
+
+def test_inquiry(benchmark, client, handler):
+    iou, friend = handler
+    benchmark(post, client, 'How much do I owe {}?'.format(friend))
+
+
+def test_add_iou(benchmark, client, handler):
+    iou, friend = handler
+    benchmark(post, client, 'I owe {} $12.50 for lunch'.format(friend))
+
+
+def test_add_iou_batch(benchmark, client, handler):
+    iou, friend = handler
+    body = '\n'.join('I owe {0} ${1} for round {1}'.format(friend, n) for n in range(1, 6))
+    benchmark(post, client, body)
+
+
+def test_add_person(benchmark, client, ledger):
+    # Numbers well clear of the dataset's so every add is a new person
+    counter = itertools.count()
+
+    def addPerson():
+        n = next(counter)
+        post(client, 'Add new{0} (312) 9{1:02d}-{2:04d}'.format(n, n // 10000, n % 10000))
+
+    benchmark(addPerson)
+
+
+def test_balance(benchmark, handler):
+    iou, friend = handler
+    sender, receiver, sent_from_ower = iou.findRelationship('i', friend)
+
+    benchmark(iou.balance, sender, receiver)
+
+
+def test_find_relationship_cached(benchmark, handler):
+    iou, friend = handler
+    benchmark(iou.findRelationship, 'i', friend)
+
+
+def test_find_relationship_uncached(benchmark, handler):
+    iou, friend = handler
+
+    def findRelationship():
+        sender_cache.clear()
+        return iou.findRelationship('i', friend)
+
+    benchmark(findRelationship)
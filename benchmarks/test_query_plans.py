@@ -0,0 +1,133 @@
+'''
+EXPLAIN the ledger's hot queries and fail if any of them reads the whole
+iou table. Plans only mean something on a realistically sized table with
+fresh statistics, so run these against Postgres and the large dataset:
+
+    BENCHMARK_DATABASE_URI=postgresql://postgres:@localhost:5432/budget_benchmark \\
+    BENCHMARK_DATASETS=large pytest benchmarks/test_query_plans.py
+
+On the SQLite stand-in they check SQLite's plans instead. Where iou is
+partitioned, reading a whole partition counts too, and a date range has to
+leave out the partitions outside it.
+'''
+import json
+import random
+from datetime import datetime
+
+import pytest
+from pytz import utc
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from budget.balances import pairKey, pairTotalQuery, uncompactedQuery
+from budget.database import db
+from budget.exporter import ledgerQuery
+from budget.models import PairBalance
+from budget.partitions import isPartitioned, partitionMonth
+from budget.utils import TIMEZONE
+
+from .datasets import friendGraph, phoneNumber
+
+
+class Explain(Executable, ClauseElement):
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def explainPostgres(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+@compiles(Explain, 'sqlite')
+def explainSqlite(element, compiler, **kw):
+    return 'EXPLAIN QUERY PLAN ' + compiler.process(element.statement, **kw)
+
+
+def planNodes(plan):
+    yield plan
+
+    for child in plan.get('Plans', []):
+        yield from planNodes(child)
+
+
+def isIOU(relation):
+    if relation is None:
+        return False
+
+    return relation in ('iou', 'iou_default') or partitionMonth(relation) is not None
+
+
+def postgresPlan(query):
+    plan = db.session.execute(Explain(query.statement)).scalar()
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return list(planNodes(plan[0]['Plan']))
+
+
+def fullScans(query):
+    '''
+    Describe each step of the query's plan that reads all of iou (or of
+    one of its partitions).
+    '''
+    if db.engine.dialect.name == 'postgresql':
+        return ['{0} on {1}'.format(node['Node Type'], node['Relation Name'])
+                for node in postgresPlan(query)
+                if node['Node Type'] == 'Seq Scan' and isIOU(node.get('Relation Name'))]
+
+    rows = db.session.execute(Explain(query.statement)).fetchall()
+
+    # SQLite searches an index or scans a table (or a whole index)
+    return [row[-1] for row in rows if row[-1].startswith('SCAN') and ' iou' in row[-1]]
+
+
+def pairBalanceQuery(ower_phone, owee_phone):
+    (low, high), sign = pairKey(ower_phone, owee_phone)
+
+    return db.session.query(PairBalance.amount)\
+                     .filter(PairBalance.low_phone == low)\
+                     .filter(PairBalance.high_phone == high)
+
+
+HOT_QUERIES = {
+    'pair_balance': lambda person, friend: pairBalanceQuery(person, friend),
+    'pair_total': lambda person, friend: pairTotalQuery(person, friend),
+    'pair_uncompacted': lambda person, friend: uncompactedQuery(person, friend),
+    'pair_history': lambda person, friend: ledgerQuery(person, friend),
+    'person_history': lambda person, friend: ledgerQuery(person),
+    'person_history_since': lambda person, friend: ledgerQuery(
+        person, start=datetime(2017, 1, 1, tzinfo=utc)),
+}
+
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_no_full_scan(ledger, name):
+    app, dataset = ledger
+
+    # Somebody from the middle of the pack and one of their friends (the
+    # same ones ledgerRecords made). Person 0 is in enough of the ledger
+    # that reading all of it can be the right plan.
+    person = dataset.people // 2
+    friends = friendGraph(dataset, random.Random(1234))
+
+    query = HOT_QUERIES[name](phoneNumber(person), phoneNumber(friends[person][0]))
+
+    assert fullScans(query) == []
+
+
+def test_partition_pruning(ledger):
+    if not isPartitioned():
+        pytest.skip('iou is only partitioned on PostgreSQL 11 and later')
+
+    app, dataset = ledger
+
+    query = ledgerQuery(phoneNumber(dataset.people // 2),
+                        start=TIMEZONE.localize(datetime(2017, 6, 1)),
+                        end=TIMEZONE.localize(datetime(2017, 7, 1)))
+
+    scanned = {node['Relation Name'] for node in postgresPlan(query)
+               if isIOU(node.get('Relation Name'))}
+
+    assert scanned == {'iou_y2017m06'}
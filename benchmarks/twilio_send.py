@@ -0,0 +1,76 @@
+'''
+Compare outbound SMS latency with a fresh twilio.rest.Client per message
+(how sendTwilioResponse used to work) against the pooled per-process client
+from budget.sms, both talking to a local stub of the Twilio API.
+
+    python -m benchmarks.twilio_send [messages]
+'''
+import time
+
+from twilio.rest import Client
+
+from budget import create_app
+from budget.sms import TwilioClients
+from tests.twilio_stub import FakeTwilioServer
+
+
+def percentile(timings, pct):
+    timings = sorted(timings)
+    return timings[min(int(len(timings) * pct / 100.0), len(timings) - 1)]
+
+
+def report(label, timings, server, connections_before):
+    print('{0:<16} mean {1:7.3f}ms  p50 {2:7.3f}ms  p99 {3:7.3f}ms  '
+          'connections {4}'.format(label,
+                                   1000 * sum(timings) / len(timings),
+                                   1000 * percentile(timings, 50),
+                                   1000 * percentile(timings, 99),
+                                   server.connections - connections_before))
+
+
+def send(client, app, index):
+    client.messages.create(to='+13126666666',
+                           from_=app.config['TWILIO_NUMBER'],
+                           body='Eric now owes Kristi ${}'.format(index))
+
+
+def fresh_client(app, server):
+    client = Client(app.config['TWILIO_ACCOUNT_ID'],
+                    app.config['TWILIO_AUTH_TOKEN'])
+    client.api.base_url = server.url
+    return client
+
+
+if __name__ == "__main__":
+    import sys
+
+    try:
+        count = int(sys.argv[1])
+    except (IndexError, ValueError):
+        count = 500
+
+    server = FakeTwilioServer().start()
+    app = create_app(settings_override={'TWILIO_API_BASE': server.url})
+
+    timings = []
+    before = server.connections
+
+    for index in range(count):
+        started = time.perf_counter()
+        send(fresh_client(app, server), app, index)
+        timings.append(time.perf_counter() - started)
+
+    report('client per send', timings, server, before)
+
+    clients = TwilioClients(app)
+    timings = []
+    before = server.connections
+
+    for index in range(count):
+        started = time.perf_counter()
+        send(clients.client, app, index)
+        timings.append(time.perf_counter() - started)
+
+    report('pooled client', timings, server, before)
+
+    server.stop()
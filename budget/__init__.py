@@ -5,6 +5,15 @@ from flask_sqlalchemy import SQLAlchemy
 from .views import views
 from .admin import admin
 from .database import db
+from .dispatch import outbox
+from .sms import twilio_clients
+from .commands import budget_cli
+from .cache import sender_cache
+from .dedup import message_log
+from .throttle import rate_limiter
+from .metrics import metrics
+from .profiler import profiler
+from .replicas import replicas
 
 def create_app(name=__name__, settings_override={}):
     app = Flask(name)
@@ -15,8 +24,18 @@ def create_app(name=__name__, settings_override={}):
         app.config[k] = v
 
     db.init_app(app)
+    replicas.init_app(app)
+    outbox.init_app(app)
+    twilio_clients.init_app(app)
+    sender_cache.init_app(app)
+    message_log.init_app(app)
+    rate_limiter.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
 
     app.register_blueprint(views)
     app.register_blueprint(admin)
 
+    app.cli.add_command(budget_cli)
+
     return app
@@ -1,10 +1,50 @@
-from flask import Blueprint, current_app, request, abort, render_template
+import hmac
+from functools import wraps
+
+from flask import Blueprint, current_app, request, abort, render_template, jsonify, \
+    Response, stream_with_context
 
 
 from .database import db
+from .models import Person
+from .settle import settleUp
+from .exporter import ledgerQuery, exportLedger, FORMATS
+from .importer import parseDate
+from .replicas import readOnly
+from .utils import normalizePhoneNumber
 
 admin = Blueprint('admin', __name__)
 
+
+def adminRequired(view):
+    '''
+    Only let through requests that carry ADMIN_TOKEN, either as a bearer
+    token or as the password for HTTP basic auth. Without an ADMIN_TOKEN
+    configured the view isn't served at all.
+    '''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config.get('ADMIN_TOKEN')
+
+        if not token:
+            abort(404)
+
+        header = request.headers.get('Authorization', '')
+
+        if header.startswith('Bearer '):
+            given = header[len('Bearer '):]
+        elif request.authorization:
+            given = request.authorization.password or ''
+        else:
+            given = ''
+
+        if not hmac.compare_digest(given.encode('utf-8'), token.encode('utf-8')):
+            return Response('Unauthorized', 401, {'WWW-Authenticate': 'Basic realm="budget"'})
+
+        return view(*args, **kwargs)
+
+    return wrapper
+
 @admin.route('/')
 def index():
     return render_template('index.html')
@@ -13,3 +53,55 @@ def index():
 @admin.route('/my-account/')
 def my_account():
     return render_template('my-account.html')
+
+
+@admin.route('/settle/<phone_number>/')
+@adminRequired
+@readOnly
+def settle(phone_number):
+    Person.query.get_or_404(phone_number)
+
+    positions, transfers = settleUp(phone_number)
+
+    return jsonify(positions=positions,
+                   transfers=[transfer._asdict() for transfer in transfers])
+
+
+@admin.route('/export/')
+@adminRequired
+@readOnly
+def export():
+    '''
+    Stream the ledger as CSV or NDJSON, e.g.
+    /export/?phone=3125555555&counterpart=3126666666&start=2018-01-01&format=ndjson
+    '''
+    format = request.args.get('format', 'csv')
+
+    if format not in FORMATS:
+        abort(400)
+
+    filters = {}
+
+    try:
+        for arg, name in [('phone', 'phone_number'), ('counterpart', 'counterpart')]:
+            if request.args.get(arg):
+                filters[name] = normalizePhoneNumber(request.args[arg])
+
+        for arg in ['start', 'end']:
+            if request.args.get(arg):
+                filters[arg] = parseDate(request.args[arg])
+    except ValueError:
+        abort(400)
+
+    # As with budget export, a counterpart only narrows down a phone
+    if 'counterpart' in filters and 'phone_number' not in filters:
+        abort(400)
+
+    rows = exportLedger(ledgerQuery(**filters), format=format)
+
+    filename = 'ledger.{}'.format(format)
+    headers = {'Content-Disposition': 'attachment; filename={}'.format(filename)}
+
+    return Response(stream_with_context(rows),
+                    mimetype=FORMATS[format],
+                    headers=headers)
@@ -0,0 +1,210 @@
+from collections import namedtuple
+
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy.exc import IntegrityError
+
+from .database import db
+from .models import IOU, ArchivedBalance, BalanceCheckpoint, PairBalance
+
+
+Mismatch = namedtuple('Mismatch', ['low_phone', 'high_phone', 'expected', 'actual'])
+PairTotals = namedtuple('PairTotals', ['amount', 'iou_count', 'last_updated'])
+
+
+def pairKey(ower_phone, owee_phone):
+    '''
+    Returns the (low_phone, high_phone) key for a pair and the sign to put
+    on an amount that ower_phone owes owee_phone.
+    '''
+    if ower_phone < owee_phone:
+        return (ower_phone, owee_phone), 1
+    return (owee_phone, ower_phone), -1
+
+
+def recordIOU(ower_phone, owee_phone, amount, date_added, count=1):
+    '''
+    Fold a new IOU (or count of them adding up to amount) into
+    pair_balance. This only flushes, so it lands in the same transaction as
+    the IOUs themselves.
+    '''
+    (low, high), sign = pairKey(ower_phone, owee_phone)
+
+    updated = PairBalance.query\
+                         .filter(PairBalance.low_phone == low)\
+                         .filter(PairBalance.high_phone == high)\
+                         .update({
+                             PairBalance.amount: PairBalance.amount + sign * amount,
+                             PairBalance.iou_count: PairBalance.iou_count + count,
+                             PairBalance.last_updated: date_added,
+                         }, synchronize_session=False)
+
+    if updated:
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.add(PairBalance(low_phone=low,
+                                       high_phone=high,
+                                       amount=sign * amount,
+                                       iou_count=count,
+                                       last_updated=date_added))
+    except IntegrityError:
+        # Somebody else created the row first, so there's one to update now
+        recordIOU(ower_phone, owee_phone, amount, date_added, count)
+
+
+def pairBalance(ower_phone, owee_phone):
+    '''
+    How many cents ower_phone owes owee_phone, negative if it's the other
+    way.
+    '''
+    (low, high), sign = pairKey(ower_phone, owee_phone)
+
+    # A column query rather than query.get, so that it sees what recordIOU
+    # just did in this transaction instead of a stale PairBalance
+    amount = db.session.query(PairBalance.amount)\
+                       .filter(PairBalance.low_phone == low)\
+                       .filter(PairBalance.high_phone == high)\
+                       .scalar()
+
+    if amount is None:
+        # IOUs that were written without going through recordIOU
+        return computePairBalance(ower_phone, owee_phone)
+
+    return sign * amount
+
+
+def uncompactedQuery(ower_phone, owee_phone):
+    '''
+    What ower_phone owes owee_phone in the IOUs between them that haven't
+    been compacted into a BalanceCheckpoint yet.
+    '''
+    signed = case([(IOU.ower_id == ower_phone, IOU.amount)], else_=-IOU.amount)
+
+    return db.session.query(func.coalesce(func.sum(signed), 0))\
+                     .filter(or_(and_(IOU.ower_id == ower_phone,
+                                      IOU.owee_id == owee_phone),
+                                 and_(IOU.ower_id == owee_phone,
+                                      IOU.owee_id == ower_phone)))\
+                     .filter(IOU.compacted_at == None)
+
+
+def pairTotalQuery(ower_phone, owee_phone):
+    '''
+    What ower_phone owes owee_phone according to their BalanceCheckpoint
+    plus the IOUs between them that haven't been compacted into it yet, in
+    one statement so that it sees a single snapshot of both.
+    '''
+    (low, high), sign = pairKey(ower_phone, owee_phone)
+
+    delta = uncompactedQuery(ower_phone, owee_phone).as_scalar()
+
+    checkpoint = db.session.query(BalanceCheckpoint.amount)\
+                           .filter(BalanceCheckpoint.low_phone == low)\
+                           .filter(BalanceCheckpoint.high_phone == high)\
+                           .as_scalar()
+
+    return db.session.query(func.coalesce(checkpoint, 0) * sign + delta)
+
+
+def computePairBalance(ower_phone, owee_phone):
+    '''
+    Work a pair's balance out from the ledger rather than pair_balance.
+    '''
+    return int(pairTotalQuery(ower_phone, owee_phone).scalar())
+
+
+def computePairBalances(*criteria):
+    '''
+    Recompute every pair's balance from the iou table (or the IOUs matching
+    criteria) in one grouped query. Yields (low_phone, high_phone, amount,
+    iou_count, last_updated) rows.
+    '''
+    ower_is_low = IOU.ower_id < IOU.owee_id
+
+    low = case([(ower_is_low, IOU.ower_id)], else_=IOU.owee_id)
+    high = case([(ower_is_low, IOU.owee_id)], else_=IOU.ower_id)
+    signed = case([(ower_is_low, IOU.amount)], else_=-IOU.amount)
+
+    return db.session.query(low.label('low_phone'),
+                            high.label('high_phone'),
+                            func.sum(signed).label('amount'),
+                            func.count(IOU.id).label('iou_count'),
+                            func.max(IOU.date_added).label('last_updated'))\
+                     .filter(*criteria)\
+                     .group_by(low, high)
+
+
+def ledgerTotals(*criteria):
+    '''
+    Every pair's totals from the iou table (or the IOUs matching criteria)
+    plus the months that have been archived out of it, as a dict of
+    (low_phone, high_phone) to PairTotals.
+    '''
+    totals = {(row.low_phone, row.high_phone): PairTotals(int(row.amount),
+                                                          row.iou_count,
+                                                          row.last_updated)
+              for row in computePairBalances(*criteria)}
+
+    archived = db.session.query(ArchivedBalance.low_phone,
+                                ArchivedBalance.high_phone,
+                                func.sum(ArchivedBalance.amount).label('amount'),
+                                func.sum(ArchivedBalance.iou_count).label('iou_count'),
+                                func.max(ArchivedBalance.last_updated).label('last_updated'))\
+                         .group_by(ArchivedBalance.low_phone, ArchivedBalance.high_phone)
+
+    for row in archived:
+        key = (row.low_phone, row.high_phone)
+        live = totals.get(key, PairTotals(0, 0, None))
+        dates = [date for date in (live.last_updated, row.last_updated) if date is not None]
+
+        totals[key] = PairTotals(live.amount + int(row.amount),
+                                 live.iou_count + int(row.iou_count),
+                                 max(dates) if dates else None)
+
+    return totals
+
+
+def checkBalances(repair=False):
+    '''
+    Compare pair_balance against the iou table (and anything archived out
+    of it) and return a Mismatch for every pair that disagrees. With
+    repair=True the stored rows are overwritten with the recomputed ones.
+    '''
+    expected = ledgerTotals()
+    actual = {(row.low_phone, row.high_phone): row for row in PairBalance.query}
+
+    mismatches = []
+
+    for key in sorted(set(expected) | set(actual)):
+        want = expected.get(key)
+        have = actual.get(key)
+
+        want_totals = (want.amount, want.iou_count) if want else None
+        have_totals = (have.amount, have.iou_count) if have else None
+
+        if want_totals == have_totals:
+            continue
+
+        mismatches.append(Mismatch(key[0], key[1], want_totals, have_totals))
+
+        if not repair:
+            continue
+
+        if want is None:
+            db.session.delete(have)
+        elif have is None:
+            db.session.add(PairBalance(low_phone=key[0],
+                                       high_phone=key[1],
+                                       amount=want.amount,
+                                       iou_count=want.iou_count,
+                                       last_updated=want.last_updated))
+        else:
+            have.amount = want.amount
+            have.iou_count = want.iou_count
+            have.last_updated = want.last_updated
+
+    if repair:
+        db.session.commit()
+
+    return mismatches
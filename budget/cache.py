@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy.orm import aliased
+
+from .database import db
+from .models import Person, person_to_person
+from .stats import stats
+
+
+Friend = namedtuple('Friend', ['phone_number', 'name'])
+SenderProfile = namedtuple('SenderProfile', ['phone_number', 'name', 'admin', 'friends'])
+
+
+def loadProfile(phone_number):
+    '''
+    Load a person along with every alias they've set up, in one query.
+    Returns None if nobody has that phone number.
+    '''
+    friend = aliased(Person)
+
+    rows = db.session.query(Person.name,
+                            Person.admin,
+                            person_to_person.c.alias,
+                            friend.phone_number.label('friend_phone'),
+                            friend.name.label('friend_name'))\
+                     .outerjoin(person_to_person,
+                                person_to_person.c.from_phone == Person.phone_number)\
+                     .outerjoin(friend,
+                                friend.phone_number == person_to_person.c.to_phone)\
+                     .filter(Person.phone_number == phone_number)\
+                     .all()
+
+    if not rows:
+        return None
+
+    friends = {row.alias: Friend(row.friend_phone, row.friend_name)
+               for row in rows if row.alias is not None}
+
+    return SenderProfile(phone_number, rows[0].name, rows[0].admin, friends)
+
+
+class SenderCache(object):
+    '''
+    LRU cache of SenderProfiles so that resolving "I owe Kristi" doesn't
+    look up the sender, the alias and the friend on every text. Entries
+    expire after SENDER_CACHE_TTL seconds, which bounds how long an edit
+    made outside of IOUHandler (or in another worker) can go unnoticed.
+    '''
+    def __init__(self, size=1024, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('SENDER_CACHE_SIZE', self.size)
+        app.config.setdefault('SENDER_CACHE_TTL', self.ttl)
+
+        self.size = app.config['SENDER_CACHE_SIZE']
+        self.ttl = app.config['SENDER_CACHE_TTL']
+        self.clear()
+
+    def get(self, phone_number):
+        now = time.time()
+
+        with self._lock:
+            entry = self.profiles.get(phone_number)
+
+            if entry is not None and entry[0] > now:
+                self.profiles.move_to_end(phone_number)
+                stats.incr('sender_cache.hits')
+                return entry[1]
+
+        stats.incr('sender_cache.misses')
+
+        profile = loadProfile(phone_number)
+
+        if profile is not None and self.size > 0:
+            with self._lock:
+                self.profiles[phone_number] = (now + self.ttl, profile)
+                self.profiles.move_to_end(phone_number)
+
+                while len(self.profiles) > self.size:
+                    self.profiles.popitem(last=False)
+
+        return profile
+
+    def invalidate(self, phone_number):
+        with self._lock:
+            self.profiles.pop(phone_number, None)
+
+    def clear(self):
+        with self._lock:
+            self.profiles.clear()
+
+
+sender_cache = SenderCache()
@@ -0,0 +1,129 @@
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+from pytz import utc
+from sqlalchemy.exc import IntegrityError
+
+from .balances import Mismatch, ledgerTotals, pairKey
+from .database import db
+from .models import IOU, BalanceCheckpoint
+from .stats import stats
+
+
+Compaction = namedtuple('Compaction', ['ious', 'pairs', 'batches'])
+
+
+def foldIntoCheckpoint(low, high, amount, count, through_date, through_id, now):
+    '''
+    Add amount and count to a pair's checkpoint, creating it if need be.
+    '''
+    updated = BalanceCheckpoint.query\
+                               .filter(BalanceCheckpoint.low_phone == low)\
+                               .filter(BalanceCheckpoint.high_phone == high)\
+                               .update({
+                                   BalanceCheckpoint.amount: BalanceCheckpoint.amount + amount,
+                                   BalanceCheckpoint.iou_count: BalanceCheckpoint.iou_count + count,
+                                   BalanceCheckpoint.through_date: through_date,
+                                   BalanceCheckpoint.through_id: through_id,
+                                   BalanceCheckpoint.updated: now,
+                               }, synchronize_session=False)
+
+    if updated:
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.add(BalanceCheckpoint(low_phone=low,
+                                             high_phone=high,
+                                             amount=amount,
+                                             iou_count=count,
+                                             through_date=through_date,
+                                             through_id=through_id,
+                                             updated=now))
+    except IntegrityError:
+        foldIntoCheckpoint(low, high, amount, count, through_date, through_id, now)
+
+
+def compactBatch(batch_size):
+    '''
+    Fold the oldest batch_size IOUs that haven't been compacted into their
+    pairs' checkpoints and mark them compacted, in one transaction. Returns
+    how many IOUs and pairs it did.
+    '''
+    query = db.session.query(IOU.id, IOU.ower_id, IOU.owee_id, IOU.amount, IOU.date_added)\
+                      .filter(IOU.compacted_at == None)\
+                      .order_by(IOU.date_added, IOU.id)\
+                      .limit(batch_size)
+
+    if db.engine.dialect.name == 'postgresql':
+        # Another compaction job skips these rather than counting them twice
+        query = query.with_for_update(skip_locked=True)
+
+    rows = query.all()
+
+    if not rows:
+        db.session.rollback()
+        return 0, 0
+
+    now = datetime.now(utc)
+    pairs = OrderedDict()
+
+    for row in rows:
+        (low, high), sign = pairKey(row.ower_id, row.owee_id)
+        amount, count, through = pairs.get((low, high), (0, 0, None))
+        pairs[(low, high)] = (amount + sign * row.amount, count + 1, row)
+
+    for (low, high), (amount, count, through) in pairs.items():
+        foldIntoCheckpoint(low, high, amount, count, through.date_added, through.id, now)
+
+    IOU.query.filter(IOU.id.in_([row.id for row in rows]))\
+             .update({IOU.compacted_at: now}, synchronize_session=False)
+
+    db.session.commit()
+
+    stats.incr('compaction.ious', len(rows))
+    stats.incr('compaction.batches')
+
+    return len(rows), len(pairs)
+
+
+def compactBalances(batch_size=5000, max_batches=None):
+    '''
+    Fold every IOU that isn't in a checkpoint yet into one, a batch at a
+    time. Each batch commits on its own, so the job can be stopped at any
+    point and picks up where it left off, and it never touches the rows
+    addIOU writes to (new IOUs and pair_balance).
+    '''
+    ious = pairs = batches = 0
+
+    while max_batches is None or batches < max_batches:
+        compacted, touched = compactBatch(batch_size)
+
+        if not compacted:
+            break
+
+        ious += compacted
+        pairs += touched
+        batches += 1
+
+        if compacted < batch_size:
+            break
+
+    return Compaction(ious, pairs, batches)
+
+
+def verifyCheckpoints():
+    '''
+    Recompute every checkpoint from the compacted IOUs, archived ones
+    included, and return a Mismatch for each one that disagrees.
+    '''
+    expected = {key: (totals.amount, totals.iou_count)
+                for key, totals in ledgerTotals(IOU.compacted_at != None).items()}
+    actual = {(row.low_phone, row.high_phone): (row.amount, row.iou_count)
+              for row in BalanceCheckpoint.query}
+
+    db.session.rollback()
+
+    return [Mismatch(key[0], key[1], expected.get(key), actual.get(key))
+            for key in sorted(set(expected) | set(actual))
+            if expected.get(key) != actual.get(key)]
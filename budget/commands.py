@@ -0,0 +1,213 @@
+import time
+
+import click
+
+from flask.cli import AppGroup
+
+from .balances import checkBalances
+from .checkpoints import compactBalances, verifyCheckpoints
+from .dedup import message_log
+from .database import db
+from .importer import importLedger, parseDate
+from .exporter import ledgerQuery, exportLedger, FORMATS
+from .partitions import PartitionError, archivePartitions, createPartitions
+from .utils import normalizePhoneNumber
+
+
+budget_cli = AppGroup('budget', help='Maintenance commands for the budget app.')
+
+
+@budget_cli.command('check-balances')
+@click.option('--repair', is_flag=True,
+              help='Overwrite pair_balance rows that disagree with the iou table.')
+def check_balances(repair):
+    '''
+    Recompute every pair balance from the iou table and compare it with
+    pair_balance.
+    '''
+    mismatches = checkBalances(repair=repair)
+
+    for mismatch in mismatches:
+        click.echo('{0.low_phone} / {0.high_phone}: expected {0.expected}, '
+                   'found {0.actual}'.format(mismatch))
+
+    if not mismatches:
+        click.echo('All pair balances match the iou table')
+    elif repair:
+        click.echo('Repaired {} pair balances'.format(len(mismatches)))
+    else:
+        raise click.ClickException('{} pair balances do not match the '
+                                   'iou table'.format(len(mismatches)))
+
+
+@budget_cli.command('compact-balances')
+@click.option('--batch-size', default=5000,
+              help='IOUs to fold in per transaction.')
+@click.option('--every', type=float,
+              help='Keep running, compacting again this many seconds after each pass.')
+def compact_balances(batch_size, every):
+    '''
+    Fold IOUs into the per-pair balance checkpoints. Safe to stop at any
+    point and to run alongside the app.
+    '''
+    while True:
+        result = compactBalances(batch_size=batch_size)
+
+        click.echo('Compacted {0.ious} IOUs into {0.pairs} checkpoints '
+                   'in {0.batches} batches'.format(result))
+
+        if every is None:
+            break
+
+        time.sleep(every)
+
+
+@budget_cli.command('verify-checkpoints')
+def verify_checkpoints():
+    '''
+    Recompute every balance checkpoint from the IOUs compacted into it and
+    report the ones that disagree.
+    '''
+    mismatches = verifyCheckpoints()
+
+    for mismatch in mismatches:
+        click.echo('{0.low_phone} / {0.high_phone}: expected {0.expected}, '
+                   'found {0.actual}'.format(mismatch))
+
+    if mismatches:
+        raise click.ClickException('{} balance checkpoints do not match the '
+                                   'iou table'.format(len(mismatches)))
+
+    click.echo('All balance checkpoints match the iou table')
+
+
+@budget_cli.command('prune-messages')
+def prune_messages():
+    '''
+    Forget processed Twilio MessageSids older than DEDUP_TTL.
+    '''
+    pruned = message_log.prune()
+    db.session.commit()
+
+    click.echo('Pruned {} processed messages'.format(pruned))
+
+
+@budget_cli.command('import')
+@click.argument('source', type=click.File('r'))
+@click.option('--format', 'format', type=click.Choice(['csv', 'jsonl']),
+              help='Defaults to jsonl for .jsonl/.ndjson files and csv otherwise.')
+@click.option('--batch-size', default=10000,
+              help='Rows to buffer before writing them to the staging tables.')
+def import_ledger(source, format, batch_size):
+    '''
+    Bulk load people, aliases and IOUs from a CSV or JSON lines file
+    (use - for stdin).
+    '''
+    if format is None:
+        jsonl = source.name.endswith(('.jsonl', '.ndjson'))
+        format = 'jsonl' if jsonl else 'csv'
+
+    def on_error(line, error):
+        click.echo('Record {0}: {1}'.format(line, error), err=True)
+
+    def on_batch(result):
+        click.echo('{0.read} rows read ({0.rate:,.0f} rows/second)'.format(result),
+                   err=True)
+
+    result = importLedger(source,
+                          format=format,
+                          batch_size=batch_size,
+                          on_error=on_error,
+                          on_batch=on_batch)
+
+    click.echo('Read {0.read} rows in {0.elapsed:.1f}s ({0.rate:,.0f} rows/second): '
+               '{0.people} people, {0.aliases} aliases and {0.ious} IOUs added, '
+               '{0.skipped} IOUs already imported, {0.rejected} rows rejected'.format(result))
+
+
+def phoneOption(ctx, param, value):
+    if value is None:
+        return None
+
+    try:
+        return normalizePhoneNumber(value)
+    except ValueError:
+        raise click.BadParameter('"{}" is not a valid phone number'.format(value))
+
+
+def dateOption(ctx, param, value):
+    if value is None:
+        return None
+
+    try:
+        return parseDate(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@budget_cli.command('export')
+@click.argument('output', type=click.File('w'), default='-')
+@click.option('--phone', callback=phoneOption,
+              help='Only IOUs this phone number is part of.')
+@click.option('--counterpart', callback=phoneOption,
+              help='Only IOUs between --phone and this phone number.')
+@click.option('--start', callback=dateOption,
+              help='Only IOUs added on or after this date (YYYY-MM-DD).')
+@click.option('--end', callback=dateOption,
+              help='Only IOUs added before this date (YYYY-MM-DD).')
+@click.option('--format', 'format', type=click.Choice(sorted(FORMATS)), default='csv')
+def export_ledger(output, phone, counterpart, start, end, format):
+    '''
+    Stream the iou ledger to OUTPUT (stdout by default) as CSV or NDJSON.
+    '''
+    if counterpart and not phone:
+        raise click.UsageError('--counterpart only makes sense with --phone')
+
+    query = ledgerQuery(phone_number=phone,
+                        counterpart=counterpart,
+                        start=start,
+                        end=end)
+
+    for line in exportLedger(query, format=format):
+        output.write(line)
+
+
+@budget_cli.command('create-partitions')
+@click.option('--months-ahead', default=3,
+              help='Months past this one to have partitions ready for.')
+def create_partitions(months_ahead):
+    '''
+    Create the monthly iou partitions that don't exist yet. Run it from
+    cron; IOUs for a month it hasn't got to go in the default partition.
+    '''
+    try:
+        created = createPartitions(months_ahead=months_ahead)
+    except PartitionError as e:
+        raise click.ClickException(str(e))
+
+    for name in created:
+        click.echo('Created {}'.format(name))
+
+    click.echo('Created {} partitions'.format(len(created)))
+
+
+@budget_cli.command('archive-partitions')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False, writable=True))
+@click.option('--before', callback=dateOption, required=True,
+              help='Archive the months that end on or before the first of '
+                   'the month this date (YYYY-MM-DD) is in.')
+def archive_partitions(directory, before):
+    '''
+    Write settled months of the iou table out to gzipped CSV files in
+    DIRECTORY and drop them from the database. Every IOU in a month has
+    to have been compacted into a balance checkpoint first.
+    '''
+    try:
+        archived = archivePartitions(directory, before)
+    except PartitionError as e:
+        raise click.ClickException(str(e))
+
+    for archive in archived:
+        click.echo('Archived {0.iou_count} IOUs from {0.partition} to {0.path}'.format(archive))
+
+    click.echo('Archived {} partitions'.format(len(archived)))
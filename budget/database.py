@@ -1,4 +1,201 @@
+import threading
+import time
+from contextlib import contextmanager
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+from .stats import stats
+
+_local = threading.local()
+
+
+class SessionRegistry(object):
+    '''
+    Stands in for the registry behind db.session, so that inside
+    usingSession() db.session and Model.query give that session (a
+    replica's, say) instead of the one for the app context.
+    '''
+    def __init__(self, registry):
+        self.registry = registry
+
+    def __call__(self):
+        session = getattr(_local, 'session', None)
+
+        if session is not None:
+            return session
+
+        return self.registry()
+
+    def has(self):
+        return self.registry.has()
+
+    def set(self, session):
+        self.registry.set(session)
+
+    def clear(self):
+        self.registry.clear()
+
+
+class Database(SQLAlchemy):
+    def create_scoped_session(self, options=None):
+        session = super(Database, self).create_scoped_session(options)
+        session.registry = SessionRegistry(session.registry)
+        return session
+
+
+db = Database()
+
+
+def sessionOverride():
+    return getattr(_local, 'session', None)
+
+
+@contextmanager
+def usingSession(session):
+    previous = getattr(_local, 'session', None)
+    _local.session = session
+
+    try:
+        yield session
+    finally:
+        _local.session = previous
+
+
+class UnitOfWork(object):
+    def __init__(self):
+        self.round_trips = 0
+        self.commits = 0
+        self.query_time = 0.0
+        self.callbacks = []
+        self.wrote = False
+
+
+def currentUnit():
+    return getattr(_local, 'unit', None)
+
+
+def afterCommit(callback, *args):
+    '''
+    Call callback once the current unit of work has committed, or straight
+    away if there isn't one. Nothing is called if it's rolled back.
+    '''
+    unit = currentUnit()
+
+    if unit is None:
+        callback(*args)
+    else:
+        unit.callbacks.append((callback, args))
+
+
+@contextmanager
+def unitOfWork():
+    '''
+    Run a block as a single transaction. Code inside it flushes (using
+    savepoints where it expects conflicts) but doesn't commit. The block is
+    committed once at the end, or rolled back if it raises.
+    '''
+    unit = UnitOfWork()
+    _local.unit = unit
+
+    try:
+        yield unit
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        _local.unit = None
+
+        stats.incr('uow.count')
+        stats.incr('uow.round_trips', unit.round_trips)
+        stats.incr('uow.commits', unit.commits)
+        stats.observe('uow.query_seconds', unit.query_time)
+
+    for callback, args in unit.callbacks:
+        callback(*args)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def countStatement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.time())
+
+    stats.incr('db.statements')
+
+    unit = currentUnit()
+
+    if unit is not None:
+        unit.round_trips += 1
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def timeStatement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.time() - conn.info['query_started'].pop()
+
+    stats.observe('db.query_seconds', elapsed)
+
+    unit = currentUnit()
+
+    if unit is not None:
+        unit.query_time += elapsed
+
+
+@event.listens_for(Engine, 'handle_error')
+def dropStatement(context):
+    if context.connection is not None:
+        started = context.connection.info.get('query_started')
+
+        if started:
+            started.pop()
+
+
+@event.listens_for(Engine, 'commit')
+def countCommit(conn):
+    stats.incr('db.commits')
+
+    unit = currentUnit()
+
+    if unit is not None:
+        unit.round_trips += 1
+        unit.commits += 1
+
+
+@event.listens_for(Engine, 'rollback')
+def countRollback(conn):
+    stats.incr('db.rollbacks')
+
+    unit = currentUnit()
+
+    if unit is not None:
+        unit.round_trips += 1
+
+
+@event.listens_for(Pool, 'connect')
+def countConnect(dbapi_connection, record):
+    stats.incr('db.pool.connects')
+
+
+@event.listens_for(Pool, 'checkout')
+def countCheckout(dbapi_connection, record, proxy):
+    stats.incr('db.pool.checkouts')
+
+
+# pysqlite doesn't emit BEGIN until the first write and treats SAVEPOINT as
+# the start of a transaction, which makes savepoints commit. Take over
+# starting transactions so that SQLite behaves like PostgreSQL.
+@event.listens_for(Engine, 'connect')
+def sqliteConnect(dbapi_connection, record):
+    if type(dbapi_connection).__module__.startswith('sqlite3'):
+        dbapi_connection.isolation_level = None
+
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys = ON')
+        cursor.close()
 
-db = SQLAlchemy()
 
+@event.listens_for(Engine, 'begin')
+def sqliteBegin(conn):
+    if conn.dialect.name == 'sqlite':
+        conn.execute('BEGIN')
@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from pytz import utc
+from sqlalchemy.exc import IntegrityError
+
+from .database import db, afterCommit
+from .models import ProcessedMessage
+from .stats import stats
+
+
+class MessageLog(object):
+    '''
+    Remembers which Twilio MessageSids we've handled so that a retried
+    webhook is answered without running IOUHandler again. The
+    processed_message table is the source of truth. An LRU of recent sids
+    in front of it means a retry that comes back to the same worker doesn't
+    touch the database at all. Rows older than DEDUP_TTL seconds are
+    pruned, at most once every DEDUP_PRUNE_INTERVAL seconds per worker.
+    '''
+    def __init__(self, size=4096, ttl=86400, prune_interval=3600):
+        self.size = size
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self.responses = OrderedDict()
+        self.pruned = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('DEDUP_CACHE_SIZE', self.size)
+        app.config.setdefault('DEDUP_TTL', self.ttl)
+        app.config.setdefault('DEDUP_PRUNE_INTERVAL', self.prune_interval)
+
+        self.size = app.config['DEDUP_CACHE_SIZE']
+        self.ttl = app.config['DEDUP_TTL']
+        self.prune_interval = app.config['DEDUP_PRUNE_INTERVAL']
+        self.clear()
+
+    def claim(self, message_sid):
+        '''
+        Returns None if this is the first time we've seen message_sid, after
+        adding its row to the current transaction. That row is committed
+        along with whatever the message does, so a concurrent retry blocks
+        on it and then sees it. Otherwise returns the reply we sent the
+        first time ('' if that's still being worked out).
+        '''
+        with self._lock:
+            if message_sid in self.responses:
+                self.responses.move_to_end(message_sid)
+                stats.incr('dedup.cache_hits')
+                stats.incr('dedup.suppressed')
+                return self.responses[message_sid]
+
+        # This is the first statement in the request's transaction, so a
+        # conflict can roll the whole thing back instead of needing a
+        # savepoint around it
+        db.session.add(ProcessedMessage(message_sid=message_sid,
+                                        created=datetime.now(utc)))
+
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+        else:
+            return None
+
+        stats.incr('dedup.suppressed')
+
+        processed = ProcessedMessage.query.get(message_sid)
+        response = processed.response if processed else None
+
+        if response is None:
+            return ''
+
+        self.remember(message_sid, response)
+
+        return response
+
+    def record(self, message_sid, response):
+        '''
+        Save the reply to a claimed message in the current transaction.
+        '''
+        updated = ProcessedMessage.query\
+                                  .filter(ProcessedMessage.message_sid == message_sid)\
+                                  .update({ProcessedMessage.response: response},
+                                          synchronize_session=False)
+
+        if not updated:
+            # The claim was rolled back along with a failed command
+            try:
+                with db.session.begin_nested():
+                    db.session.add(ProcessedMessage(message_sid=message_sid,
+                                                    response=response,
+                                                    created=datetime.now(utc)))
+            except IntegrityError:
+                return
+
+        if time.time() - self.pruned > self.prune_interval:
+            self.prune()
+
+        afterCommit(self.remember, message_sid, response)
+
+    def remember(self, message_sid, response):
+        if self.size <= 0:
+            return
+
+        with self._lock:
+            self.responses[message_sid] = response
+            self.responses.move_to_end(message_sid)
+
+            while len(self.responses) > self.size:
+                self.responses.popitem(last=False)
+
+    def prune(self):
+        '''
+        Delete processed_message rows older than the TTL. Doesn't commit.
+        '''
+        cutoff = datetime.now(utc) - timedelta(seconds=self.ttl)
+
+        pruned = ProcessedMessage.query\
+                                 .filter(ProcessedMessage.created < cutoff)\
+                                 .delete(synchronize_session=False)
+
+        self.pruned = time.time()
+        stats.incr('dedup.pruned', pruned)
+
+        return pruned
+
+    def clear(self):
+        with self._lock:
+            self.responses.clear()
+
+
+message_log = MessageLog()
@@ -0,0 +1,358 @@
+import atexit
+import calendar
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pytz import utc
+
+from .database import db, afterCommit, currentUnit
+from .models import OutboundMessage
+from .profiler import profiler
+from .stats import stats
+from .utils import sendTwilioResponse
+
+logger = logging.getLogger(__name__)
+
+
+class Envelope(object):
+    def __init__(self, body, to_number, id=None, attempts=0, enqueued=None):
+        self.body = body
+        self.to_number = to_number
+        self.id = id
+        self.attempts = attempts
+        self.enqueued = enqueued or time.time()
+        self.not_before = self.enqueued
+        self.trace = None
+
+    def __repr__(self):
+        return '<Envelope to %r (%r attempts)>' % (self.to_number, self.attempts)
+
+
+class MemoryBackend(object):
+    '''
+    Keeps outgoing messages in a priority queue ordered by the time they
+    become eligible for (re)delivery. Anything still queued when the process
+    dies is lost.
+    '''
+    durable = False
+
+    def __init__(self):
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+
+    def put(self, envelope):
+        self.queue.put((envelope.not_before, next(self.sequence), envelope))
+
+    def get(self, timeout):
+        try:
+            not_before, sequence, envelope = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        wait = not_before - time.time()
+
+        if wait > 0:
+            self.queue.put((not_before, sequence, envelope))
+            time.sleep(min(wait, timeout))
+            return None
+
+        return envelope
+
+    def ack(self, envelope):
+        pass
+
+    def retry(self, envelope, delay, error):
+        envelope.not_before = time.time() + delay
+        self.put(envelope)
+
+    def fail(self, envelope, error):
+        pass
+
+    def depth(self):
+        return self.queue.qsize()
+
+
+class DatabaseBackend(object):
+    '''
+    Stores outgoing messages in the outbound_message table so that they
+    survive restarts. Workers claim a message by pushing its not_before
+    forward by the lease, so a worker that dies mid-send only delays the
+    message rather than losing it.
+    '''
+    durable = True
+
+    def __init__(self, lease=60):
+        self.lease = lease
+
+    def put(self, envelope):
+        now = datetime.now(utc)
+        message = OutboundMessage(to_number=envelope.to_number,
+                                  body=envelope.body,
+                                  attempts=0,
+                                  created=now,
+                                  not_before=now)
+        db.session.add(message)
+
+        # Inside a unit of work the message is committed along with whatever
+        # it's a reply to
+        if currentUnit() is None:
+            db.session.commit()
+        else:
+            db.session.flush()
+
+        envelope.id = message.id
+
+    def get(self, timeout):
+        now = datetime.now(utc)
+
+        message = OutboundMessage.query\
+                                 .filter(OutboundMessage.sent_at == None)\
+                                 .filter(OutboundMessage.failed_at == None)\
+                                 .filter(OutboundMessage.not_before <= now)\
+                                 .order_by(OutboundMessage.not_before)\
+                                 .with_for_update(skip_locked=True)\
+                                 .first()
+
+        if message is None:
+            db.session.rollback()
+            time.sleep(timeout)
+            return None
+
+        message.not_before = now + timedelta(seconds=self.lease)
+        envelope = Envelope(message.body,
+                            message.to_number,
+                            id=message.id,
+                            attempts=message.attempts,
+                            enqueued=calendar.timegm(message.created.utctimetuple()))
+        db.session.commit()
+
+        return envelope
+
+    def _update(self, envelope, **values):
+        OutboundMessage.query\
+                       .filter(OutboundMessage.id == envelope.id)\
+                       .update(values, synchronize_session=False)
+        db.session.commit()
+
+    def ack(self, envelope):
+        self._update(envelope,
+                     attempts=envelope.attempts,
+                     sent_at=datetime.now(utc))
+
+    def retry(self, envelope, delay, error):
+        not_before = datetime.now(utc) + timedelta(seconds=delay)
+        self._update(envelope,
+                     attempts=envelope.attempts,
+                     not_before=not_before,
+                     error=str(error))
+
+    def fail(self, envelope, error):
+        self._update(envelope,
+                     attempts=envelope.attempts,
+                     failed_at=datetime.now(utc),
+                     error=str(error))
+
+    def depth(self):
+        depth = OutboundMessage.query\
+                               .filter(OutboundMessage.sent_at == None)\
+                               .filter(OutboundMessage.failed_at == None)\
+                               .count()
+        db.session.rollback()
+        return depth
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'database': DatabaseBackend,
+}
+
+
+def isRetryable(exception):
+    from requests.exceptions import RequestException
+    from twilio.base.exceptions import TwilioRestException
+
+    if isinstance(exception, TwilioRestException):
+        return exception.status == 429 or exception.status >= 500
+
+    return isinstance(exception, RequestException)
+
+
+class Outbox(object):
+    '''
+    Sends SMS replies from a pool of worker threads so that the webhook
+    doesn't wait on Twilio. Set OUTBOX_BACKEND to "sync" to send inline
+    (the default when TESTING), "memory" for an in-process queue or
+    "database" to persist messages in the outbound_message table.
+    '''
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self.threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('OUTBOX_BACKEND', 'sync' if app.testing else 'memory')
+        app.config.setdefault('OUTBOX_WORKERS', 4)
+        app.config.setdefault('OUTBOX_MAX_ATTEMPTS', 5)
+        app.config.setdefault('OUTBOX_BACKOFF', 2.0)
+        app.config.setdefault('OUTBOX_POLL_INTERVAL', 1.0)
+        app.config.setdefault('OUTBOX_DRAIN_TIMEOUT', 10.0)
+
+        self.app = app
+
+        backend = app.config['OUTBOX_BACKEND']
+
+        if backend != 'sync':
+            self.backend = BACKENDS[backend]()
+
+        app.extensions['outbox'] = self
+
+    def put(self, body, to_number):
+        if self.backend is not None and self.backend.durable:
+            self._enqueue(body, to_number)
+        else:
+            # Nothing goes out until whatever it's a reply to is committed
+            afterCommit(self._enqueue, body, to_number)
+
+    def _enqueue(self, body, to_number):
+        if self.backend is None:
+            sendTwilioResponse(body, to_number)
+            return
+
+        self.start()
+
+        envelope = Envelope(body, to_number)
+
+        # Only a message that's sent from this process can finish the trace
+        # of the request it's a reply to
+        if not self.backend.durable:
+            envelope.trace = profiler.hold()
+
+        self.backend.put(envelope)
+        stats.incr('outbox.enqueued')
+
+    def start(self):
+        # Threads don't survive a fork, so a gunicorn worker that inherited
+        # this object from a preloaded master needs its own pool.
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._stopping.clear()
+            self.threads = []
+
+            for index in range(self.app.config['OUTBOX_WORKERS']):
+                thread = threading.Thread(target=self._work,
+                                          name='outbox-{}'.format(index))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+            self._pid = os.getpid()
+
+            atexit.register(self.drain)
+
+    def drain(self, timeout=None):
+        '''
+        Stop the workers, giving them up to OUTBOX_DRAIN_TIMEOUT seconds to
+        empty an in-memory queue first. Durable backends only finish the
+        message they're currently sending; the rest stay in the table.
+        '''
+        if self._pid != os.getpid():
+            return
+
+        if timeout is None:
+            timeout = self.app.config['OUTBOX_DRAIN_TIMEOUT']
+
+        self._stopping.set()
+
+        deadline = time.time() + timeout
+
+        for thread in self.threads:
+            thread.join(max(deadline - time.time(), 0))
+
+        if not self.backend.durable and self.backend.depth():
+            logger.warning('Outbox shut down with %s unsent messages',
+                           self.backend.depth())
+
+        self._pid = None
+
+    def depth(self):
+        if self.backend is None:
+            return 0
+
+        return self.backend.depth()
+
+    def _work(self):
+        poll_interval = self.app.config['OUTBOX_POLL_INTERVAL']
+
+        with self.app.app_context():
+            while True:
+                if self._stopping.is_set():
+                    if self.backend.durable or not self.backend.depth():
+                        break
+
+                try:
+                    envelope = self.backend.get(poll_interval)
+
+                    if envelope is not None:
+                        self._deliver(envelope)
+                except Exception:
+                    logger.exception('Outbox worker error')
+                    time.sleep(poll_interval)
+                finally:
+                    db.session.remove()
+
+    def _deliver(self, envelope):
+        envelope.attempts += 1
+        started = time.time()
+
+        # Retries don't hold the request's trace up any longer
+        trace, envelope.trace = envelope.trace, None
+
+        try:
+            with profiler.resume(trace):
+                sendTwilioResponse(envelope.body, envelope.to_number)
+        except Exception as e:
+            stats.observe('outbox.send_time', time.time() - started)
+
+            max_attempts = self.app.config['OUTBOX_MAX_ATTEMPTS']
+
+            if isRetryable(e) and envelope.attempts < max_attempts:
+                delay = self.app.config['OUTBOX_BACKOFF'] * 2 ** (envelope.attempts - 1)
+                self.backend.retry(envelope, delay, e)
+                stats.incr('outbox.retried')
+            else:
+                logger.error('Giving up on %r: %s', envelope, e)
+                self.backend.fail(envelope, e)
+                stats.incr('outbox.failed')
+
+            return
+
+        finished = time.time()
+
+        self.backend.ack(envelope)
+
+        stats.observe('outbox.send_time', finished - started)
+        stats.observe('outbox.latency', finished - envelope.enqueued)
+        stats.incr('outbox.sent')
+
+
+outbox = Outbox()
+
+
+def queueResponse(message, to_number):
+    outbox.put(message, to_number)
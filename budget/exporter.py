@@ -0,0 +1,99 @@
+import csv
+import io
+import json
+
+from sqlalchemy import and_, or_
+
+from .database import db
+from .models import IOU
+from .money import centsToDecimal
+
+
+COLUMNS = ['id', 'ower_id', 'owee_id', 'amount', 'reason', 'date_added', 'pending']
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def ledgerQuery(phone_number=None, counterpart=None, start=None, end=None,
+                batch_size=1000):
+    '''
+    IOUs involving phone_number (or everybody's), optionally only those with
+    counterpart and only those added on or after start and before end, in
+    the order they were added. The query reads plain rows through a server
+    side cursor batch_size at a time rather than building IOU objects for
+    the whole ledger.
+    '''
+    columns = [getattr(IOU, column) for column in COLUMNS]
+    query = db.session.query(*columns)
+
+    if phone_number and counterpart:
+        query = query.filter(or_(and_(IOU.ower_id == phone_number,
+                                      IOU.owee_id == counterpart),
+                                 and_(IOU.ower_id == counterpart,
+                                      IOU.owee_id == phone_number)))
+    elif phone_number:
+        query = query.filter(or_(IOU.ower_id == phone_number,
+                                 IOU.owee_id == phone_number))
+
+    if start:
+        query = query.filter(IOU.date_added >= start)
+
+    if end:
+        query = query.filter(IOU.date_added < end)
+
+    return query.order_by(IOU.date_added)\
+                .execution_options(stream_results=True)\
+                .yield_per(batch_size)
+
+
+def exportValue(value):
+    if value is None:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, (bool, int, float)):
+        return value
+    return str(value)
+
+
+def exportRow(row):
+    values = [exportValue(value) for value in row]
+    amount = COLUMNS.index('amount')
+
+    # Exact dollars and cents, the same way the importer reads them
+    if row[amount] is not None:
+        values[amount] = centsToDecimal(row[amount])
+
+    return values
+
+
+def exportLedger(query, format='csv'):
+    '''
+    Yield the rows from ledgerQuery one line at a time. CSV output has a
+    "type" column so that it can be fed straight back to importLedger.
+    '''
+    if format == 'ndjson':
+        for row in query:
+            record = {'type': 'iou'}
+            record.update(zip(COLUMNS, exportRow(row)))
+            yield json.dumps(record) + '\n'
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(['type'] + COLUMNS)
+
+    for row in query:
+        writer.writerow(['iou'] + exportRow(row))
+
+        yield buffer.getvalue()
+
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,390 @@
+import csv
+import io
+import json
+import time
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, Text, text
+
+from .cache import sender_cache
+from .database import db
+from .models import IOU, get_uuid
+from .money import parseCents
+from .utils import normalizePhoneNumber, TIMEZONE
+
+
+staging = MetaData()
+
+import_person = Table('import_person', staging,
+                      Column('phone_number', String(15)),
+                      Column('name', String),
+                      Column('admin', Integer),
+                      prefixes=['TEMPORARY'])
+
+import_alias = Table('import_alias', staging,
+                     Column('from_phone', String(15)),
+                     Column('to_phone', String(15)),
+                     Column('alias', String),
+                     prefixes=['TEMPORARY'])
+
+import_iou = Table('import_iou', staging,
+                   Column('id', IOU.__table__.c.id.type),
+                   Column('ower_id', String(15)),
+                   Column('owee_id', String(15)),
+                   Column('amount', IOU.__table__.c.amount.type),
+                   Column('date_added', IOU.__table__.c.date_added.type),
+                   Column('pending', IOU.__table__.c.pending.type),
+                   Column('reason', Text),
+                   # Where it was in the input, to keep the first of any
+                   # that share an id
+                   Column('line', Integer),
+                   prefixes=['TEMPORARY'])
+
+DATE_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']
+
+TRUE = ('1', 't', 'true', 'y', 'yes')
+
+
+def optional(record, field):
+    '''
+    A field as a string, whatever type it came in as (JSON lines can hold
+    numbers), or '' if it's missing.
+    '''
+    value = record.get(field)
+
+    if value is None:
+        return ''
+
+    return str(value).strip()
+
+
+def required(record, field):
+    value = optional(record, field)
+
+    if not value:
+        raise ValueError('"{}" is required'.format(field))
+
+    return value
+
+
+def phone(record, field):
+    value = required(record, field)
+
+    try:
+        return normalizePhoneNumber(value)
+    except ValueError:
+        raise ValueError('"{}" is not a valid phone number'.format(value))
+
+
+def flag(record, field, default):
+    value = record.get(field)
+
+    if value in (None, ''):
+        return default
+
+    return str(value).strip().lower() in TRUE
+
+
+def parseDate(value):
+    if not value:
+        return TIMEZONE.localize(datetime.now())
+
+    for fmt in DATE_FORMATS:
+        try:
+            return TIMEZONE.localize(datetime.strptime(str(value).strip(), fmt))
+        except ValueError:
+            pass
+
+    raise ValueError('"{}" is not a date'.format(value))
+
+
+def cleanPerson(record):
+    return {
+        'phone_number': phone(record, 'phone_number'),
+        'name': required(record, 'name'),
+        'admin': 1 if flag(record, 'admin', False) else 0,
+    }
+
+
+def cleanAlias(record):
+    return {
+        'from_phone': phone(record, 'from_phone'),
+        'to_phone': phone(record, 'to_phone'),
+        'alias': required(record, 'alias').lower(),
+    }
+
+
+def cleanIOU(record):
+    amount = parseCents(required(record, 'amount'))
+
+    return {
+        'id': optional(record, 'id') or get_uuid(),
+        'ower_id': phone(record, 'ower_id'),
+        'owee_id': phone(record, 'owee_id'),
+        'amount': amount,
+        'date_added': parseDate(record.get('date_added')),
+        'pending': flag(record, 'pending', True),
+        'reason': optional(record, 'reason') or 'General',
+    }
+
+
+RECORD_TYPES = {
+    'person': (import_person, cleanPerson),
+    'alias': (import_alias, cleanAlias),
+    'iou': (import_iou, cleanIOU),
+}
+
+
+def readRecords(stream, format):
+    '''
+    Yields each record as a dict, or a ValueError for a line that isn't
+    one, so that importLedger can reject it like any other bad record.
+    '''
+    if format == 'jsonl':
+        for line in stream:
+            line = line.strip()
+
+            if not line:
+                continue
+
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield ValueError('Not JSON: {}'.format(e))
+                continue
+
+            if isinstance(record, dict):
+                yield record
+            else:
+                yield ValueError('Not a JSON object: {}'.format(line))
+    else:
+        for record in csv.DictReader(stream):
+            yield record
+
+
+def csvValue(value):
+    if value is None:
+        return ''
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class StagingLoader(object):
+    '''
+    Buffers cleaned rows and writes them to the staging tables a batch at a
+    time, with COPY on PostgreSQL and executemany everywhere else.
+    '''
+    def __init__(self, connection, batch_size):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.buffers = {table.name: [] for table in staging.sorted_tables}
+        self.copy = connection.dialect.name == 'postgresql'
+
+    def add(self, table, row):
+        buffer = self.buffers[table.name]
+        buffer.append(row)
+
+        if len(buffer) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table):
+        rows = self.buffers[table.name]
+
+        if not rows:
+            return
+
+        if self.copy:
+            self.copyRows(table, rows)
+        else:
+            self.connection.execute(table.insert(), rows)
+
+        del rows[:]
+
+    def flushAll(self):
+        for table in staging.sorted_tables:
+            self.flush(table)
+
+    def copyRows(self, table, rows):
+        columns = [column.name for column in table.columns]
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        for row in rows:
+            writer.writerow([csvValue(row[column]) for column in columns])
+
+        buffer.seek(0)
+
+        cursor = self.connection.connection.cursor()
+        cursor.copy_expert('COPY {0} ({1}) FROM STDIN WITH CSV'.format(table.name,
+                                                                       ', '.join(columns)),
+                           buffer)
+
+
+# "WHERE true" keeps SQLite from reading ON CONFLICT as part of the SELECT
+MERGE_PEOPLE = '''
+    INSERT INTO person (phone_number, name, admin)
+    SELECT phone_number, MIN(name), MAX(admin) = 1
+    FROM import_person
+    WHERE true
+    GROUP BY phone_number
+    ON CONFLICT (phone_number) DO NOTHING
+'''
+
+REJECT_ALIASES = '''
+    DELETE FROM import_alias
+    WHERE NOT EXISTS (SELECT 1 FROM person WHERE phone_number = import_alias.from_phone)
+       OR NOT EXISTS (SELECT 1 FROM person WHERE phone_number = import_alias.to_phone)
+'''
+
+MERGE_ALIASES = '''
+    INSERT INTO person_to_person (from_phone, to_phone, alias)
+    SELECT from_phone, MIN(to_phone), alias
+    FROM import_alias
+    WHERE true
+    GROUP BY from_phone, alias
+    ON CONFLICT (from_phone, alias) DO NOTHING
+'''
+
+REJECT_IOUS = '''
+    DELETE FROM import_iou
+    WHERE NOT EXISTS (SELECT 1 FROM person WHERE phone_number = import_iou.ower_id)
+       OR NOT EXISTS (SELECT 1 FROM person WHERE phone_number = import_iou.owee_id)
+'''
+
+SKIP_DUPLICATE_IOUS = '''
+    DELETE FROM import_iou
+    WHERE line NOT IN (SELECT MIN(line) FROM import_iou GROUP BY id)
+'''
+
+SKIP_EXISTING_IOUS = '''
+    DELETE FROM import_iou
+    WHERE EXISTS (SELECT 1 FROM iou WHERE iou.id = import_iou.id)
+'''
+
+MERGE_IOUS = '''
+    INSERT INTO iou (id, ower_id, owee_id, amount, date_added, pending, reason)
+    SELECT id, ower_id, owee_id, amount, date_added, pending, reason
+    FROM import_iou
+'''
+
+MERGE_PAIR_BALANCES = '''
+    INSERT INTO pair_balance (low_phone, high_phone, amount, iou_count, last_updated)
+    SELECT
+      CASE WHEN ower_id < owee_id THEN ower_id ELSE owee_id END,
+      CASE WHEN ower_id < owee_id THEN owee_id ELSE ower_id END,
+      SUM(CASE WHEN ower_id < owee_id THEN amount ELSE -amount END),
+      COUNT(*),
+      MAX(date_added)
+    FROM import_iou
+    WHERE true
+    GROUP BY 1, 2
+    ON CONFLICT (low_phone, high_phone) DO UPDATE SET
+      amount = pair_balance.amount + excluded.amount,
+      iou_count = pair_balance.iou_count + excluded.iou_count,
+      last_updated = CASE
+        WHEN pair_balance.last_updated IS NULL
+          OR excluded.last_updated > pair_balance.last_updated
+        THEN excluded.last_updated
+        ELSE pair_balance.last_updated
+      END
+'''
+
+
+class ImportResult(object):
+    def __init__(self):
+        self.read = 0
+        self.rejected = 0
+        self.skipped = 0
+        self.people = 0
+        self.aliases = 0
+        self.ious = 0
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        return self.read / max(self.elapsed, 1e-6)
+
+
+def importLedger(stream, format='csv', batch_size=10000, on_error=None, on_batch=None):
+    '''
+    Load people, aliases and IOUs from a CSV or JSON lines stream. Each
+    record has a "type" of person (phone_number, name, admin), alias
+    (from_phone, alias, to_phone) or iou (ower_id, owee_id, amount, reason,
+    date_added, pending and optionally id).
+
+    Rows are cleaned one at a time and streamed into temporary staging
+    tables, then merged with a handful of set-based statements, so memory
+    use doesn't depend on the size of the input. Everything happens in one
+    transaction. People and aliases that already exist are left alone, and
+    IOUs whose id is already in the ledger are skipped, so re-running an
+    import that supplies ids is safe. Of several IOUs with the same id, only
+    the first is imported.
+    '''
+    result = ImportResult()
+    connection = db.session.connection()
+
+    for table in staging.sorted_tables:
+        table.create(connection)
+
+    loader = StagingLoader(connection, batch_size)
+
+    for record in readRecords(stream, format):
+        result.read += 1
+
+        try:
+            if isinstance(record, ValueError):
+                raise record
+
+            try:
+                table, clean = RECORD_TYPES[optional(record, 'type').lower()]
+            except KeyError:
+                raise ValueError('Unknown record type "{}"'.format(record.get('type')))
+
+            row = clean(record)
+
+            if table is import_iou:
+                row['line'] = result.read
+
+            loader.add(table, row)
+        except ValueError as e:
+            result.rejected += 1
+
+            if on_error:
+                on_error(result.read, e)
+
+        if on_batch and result.read % batch_size == 0:
+            on_batch(result)
+
+    loader.flushAll()
+
+    result.people = connection.execute(text(MERGE_PEOPLE)).rowcount
+
+    result.rejected += connection.execute(text(REJECT_ALIASES)).rowcount
+    result.aliases = connection.execute(text(MERGE_ALIASES)).rowcount
+
+    result.skipped = connection.execute(text(SKIP_DUPLICATE_IOUS)).rowcount
+    result.rejected += connection.execute(text(REJECT_IOUS)).rowcount
+    result.skipped += connection.execute(text(SKIP_EXISTING_IOUS)).rowcount
+    result.ious = connection.execute(text(MERGE_IOUS)).rowcount
+    connection.execute(text(MERGE_PAIR_BALANCES))
+
+    for table in reversed(staging.sorted_tables):
+        table.drop(connection)
+
+    db.session.commit()
+    sender_cache.clear()
+
+    result.finished = time.time()
+
+    return result
@@ -0,0 +1,240 @@
+import atexit
+import json
+import os
+import re
+import tempfile
+import time
+
+from .database import db
+from .dispatch import outbox
+from .stats import stats
+
+
+def liveProcess(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def splitName(name):
+    '''
+    'incoming.seconds{command="inquiry"}' -> ('budget_incoming_seconds', 'command="inquiry"')
+    '''
+    base, _, labels = name.partition('{')
+    return 'budget_' + re.sub(r'[^a-zA-Z0-9_]', '_', base), labels.rstrip('}')
+
+
+def labelled(name, labels, *extra):
+    labels = ','.join(label for label in (labels,) + extra if label)
+    return '{0}{{{1}}}'.format(name, labels) if labels else name
+
+
+def mergeSnapshots(snapshots):
+    merged = {'counters': {}, 'timers': {}, 'histograms': {}, 'gauges': {}}
+
+    for snapshot in snapshots:
+        for name, value in snapshot['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + value
+
+        for name, (count, total, maximum) in snapshot['timers'].items():
+            have = merged['timers'].get(name, (0, 0.0, 0.0))
+            merged['timers'][name] = (have[0] + count, have[1] + total, max(have[2], maximum))
+
+        for name, counts in snapshot['histograms'].items():
+            have = merged['histograms'].get(name, [0] * len(counts))
+            merged['histograms'][name] = [a + b for a, b in zip(have, counts)]
+
+        for name, value in snapshot.get('gauges', {}).items():
+            merged['gauges'][name] = merged['gauges'].get(name, 0) + value
+
+    return merged
+
+
+def formatMetrics(snapshot, buckets):
+    '''
+    Render a snapshot in the Prometheus text exposition format. Counters
+    get a _total suffix, timers become histograms along with a _max gauge.
+    '''
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+
+    for name, value in sorted(snapshot['counters'].items()):
+        base, labels = splitName(name)
+        declare(base + '_total', 'counter')
+        lines.append('{0} {1}'.format(labelled(base + '_total', labels), value))
+
+    for name, (count, total, maximum) in sorted(snapshot['timers'].items()):
+        base, labels = splitName(name)
+        counts = snapshot['histograms'].get(name, [0] * len(buckets))
+
+        declare(base, 'histogram')
+
+        cumulative = 0
+
+        for bound, bucket in zip(buckets, counts):
+            cumulative += bucket
+            lines.append('{0} {1}'.format(labelled(base + '_bucket', labels,
+                                                   'le="{}"'.format(bound)),
+                                          cumulative))
+
+        lines.append('{0} {1}'.format(labelled(base + '_bucket', labels, 'le="+Inf"'), count))
+        lines.append('{0} {1!r}'.format(labelled(base + '_sum', labels), total))
+        lines.append('{0} {1}'.format(labelled(base + '_count', labels), count))
+
+    for name, (count, total, maximum) in sorted(snapshot['timers'].items()):
+        base, labels = splitName(name)
+        declare(base + '_max', 'gauge')
+        lines.append('{0} {1!r}'.format(labelled(base + '_max', labels), maximum))
+
+    for name, value in sorted(snapshot['gauges'].items()):
+        base, labels = splitName(name)
+        declare(base, 'gauge')
+        lines.append('{0} {1}'.format(labelled(base, labels), value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def collectGauges():
+    '''
+    This worker's gauges, cheap enough to read on every flush.
+    '''
+    gauges = {}
+
+    if outbox.backend is not None and not outbox.backend.durable:
+        gauges['outbox.depth'] = outbox.depth()
+
+    pool = db.engine.pool
+
+    # Only QueuePool keeps track of these
+    if hasattr(pool, 'checkedout'):
+        gauges['db.pool.size'] = pool.size()
+        gauges['db.pool.checked_out'] = pool.checkedout()
+        gauges['db.pool.overflow'] = max(pool.overflow(), 0)
+
+    return gauges
+
+
+def scrapeGauges():
+    '''
+    Gauges that come out the same whichever worker reads them, so they're
+    read once per scrape rather than by every worker as it flushes. The
+    database outbox's depth is a count of outbound_message.
+    '''
+    if outbox.backend is not None and outbox.backend.durable:
+        return {'outbox.depth': outbox.depth()}
+
+    return {}
+
+
+class Metrics(object):
+    '''
+    Serves stats in the Prometheus text format at /metrics. Every gunicorn
+    worker has its own stats, so with METRICS_DIR set each worker writes a
+    snapshot to METRICS_DIR/<pid>.json at most every METRICS_FLUSH_INTERVAL
+    seconds (and when it exits), and whichever worker gets the scrape adds
+    them all up. Counters from workers that have exited are kept so totals
+    never go backwards; their gauges are dropped.
+    '''
+    def __init__(self, app=None):
+        self.app = None
+        self.directory = None
+        self.interval = 5.0
+        self.flushed = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 5.0)
+
+        self.app = app
+        self.directory = app.config['METRICS_DIR']
+        self.interval = app.config['METRICS_FLUSH_INTERVAL']
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            app.after_request(self._afterRequest)
+            atexit.register(self.flush)
+
+        app.extensions['metrics'] = self
+
+    def snapshot(self):
+        counters, timers, histograms = stats.snapshot()
+
+        with self.app.app_context():
+            gauges = collectGauges()
+
+        return {
+            'pid': os.getpid(),
+            'counters': counters,
+            'timers': timers,
+            'histograms': histograms,
+            'gauges': gauges,
+        }
+
+    def flush(self, snapshot=None):
+        if not self.directory:
+            return
+
+        snapshot = snapshot or self.snapshot()
+        path = os.path.join(self.directory, '{}.json'.format(snapshot['pid']))
+
+        # Write and rename so that a scrape never reads half a file
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+
+        os.replace(temp, path)
+        self.flushed = time.time()
+
+    def render(self):
+        snapshot = self.snapshot()
+        snapshots = [snapshot]
+
+        if self.directory:
+            self.flush(snapshot)
+
+            for filename in os.listdir(self.directory):
+                pid, ext = os.path.splitext(filename)
+
+                if ext != '.json' or not pid.isdigit() or int(pid) == snapshot['pid']:
+                    continue
+
+                try:
+                    with open(os.path.join(self.directory, filename)) as f:
+                        other = json.load(f)
+                except (OSError, ValueError):
+                    continue
+
+                if not liveProcess(int(pid)):
+                    other['gauges'] = {}
+
+                snapshots.append(other)
+
+        merged = mergeSnapshots(snapshots)
+
+        with self.app.app_context():
+            merged['gauges'].update(scrapeGauges())
+
+        return formatMetrics(merged, stats.buckets)
+
+    def _afterRequest(self, response):
+        if time.time() - self.flushed > self.interval:
+            self.flush()
+
+        return response
+
+
+metrics = Metrics()
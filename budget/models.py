@@ -1,15 +1,68 @@
-from uuid import uuid4
+import os
+import threading
+import time
+from uuid import UUID as PythonUUID
 
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, text
 
 from .database import db
+from .types import UUID, DateTimeTZ
+from .money import formatCents
+
+_uuid_lock = threading.Lock()
+_uuid_last = [0, 0]
+
+
+def uuid7():
+    '''
+    A version 7 UUID: the Unix time in milliseconds followed by random bits,
+    so new rows land at the end of the primary key's index instead of on a
+    random page of it. The 12 bits after the version count up within a
+    millisecond, which keeps ids from one process in the order they were
+    made. Older rows keep their random (version 4) ids.
+    '''
+    with _uuid_lock:
+        millis = max(int(time.time() * 1000), _uuid_last[0])
+
+        if millis == _uuid_last[0]:
+            counter = _uuid_last[1] + 1
+
+            if counter > 0xfff:
+                millis += 1
+                counter = int.from_bytes(os.urandom(2), 'big') & 0x7ff
+        else:
+            counter = int.from_bytes(os.urandom(2), 'big') & 0x7ff
+
+        _uuid_last[:] = [millis, counter]
+
+    random_bits = int.from_bytes(os.urandom(8), 'big') & (2 ** 62 - 1)
+
+    return PythonUUID(int=(millis << 80) | (0x7 << 76) | (counter << 64) | (0b10 << 62) | random_bits)
+
 
 def get_uuid():
-    return str(uuid4())
+    return str(uuid7())
 
 class IOU(db.Model):
+    # On PostgreSQL 11 and later the migrations partition iou by month of
+    # date_added (see budget/partitions.py). The primary key there is
+    # (id, date_added), since a partitioned table's has to include the
+    # partition key, but id is still unique on its own.
     __tablename__ = 'iou'
+    __table_args__ = (
+        db.Index('ix_iou_ower_id_owee_id_date_added_amount',
+                 'ower_id', 'owee_id', 'date_added', 'amount'),
+        db.Index('ix_iou_ower_id_date_added', 'ower_id', 'date_added'),
+        db.Index('ix_iou_owee_id_date_added', 'owee_id', 'date_added'),
+        db.Index('ix_iou_date_added', 'date_added'),
+        db.Index('ix_iou_uncompacted', 'date_added', 'id',
+                 postgresql_where=text('compacted_at IS NULL'),
+                 sqlite_where=text('compacted_at IS NULL')),
+        # For the part of a pair's total that isn't in its checkpoint yet
+        db.Index('ix_iou_uncompacted_pair', 'ower_id', 'owee_id', 'amount',
+                 postgresql_where=text('compacted_at IS NULL'),
+                 sqlite_where=text('compacted_at IS NULL')),
+    )
     id = db.Column(UUID, primary_key=True, default=get_uuid)
     ower_id = db.Column(db.String(15), db.ForeignKey('person.phone_number'), nullable=False)
     owee_id = db.Column(db.String(15), db.ForeignKey('person.phone_number'), nullable=False)
@@ -22,13 +75,17 @@ class IOU(db.Model):
                            backref='uoms',
                            primaryjoin="Person.phone_number == IOU.owee_id")
 
-    amount = db.Column(db.Float)
-    date_added = db.Column(db.DateTime(timezone=True))
+    # In cents
+    amount = db.Column(db.BigInteger)
+    date_added = db.Column(DateTimeTZ)
     pending = db.Column(db.Boolean, default=True)
     reason = db.Column(db.Text)
 
+    # When the IOU was folded into its pair's BalanceCheckpoint
+    compacted_at = db.Column(DateTimeTZ)
+
     def __repr__(self):
-        return '<IOU %r owes %r $%r>' % (self.ower, self.owee, self.amount)
+        return '<IOU %r owes %r %s>' % (self.ower, self.owee, formatCents(self.amount))
 
 
 person_to_person = db.Table('person_to_person',
@@ -53,3 +110,123 @@ class Person(db.Model):
 
     def __repr__(self):
         return '<Person %r (%r)>' % (self.name, self.phone_number, )
+
+
+class OutboundMessage(db.Model):
+    __tablename__ = 'outbound_message'
+    id = db.Column(UUID, primary_key=True, default=get_uuid)
+    to_number = db.Column(db.String(15), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    created = db.Column(DateTimeTZ, nullable=False)
+    not_before = db.Column(DateTimeTZ, nullable=False, index=True)
+    sent_at = db.Column(DateTimeTZ)
+    failed_at = db.Column(DateTimeTZ)
+    error = db.Column(db.Text)
+
+    def __repr__(self):
+        return '<OutboundMessage to %r (%r attempts)>' % (self.to_number, self.attempts)
+
+
+class PairBalance(db.Model):
+    '''
+    Running total of the IOUs between two people. The pair is stored with
+    the lower phone number first and amount is what low_phone owes
+    high_phone in cents, so a negative amount means it goes the other way.
+    '''
+    __tablename__ = 'pair_balance'
+    low_phone = db.Column(db.String(15), db.ForeignKey('person.phone_number'), primary_key=True)
+    high_phone = db.Column(db.String(15), db.ForeignKey('person.phone_number'), primary_key=True)
+    amount = db.Column(db.BigInteger, default=0, nullable=False)
+    iou_count = db.Column(db.Integer, default=0, nullable=False)
+    last_updated = db.Column(DateTimeTZ)
+
+    def __repr__(self):
+        return '<PairBalance %r owes %r %s>' % (self.low_phone, self.high_phone, formatCents(self.amount))
+
+
+class BalanceCheckpoint(db.Model):
+    '''
+    The IOUs between two people that the compaction job has folded in so
+    far, summed the same way as PairBalance. A pair's balance is its
+    checkpoint plus the IOUs that haven't been compacted yet. through_date
+    and through_id are the last IOU folded in.
+    '''
+    __tablename__ = 'balance_checkpoint'
+    low_phone = db.Column(db.String(15), db.ForeignKey('person.phone_number'), primary_key=True)
+    high_phone = db.Column(db.String(15), db.ForeignKey('person.phone_number'), primary_key=True)
+    amount = db.Column(db.BigInteger, default=0, nullable=False)
+    iou_count = db.Column(db.Integer, default=0, nullable=False)
+    through_date = db.Column(DateTimeTZ)
+    through_id = db.Column(UUID)
+    updated = db.Column(DateTimeTZ, nullable=False)
+
+    def __repr__(self):
+        return '<BalanceCheckpoint %r owes %r %s>' % (self.low_phone, self.high_phone, formatCents(self.amount))
+
+
+class IOUArchive(db.Model):
+    '''
+    A month of iou that has been detached from the table and written out
+    to path. archived_at is set once the file is written and the partition
+    dropped, so an archive that was interrupted can be finished.
+    '''
+    __tablename__ = 'iou_archive'
+    partition = db.Column(db.String(32), primary_key=True)
+    start = db.Column(DateTimeTZ, nullable=False)
+    end = db.Column(DateTimeTZ, nullable=False)
+    iou_count = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.Text)
+    detached_at = db.Column(DateTimeTZ, nullable=False)
+    archived_at = db.Column(DateTimeTZ)
+
+    def __repr__(self):
+        return '<IOUArchive %r (%r IOUs)>' % (self.partition, self.iou_count)
+
+
+class ArchivedBalance(db.Model):
+    '''
+    What an archived month of IOUs added up to for each pair, summed the
+    same way as PairBalance, so that balances can still be recomputed from
+    the ledger once those IOUs are gone from iou.
+    '''
+    __tablename__ = 'archived_balance'
+    partition = db.Column(db.String(32), db.ForeignKey('iou_archive.partition'), primary_key=True)
+    low_phone = db.Column(db.String(15), db.ForeignKey('person.phone_number'), primary_key=True)
+    high_phone = db.Column(db.String(15), db.ForeignKey('person.phone_number'), primary_key=True)
+    amount = db.Column(db.BigInteger, nullable=False)
+    iou_count = db.Column(db.Integer, nullable=False)
+    last_updated = db.Column(DateTimeTZ)
+
+    def __repr__(self):
+        return '<ArchivedBalance %r: %r owes %r %s>' % (self.partition, self.low_phone,
+                                                         self.high_phone, formatCents(self.amount))
+
+
+class ProcessedMessage(db.Model):
+    '''
+    Twilio MessageSids that have already been handled, along with the reply
+    we sent, so a webhook that Twilio retries doesn't run twice.
+    '''
+    __tablename__ = 'processed_message'
+    message_sid = db.Column(db.String(64), primary_key=True)
+    response = db.Column(db.Text)
+    created = db.Column(DateTimeTZ, nullable=False, index=True)
+
+    def __repr__(self):
+        return '<ProcessedMessage %r>' % self.message_sid
+
+
+class RateLimitBucket(db.Model):
+    '''
+    Token bucket per phone number, shared between workers when
+    RATE_LIMIT_BACKEND is "database". Times are seconds since the epoch.
+    '''
+    __tablename__ = 'rate_limit_bucket'
+    phone_number = db.Column(db.String(15), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated = db.Column(db.Float, nullable=False)
+    notified = db.Column(db.Float)
+
+    def __repr__(self):
+        return '<RateLimitBucket %r (%r tokens)>' % (self.phone_number, self.tokens)
@@ -0,0 +1,52 @@
+from decimal import Decimal, InvalidOperation
+
+
+# Amounts and balances are BIGINT cents. Keeping each amount well under the
+# limit leaves room to add plenty of them up.
+MAX_CENTS = 10 ** 15
+
+
+def parseCents(amount):
+    '''
+    Turn "$20", "20" or "20.50" into a whole number of cents, raising
+    ValueError for anything that isn't an exact, positive amount of money.
+    '''
+    text = str(amount).strip().replace('$', '').replace(',', '')
+
+    try:
+        value = Decimal(text)
+    except InvalidOperation:
+        raise ValueError('Amount "{}" should be a number'.format(text))
+
+    if not value.is_finite():
+        raise ValueError('Amount "{}" should be a number'.format(text))
+
+    cents = value * 100
+
+    if cents != cents.to_integral_value():
+        raise ValueError('Amount "{}" has fractions of a cent'.format(text))
+
+    if cents <= 0:
+        raise ValueError('Amount "{}" should be more than zero'.format(text))
+
+    if cents > MAX_CENTS:
+        raise ValueError('Amount "{}" is too big'.format(text))
+
+    return int(cents)
+
+
+def formatCents(cents):
+    '''
+    "$100" for whole dollars, "$100.50" otherwise.
+    '''
+    sign = '-' if cents < 0 else ''
+    dollars, cents = divmod(abs(cents), 100)
+
+    if cents:
+        return '{0}${1}.{2:02d}'.format(sign, dollars, cents)
+
+    return '{0}${1}'.format(sign, dollars)
+
+
+def centsToDecimal(cents):
+    return '{0}{1}.{2:02d}'.format('-' if cents < 0 else '', *divmod(abs(cents), 100))
@@ -0,0 +1,123 @@
+import re
+from collections import namedtuple
+
+from .money import parseCents
+
+
+class ParseError(Exception):
+    pass
+
+
+Verb = namedtuple('Verb', ['name', 'detect', 'grammar', 'build', 'usage', 'example'])
+
+AddPerson = namedtuple('AddPerson', ['name', 'number'])
+AddIOU = namedtuple('AddIOU', ['ower', 'owee', 'amount', 'reason'])
+Inquiry = namedtuple('Inquiry', ['ower', 'owee'])
+SettleUp = namedtuple('SettleUp', [])
+
+VERBS = []
+
+SEPARATORS = re.compile(r'[;\n]+')
+
+
+def verb(name, detect, grammar, usage, example):
+    '''
+    Register a command. A message that matches the detect pattern belongs
+    to this verb and has to match the grammar, otherwise the sender gets
+    the usage back. Verbs are tried in the order they were registered.
+    '''
+    def register(build):
+        VERBS.append(Verb(name,
+                          re.compile(detect, re.IGNORECASE),
+                          re.compile(grammar, re.IGNORECASE),
+                          build,
+                          usage,
+                          example))
+        return build
+    return register
+
+
+def parseCommand(message):
+    message = message.strip()
+
+    for command in VERBS:
+        if command.detect.search(message):
+            match = command.grammar.match(message)
+
+            if match is None:
+                raise ParseError(command.usage)
+
+            return command.build(match)
+
+    raise ParseError("Sorry, I don't understand that. Try something like {}".format(
+        ' or '.join('"{}"'.format(command.example) for command in VERBS)))
+
+
+def parseCommands(message):
+    '''
+    Parse a message holding one or more commands, one per line or separated
+    by semicolons. Errors in a message with several commands say which one
+    was wrong.
+    '''
+    lines = [line.strip() for line in SEPARATORS.split(message)]
+    lines = [line for line in lines if line]
+
+    if len(lines) <= 1:
+        return [parseCommand(message)]
+
+    commands = []
+
+    for line in lines:
+        try:
+            commands.append(parseCommand(line))
+        except ParseError as e:
+            raise ParseError('"{0}": {1}'.format(line, e))
+
+    return commands
+
+
+@verb('inquiry',
+      detect=r'^how much\b',
+      grammar=r'^how much\s+(?:\S+\s+)?(?P<ower>\S+)\s+owes?\s+(?P<owee>[^\s?]+)\s*\??$',
+      usage='Balance inquiry should look like '
+            '"How much does <person 1 name> owe <person 2 name>?"',
+      example='How much do I owe Kristi?')
+def inquiry(match):
+    return Inquiry(match.group('ower').lower(), match.group('owee').lower())
+
+
+@verb('settle',
+      detect=r'^settle\b',
+      grammar=r'^settle(?:\s+up)?\W*$',
+      usage='Settle up message should look like: "Settle up"',
+      example='Settle up')
+def settle(match):
+    return SettleUp()
+
+
+@verb('add person',
+      detect=r'^add\b',
+      grammar=r'^add\s+(?P<name>\S+)\s+(?P<number>\S.*)$',
+      usage='"Add person" message should look like: "Add <name> <phone number>"',
+      example='Add Kristi 3125555555')
+def addPerson(match):
+    return AddPerson(match.group('name'), match.group('number'))
+
+
+@verb('iou',
+      detect=r'owe',
+      grammar=r'^(?P<ower>\S.*?)\s+owes?\s+(?P<owee>\S.*?)\s+\$?(?P<amount>\S+?)'
+              r'(?:\s+for\s+(?P<reason>\S.*))?$',
+      usage='IOU message should look like: '
+            '"<name> owes <name> <amount> for <reason>"',
+      example='I owe Kristi $20 for lunch')
+def addIOU(match):
+    try:
+        amount = parseCents(match.group('amount'))
+    except ValueError as e:
+        raise ParseError(str(e))
+
+    return AddIOU(match.group('ower').lower(),
+                  match.group('owee').lower(),
+                  amount,
+                  match.group('reason') or 'General')
@@ -0,0 +1,229 @@
+import gzip
+import os
+import re
+from datetime import datetime
+
+from pytz import utc
+from sqlalchemy import text
+
+from .balances import computePairBalances
+from .database import db
+from .models import IOU, ArchivedBalance, IOUArchive
+from .stats import stats
+from .utils import TIMEZONE
+
+
+# Declarative partitioning only grew primary keys and indexes in 11
+PARTITIONING_VERSION = (11,)
+
+PARTITION_NAME = re.compile(r'^iou_y(\d{4})m(\d{2})$')
+
+
+class PartitionError(Exception):
+    pass
+
+
+def monthStart(when):
+    '''
+    Midnight on the first of the month when falls in, local time.
+    '''
+    when = when.astimezone(TIMEZONE) if when.tzinfo else when
+    return TIMEZONE.localize(datetime(when.year, when.month, 1))
+
+
+def addMonths(month, count):
+    years, index = divmod(month.month - 1 + count, 12)
+    return TIMEZONE.localize(datetime(month.year + years, index + 1, 1))
+
+
+def partitionName(month):
+    return 'iou_y{0:04d}m{1:02d}'.format(month.year, month.month)
+
+
+def partitionMonth(name):
+    '''
+    The month a partition made by createPartitions holds, or None for any
+    other table.
+    '''
+    match = PARTITION_NAME.match(name)
+
+    if match is None:
+        return None
+
+    return TIMEZONE.localize(datetime(int(match.group(1)), int(match.group(2)), 1))
+
+
+def isPartitioned():
+    if db.engine.dialect.name != 'postgresql':
+        return False
+
+    if db.engine.dialect.server_version_info < PARTITIONING_VERSION:
+        return False
+
+    return db.session.execute(text('''
+        SELECT EXISTS (SELECT 1 FROM pg_partitioned_table
+                       WHERE partrelid = 'iou'::regclass)
+    ''')).scalar()
+
+
+def requirePartitioned():
+    if not isPartitioned():
+        raise PartitionError('iou is not partitioned; that takes PostgreSQL {} or '
+                             'later'.format('.'.join(map(str, PARTITIONING_VERSION))))
+
+
+def listPartitions():
+    '''
+    The monthly partitions attached to iou as (month, name) pairs, oldest
+    first. The default partition isn't one of them.
+    '''
+    names = db.session.execute(text('''
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = 'iou'::regclass
+    ''')).fetchall()
+
+    return sorted((partitionMonth(name), name) for name, in names
+                  if partitionMonth(name) is not None)
+
+
+def createPartitions(months_ahead=3, first=None, now=None):
+    '''
+    Make sure iou has a partition for every month from this one (or the
+    one first is in, if that's earlier) to months_ahead months from now.
+    IOUs for a month without one land in the default partition, so running
+    this late doesn't lose any, but creating a month's partition fails once
+    the default is holding rows for it. Returns the names of the
+    partitions it created.
+    '''
+    requirePartitioned()
+
+    this_month = monthStart(now or datetime.now(utc))
+    month = min(monthStart(first), this_month) if first else this_month
+    last = addMonths(this_month, months_ahead)
+
+    existing = {name for _, name in listPartitions()}
+    created = []
+
+    while month <= last:
+        name = partitionName(month)
+
+        if name not in existing:
+            db.session.execute(text(
+                "CREATE TABLE {0} PARTITION OF iou FOR VALUES FROM ('{1}') TO ('{2}')".format(
+                    name, month.isoformat(), addMonths(month, 1).isoformat())))
+            created.append(name)
+
+        month = addMonths(month, 1)
+
+    db.session.commit()
+
+    stats.incr('partitions.created', len(created))
+
+    return created
+
+
+def detachPartition(month, name):
+    '''
+    Record what a month of IOUs added up to for each pair and detach its
+    partition from iou, in one transaction so that balances recomputed from
+    the ledger never count the month twice or miss it. Every IOU in it has
+    to be in a balance checkpoint already.
+    '''
+    in_month = (IOU.date_added >= month, IOU.date_added < addMonths(month, 1))
+    uncompacted = IOU.query.filter(*in_month).filter(IOU.compacted_at == None)
+
+    if uncompacted.count():
+        db.session.rollback()
+        raise PartitionError('{0} has IOUs that are not in a balance checkpoint yet; '
+                             'run compact-balances first'.format(name))
+
+    totals = computePairBalances(*in_month).all()
+    iou_count = sum(row.iou_count for row in totals)
+
+    # DETACH needs this lock anyway. Taking it on iou before the partition,
+    # the same order an INSERT does, means it can't deadlock with one. It
+    # holds off writes only while making sure nothing has been added to
+    # the month since it was added up.
+    db.session.execute(text('LOCK TABLE iou IN ACCESS EXCLUSIVE MODE'))
+
+    if uncompacted.count() or IOU.query.filter(*in_month).count() != iou_count:
+        db.session.rollback()
+        raise PartitionError('IOUs were added to {} while it was being archived; '
+                             'compact them and try again'.format(name))
+
+    archive = IOUArchive(partition=name,
+                         start=month,
+                         end=addMonths(month, 1),
+                         iou_count=iou_count,
+                         detached_at=datetime.now(utc))
+    db.session.add(archive)
+    db.session.flush()
+
+    db.session.add_all([ArchivedBalance(partition=name,
+                                        low_phone=row.low_phone,
+                                        high_phone=row.high_phone,
+                                        amount=int(row.amount),
+                                        iou_count=row.iou_count,
+                                        last_updated=row.last_updated)
+                        for row in totals])
+
+    db.session.execute(text('ALTER TABLE iou DETACH PARTITION {}'.format(name)))
+    db.session.commit()
+
+    return archive
+
+
+def writeArchive(archive, directory):
+    '''
+    Copy a detached partition to a gzipped CSV file in directory, then drop
+    it.
+    '''
+    path = os.path.join(directory, '{}.csv.gz'.format(archive.partition))
+    partial = path + '.partial'
+
+    connection = db.session.connection().connection
+
+    with gzip.open(partial, 'wb') as output:
+        cursor = connection.cursor()
+        cursor.copy_expert('COPY (SELECT * FROM {} ORDER BY date_added, id) '
+                           'TO STDOUT WITH CSV HEADER'.format(archive.partition), output)
+
+    with open(partial, 'rb') as output:
+        os.fsync(output.fileno())
+
+    os.replace(partial, path)
+
+    db.session.execute(text('DROP TABLE {}'.format(archive.partition)))
+
+    archive.path = os.path.abspath(path)
+    archive.archived_at = datetime.now(utc)
+    db.session.commit()
+
+    stats.incr('partitions.archived')
+    stats.incr('partitions.archived_ious', archive.iou_count)
+
+    return archive
+
+
+def archivePartitions(directory, before):
+    '''
+    Move every month of iou that ends on or before the month before falls
+    in out to directory, along with any that a previous run detached but
+    didn't finish writing. Balances keep coming out right because every
+    archived IOU is already in a checkpoint and the months' totals are kept
+    in archived_balance. Returns the IOUArchive rows it finished.
+    '''
+    requirePartitioned()
+
+    cutoff = monthStart(before)
+
+    pending = IOUArchive.query.filter(IOUArchive.archived_at == None)\
+                              .order_by(IOUArchive.start)\
+                              .all()
+
+    for month, name in listPartitions():
+        if addMonths(month, 1) <= cutoff:
+            pending.append(detachPartition(month, name))
+
+    return [writeArchive(archive, directory) for archive in pending]
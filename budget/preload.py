@@ -0,0 +1,60 @@
+import gc
+import importlib
+
+from .database import db
+from .utils import PHONE_REGION
+
+
+# Imported on first use so that a worker that never sends a text (or a
+# CLI command) doesn't pay for them
+DEFERRED_MODULES = [
+    'phonenumbers',
+    'twilio.rest',
+    'twilio.base.exceptions',
+    'budget.twilio_http',
+]
+
+
+def loadPhoneMetadata(region):
+    '''
+    Load phonenumbers' metadata for region and validate an example number
+    from it, which compiles the patterns it's going to need. phonenumbers
+    only ever loads a region's metadata when a number needs it, so this is
+    all of it a worker ends up holding unless it's handed a number from
+    somewhere else.
+    '''
+    import phonenumbers
+
+    phonenumbers.PhoneMetadata.metadata_for_region(region)
+
+    example = phonenumbers.example_number(region)
+
+    if example is not None:
+        phonenumbers.is_valid_number(example)
+
+
+def preload(app):
+    '''
+    Do the work every worker would otherwise do for itself in a gunicorn
+    master with preload_app set, so that the workers forked from it share
+    the result copy-on-write: import what's imported lazily, load the
+    phone number metadata for the region numbers are parsed in and make the
+    database engines. Nothing that can't survive a fork (connections,
+    threads, the Twilio client) is kept.
+    '''
+    for name in DEFERRED_MODULES:
+        importlib.import_module(name)
+
+    loadPhoneMetadata(PHONE_REGION)
+
+    with app.app_context():
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+            db.get_engine(app, bind).dispose()
+
+    # Leave everything loaded so far out of the workers' garbage
+    # collections, which would otherwise write to (and so copy) the pages
+    # it's on
+    gc.collect()
+
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
@@ -0,0 +1,287 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .stats import stats
+
+
+logger = logging.getLogger('budget.slow_requests')
+
+_local = threading.local()
+
+
+class Trace(object):
+    '''
+    What one request spent its time on. Stage times exclude any SQL run
+    during them, which is added up under "db" instead.
+    '''
+    def __init__(self, profile=None):
+        self.started = time.time()
+        self.profile = profile
+        self.stages = {}
+        self.db_time = 0.0
+        self.statements = []
+        self.pending = 0
+        self.details = None
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+
+def currentTrace():
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def stage(name):
+    '''
+    Time a block as one stage of the current request, if it's being traced.
+    '''
+    trace = currentTrace()
+
+    if trace is None:
+        yield
+        return
+
+    started = time.time()
+    db_before = trace.db_time
+
+    try:
+        yield
+    finally:
+        trace.add(name, time.time() - started - (trace.db_time - db_before))
+
+
+def hotFunctions(profile, limit):
+    '''
+    The limit functions with the most time spent in them (not counting what
+    they called).
+    '''
+    rows = []
+
+    for (filename, line, function), (cc, calls, tottime, cumtime, callers) in \
+            pstats.Stats(profile).stats.items():
+        rows.append({
+            'function': '{0}:{1}({2})'.format(os.path.basename(filename), line, function),
+            'calls': calls,
+            'tottime': round(tottime, 6),
+            'cumtime': round(cumtime, 6),
+        })
+
+    rows.sort(key=lambda row: row['tottime'], reverse=True)
+
+    return rows[:limit]
+
+
+class RequestProfiler(object):
+    '''
+    Opt-in tracing of /incoming/. With PROFILE_ENABLED every request gets
+    stage timings (parse, db, render and sms) and a list of its SQL, and
+    PROFILE_SAMPLE_RATE of them also run under cProfile. A request that
+    takes longer than PROFILE_SLOW_THRESHOLD seconds is logged as one JSON
+    record on the "budget.slow_requests" logger, with the hottest
+    PROFILE_TOP_FUNCTIONS functions if it was sampled.
+
+    Any of those settings can be changed without a restart by writing them
+    (lower case, without the PROFILE_ prefix) to the JSON file named by
+    PROFILE_CONTROL_FILE, e.g. {"enabled": true, "sample_rate": 0.05}.
+    Workers look at its modification time at most once a second.
+    '''
+    settings = ('enabled', 'sample_rate', 'slow_threshold', 'top_functions', 'max_statements')
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.sample_rate = 0.01
+        self.slow_threshold = 1.0
+        self.top_functions = 15
+        self.max_statements = 50
+        self.control_file = None
+        self.control_mtime = None
+        self.checked = 0
+        self.defaults = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_ENABLED', self.enabled)
+        app.config.setdefault('PROFILE_SAMPLE_RATE', self.sample_rate)
+        app.config.setdefault('PROFILE_SLOW_THRESHOLD', self.slow_threshold)
+        app.config.setdefault('PROFILE_TOP_FUNCTIONS', self.top_functions)
+        app.config.setdefault('PROFILE_MAX_STATEMENTS', self.max_statements)
+        app.config.setdefault('PROFILE_CONTROL_FILE', None)
+
+        self.defaults = {name: app.config['PROFILE_' + name.upper()] for name in self.settings}
+        self.control_file = app.config['PROFILE_CONTROL_FILE']
+        self.control_mtime = None
+
+        self.configure({})
+
+        app.extensions['profiler'] = self
+
+    def configure(self, overrides):
+        for name in self.settings:
+            setattr(self, name, overrides.get(name, self.defaults[name]))
+
+    def refresh(self):
+        now = time.time()
+
+        if not self.control_file or now - self.checked < 1:
+            return
+
+        self.checked = now
+
+        try:
+            mtime = os.stat(self.control_file).st_mtime
+        except OSError:
+            mtime = None
+
+        if mtime == self.control_mtime:
+            return
+
+        self.control_mtime = mtime
+        overrides = {}
+
+        if mtime is not None:
+            try:
+                with open(self.control_file) as f:
+                    overrides = json.load(f)
+            except (OSError, ValueError):
+                logger.exception('Could not read %s', self.control_file)
+
+        self.configure(overrides)
+
+    def begin(self):
+        self.refresh()
+
+        if not self.enabled:
+            return None
+
+        profile = None
+
+        if random.random() < self.sample_rate:
+            profile = cProfile.Profile()
+
+        trace = Trace(profile)
+        _local.trace = trace
+
+        if profile is not None:
+            profile.enable()
+
+        return trace
+
+    def end(self, trace, **details):
+        if trace is None:
+            return
+
+        if trace.profile is not None:
+            trace.profile.disable()
+
+        _local.trace = None
+
+        elapsed = time.time() - trace.started
+
+        if elapsed < self.slow_threshold:
+            return
+
+        details['seconds'] = round(elapsed, 6)
+
+        # A reply still waiting in the outbox logs it once it's been sent
+        with trace.lock:
+            trace.details = details
+
+            if trace.pending:
+                return
+
+        self.log(trace)
+
+    def hold(self):
+        '''
+        Keep the current trace from being logged until resume() has run
+        with it, so that a reply sent from an outbox thread shows up in its
+        sms stage. Returns the trace, if there is one.
+        '''
+        trace = currentTrace()
+
+        if trace is not None:
+            with trace.lock:
+                trace.pending += 1
+
+        return trace
+
+    @contextmanager
+    def resume(self, trace):
+        '''
+        Run a block on another thread as part of a trace from hold().
+        '''
+        if trace is None:
+            yield
+            return
+
+        _local.trace = trace
+
+        try:
+            yield
+        finally:
+            _local.trace = None
+
+            with trace.lock:
+                trace.pending -= 1
+                finished = not trace.pending and trace.details is not None
+
+            if finished:
+                self.log(trace)
+
+    def log(self, trace):
+        stats.incr('profiler.slow_requests')
+
+        record = dict(trace.details)
+        record['stages'] = {name: round(seconds, 6) for name, seconds in trace.stages.items()}
+        record['stages']['db'] = round(trace.db_time, 6)
+        record['sql'] = trace.statements
+        record['sampled'] = trace.profile is not None
+
+        if trace.profile is not None:
+            record['functions'] = hotFunctions(trace.profile, self.top_functions)
+
+        logger.warning(json.dumps(record))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def startStatement(conn, cursor, statement, parameters, context, executemany):
+    if currentTrace() is not None:
+        conn.info.setdefault('trace_started', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def traceStatement(conn, cursor, statement, parameters, context, executemany):
+    trace = currentTrace()
+
+    if trace is None or not conn.info.get('trace_started'):
+        return
+
+    elapsed = time.time() - conn.info['trace_started'].pop()
+    trace.db_time += elapsed
+
+    if len(trace.statements) < profiler.max_statements:
+        trace.statements.append({'sql': ' '.join(statement.split()),
+                                 'seconds': round(elapsed, 6)})
+
+
+@event.listens_for(Engine, 'handle_error')
+def dropStatement(context):
+    if context.connection is not None and context.connection.info.get('trace_started'):
+        context.connection.info['trace_started'].pop()
+
+
+profiler = RequestProfiler()
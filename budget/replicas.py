@@ -0,0 +1,266 @@
+import itertools
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, has_request_context
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from .database import afterCommit, currentUnit, db, sessionOverride, usingSession
+from .stats import stats
+
+_local = threading.local()
+
+
+class Replica(object):
+    def __init__(self, bind):
+        self.bind = bind
+        self.lag = None
+        self.checked = 0
+        self.down_until = 0
+
+    def __repr__(self):
+        return '<Replica %r (%r seconds behind)>' % (self.bind, self.lag)
+
+
+def measureLag(connection):
+    '''
+    How many seconds of the primary's transactions the database on the
+    other end of connection hasn't replayed yet, or None if it can't tell.
+    A database that isn't replicating at all is never behind.
+    '''
+    if connection.dialect.name != 'postgresql':
+        return 0.0
+
+    if connection.dialect.server_version_info >= (10,):
+        received, replayed = 'pg_last_wal_receive_lsn', 'pg_last_wal_replay_lsn'
+    else:
+        received, replayed = 'pg_last_xlog_receive_location', 'pg_last_xlog_replay_location'
+
+    # Replay timestamps stand still while the primary is idle, so a replica
+    # that has replayed everything it has received counts as caught up
+    lag = connection.execute(text('''
+        SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN {0}() = {1}() THEN 0
+                    ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+               END
+    '''.format(received, replayed))).scalar()
+
+    return None if lag is None else float(lag)
+
+
+class ReplicaRouter(object):
+    '''
+    Sends read-only work to the databases in DATABASE_REPLICAS, taking
+    turns between them, and everything else to the primary. Work goes to
+    the primary instead when:
+
+    * the unit of work it's part of has already written something,
+    * the sender wrote something more recently than a replica is behind,
+    * every replica is more than REPLICA_MAX_LAG seconds behind, or
+    * a replica fails, in which case it's left alone for
+      REPLICA_RETRY_AFTER seconds and the work is run again on the primary.
+
+    How far behind each replica is gets checked at most every
+    REPLICA_LAG_CHECK_INTERVAL seconds. Recent writes are remembered per
+    worker, so with several workers a sender's next text can land on one
+    that doesn't know about them. REPLICA_MAX_LAG bounds how stale that
+    read can be.
+    '''
+    def __init__(self, app=None):
+        self.replicas = []
+        self.writes = {}
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DATABASE_REPLICAS', [])
+        app.config.setdefault('REPLICA_MAX_LAG', 5.0)
+        app.config.setdefault('REPLICA_LAG_CHECK_INTERVAL', 1.0)
+        app.config.setdefault('REPLICA_RETRY_AFTER', 30.0)
+
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        self.check_interval = app.config['REPLICA_LAG_CHECK_INTERVAL']
+        self.retry_after = app.config['REPLICA_RETRY_AFTER']
+
+        # Flask-SQLAlchemy makes and pools the engines, as for any other bind
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        self.replicas = []
+
+        for index, uri in enumerate(app.config['DATABASE_REPLICAS']):
+            bind = 'replica{}'.format(index)
+            binds[bind] = uri
+            self.replicas.append(Replica(bind))
+
+        app.config['SQLALCHEMY_BINDS'] = binds
+        app.teardown_request(self.closeSessions)
+
+        self.reset()
+
+        app.extensions['replicas'] = self
+
+    def reset(self):
+        with self._lock:
+            self.writes.clear()
+
+            for replica in self.replicas:
+                replica.lag = None
+                replica.checked = 0
+                replica.down_until = 0
+
+    def wrote(self, phone_number):
+        '''
+        Note that phone_number is writing in the current unit of work, so
+        that the rest of it and their next few texts read from the primary.
+        '''
+        unit = currentUnit()
+
+        if unit is not None:
+            unit.wrote = True
+
+        if self.replicas:
+            afterCommit(self.remember, phone_number)
+
+    def remember(self, phone_number):
+        now = time.time()
+
+        with self._lock:
+            self.writes[phone_number] = now
+
+            # Older writes are on any replica that's close enough to use
+            if len(self.writes) > 1024:
+                horizon = now - self.max_lag - self.check_interval
+
+                for other, written in list(self.writes.items()):
+                    if written < horizon:
+                        del self.writes[other]
+
+    def markDown(self, replica, now):
+        replica.down_until = now + self.retry_after
+        stats.incr('replica.errors{{bind="{}"}}'.format(replica.bind))
+
+        current_app.logger.warning('Replica %s failed, using the primary for %ss',
+                                   replica.bind, self.retry_after)
+
+    def checkLag(self, replica, now):
+        if now - replica.checked < self.check_interval:
+            return
+
+        replica.checked = now
+
+        try:
+            with db.get_engine(current_app, replica.bind).connect() as connection:
+                replica.lag = measureLag(connection)
+        except DBAPIError:
+            replica.lag = None
+            self.markDown(replica, now)
+            return
+
+        if replica.lag is not None:
+            stats.observe('replica.lag_seconds{{bind="{}"}}'.format(replica.bind), replica.lag)
+
+    def choose(self, phone_number=None):
+        '''
+        Pick a replica to read from. Returns it, or None and the reason for
+        using the primary.
+        '''
+        unit = currentUnit()
+
+        if unit is not None and unit.wrote:
+            return None, 'wrote'
+
+        now = time.time()
+        written = self.writes.get(phone_number) if phone_number else None
+        reason = 'lag'
+        start = next(self._turn)
+
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+
+            with self._lock:
+                if replica.down_until <= now:
+                    self.checkLag(replica, now)
+
+            if replica.down_until > now:
+                reason = 'down'
+                continue
+
+            if replica.lag is None or replica.lag > self.max_lag:
+                continue
+
+            # The lag could have grown by as much as the time since it was
+            # checked
+            if written is not None and now - written <= replica.lag + (now - replica.checked):
+                reason = 'recent_write'
+                continue
+
+            return replica, None
+
+        return None, reason
+
+    def read(self, sender, fn, *args, **kwargs):
+        '''
+        Call fn on a replica if there's one fit to use, with db.session and
+        Model.query reading from it, and on the primary otherwise (or if the
+        replica fails part way). sender is the phone number the read is
+        for, if anybody's.
+        '''
+        if not self.replicas or sessionOverride() is not None:
+            return fn(*args, **kwargs)
+
+        replica, reason = self.choose(sender)
+
+        if replica is None:
+            stats.incr('replica.fallbacks{{reason="{}"}}'.format(reason))
+            return fn(*args, **kwargs)
+
+        engine = db.get_engine(current_app, replica.bind)
+        session = db.create_session({'bind': engine, 'binds': {}, 'query_cls': BaseQuery})()
+
+        try:
+            with usingSession(session):
+                result = fn(*args, **kwargs)
+        except DBAPIError:
+            session.close()
+            self.markDown(replica, time.time())
+            stats.incr('replica.fallbacks{reason="error"}')
+            return fn(*args, **kwargs)
+        except Exception:
+            session.close()
+            raise
+
+        stats.incr('replica.reads{{bind="{}"}}'.format(replica.bind))
+
+        # Queries can still be iterating after fn returns (a streamed
+        # export), so in a request the session lasts as long as it does
+        if has_request_context():
+            _local.replica_sessions = getattr(_local, 'replica_sessions', []) + [session]
+        else:
+            session.close()
+
+        return result
+
+    def closeSessions(self, exception=None):
+        for session in getattr(_local, 'replica_sessions', []):
+            session.close()
+
+        _local.replica_sessions = []
+
+
+replicas = ReplicaRouter()
+
+
+def readOnly(view):
+    '''
+    Run a view on a replica.
+    '''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        return replicas.read(None, view, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,112 @@
+import heapq
+from collections import defaultdict, namedtuple
+
+from sqlalchemy import String, and_, case, cast, func, literal, or_, select, union_all
+
+from .database import db
+from .models import PairBalance, person_to_person
+
+
+Transfer = namedtuple('Transfer', ['from_phone', 'to_phone', 'amount'])
+
+
+def friendGraph(phone_number):
+    '''
+    Everybody reachable from phone_number through person_to_person, in
+    either direction, found with a single recursive query.
+    '''
+    # Both halves of a recursive query have to agree on the column type,
+    # length modifier included, so cast them both to plain VARCHAR
+    graph = db.session.query(cast(literal(phone_number), String).label('phone'))\
+                      .cte('graph', recursive=True)
+
+    other = cast(case([(person_to_person.c.from_phone == graph.c.phone,
+                        person_to_person.c.to_phone)],
+                      else_=person_to_person.c.from_phone), String)
+
+    step = db.session.query(other)\
+                     .select_from(graph)\
+                     .join(person_to_person,
+                           or_(person_to_person.c.from_phone == graph.c.phone,
+                               person_to_person.c.to_phone == graph.c.phone))
+
+    graph = graph.union(step)
+
+    return {row.phone for row in db.session.query(graph.c.phone)}
+
+
+def netPositions(phone_numbers):
+    '''
+    Net position in cents of each person across everybody else in
+    phone_numbers: positive if they're owed money, negative if they owe it.
+    This is one grouped aggregate over pair_balance, so it costs one row per
+    pair no matter how many IOUs are behind it.
+    '''
+    phone_numbers = list(phone_numbers)
+
+    within = and_(PairBalance.low_phone.in_(phone_numbers),
+                  PairBalance.high_phone.in_(phone_numbers))
+
+    lows = select([PairBalance.low_phone.label('phone'),
+                   (-PairBalance.amount).label('amount')]).where(within)
+    highs = select([PairBalance.high_phone.label('phone'),
+                    PairBalance.amount.label('amount')]).where(within)
+
+    sides = union_all(lows, highs).alias('sides')
+
+    rows = db.session.query(sides.c.phone, func.sum(sides.c.amount))\
+                     .group_by(sides.c.phone)
+
+    return {phone: int(amount) for phone, amount in rows}
+
+
+def settleTransfers(positions):
+    '''
+    Payments that zero out net positions in cents: exact matches first,
+    then the biggest debtor pays the biggest creditor.
+    '''
+    debts = defaultdict(list)
+    credits = defaultdict(list)
+
+    for phone, cents in positions.items():
+        if cents < 0:
+            debts[-cents].append(phone)
+        elif cents > 0:
+            credits[cents].append(phone)
+
+    transfers = []
+    debtors = []
+    creditors = []
+
+    for cents, phones in debts.items():
+        matches = credits.get(cents, [])
+
+        while phones and matches:
+            transfers.append(Transfer(phones.pop(), matches.pop(), cents))
+
+        debtors.extend((-cents, phone) for phone in phones)
+
+    for cents, phones in credits.items():
+        creditors.extend((-cents, phone) for phone in phones)
+
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
+
+    while debtors and creditors:
+        owes, debtor = heapq.heappop(debtors)
+        owed, creditor = heapq.heappop(creditors)
+
+        cents = min(-owes, -owed)
+        transfers.append(Transfer(debtor, creditor, cents))
+
+        if -owes > cents:
+            heapq.heappush(debtors, (owes + cents, debtor))
+        if -owed > cents:
+            heapq.heappush(creditors, (owed + cents, creditor))
+
+    return transfers
+
+
+def settleUp(phone_number):
+    positions = netPositions(friendGraph(phone_number))
+    return positions, settleTransfers(positions)
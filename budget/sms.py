@@ -0,0 +1,72 @@
+import os
+import threading
+
+
+class TwilioClients(object):
+    '''
+    Hands out one twilio.rest.Client per process. Sockets can't be shared
+    across a fork, so a gunicorn worker builds its own client (and
+    connection pool) the first time it sends rather than reusing the one
+    from a preloaded master.
+
+    Point TWILIO_API_BASE at a local server to send messages somewhere
+    other than api.twilio.com.
+    '''
+    def __init__(self, app=None):
+        self.app = None
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TWILIO_POOL_SIZE',
+                              app.config.get('OUTBOX_WORKERS', 4))
+        app.config.setdefault('TWILIO_TIMEOUT', 10.0)
+        app.config.setdefault('TWILIO_API_BASE', None)
+
+        self.app = app
+        self.reset()
+
+        app.extensions['twilio'] = self
+
+    def reset(self):
+        with self._lock:
+            self._client = None
+            self._pid = None
+
+    def build(self):
+        # twilio (and requests under it) take a while to import, so they
+        # wait until a worker first sends, or preload() in a gunicorn master
+        from twilio.rest import Client
+
+        from .twilio_http import PooledHttpClient
+
+        config = self.app.config
+
+        http_client = PooledHttpClient(config['TWILIO_POOL_SIZE'],
+                                       timeout=config['TWILIO_TIMEOUT'])
+
+        client = Client(config['TWILIO_ACCOUNT_ID'],
+                        config['TWILIO_AUTH_TOKEN'],
+                        http_client=http_client)
+
+        if config['TWILIO_API_BASE']:
+            client.api.base_url = config['TWILIO_API_BASE']
+
+        return client
+
+    @property
+    def client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = self.build()
+                    self._pid = os.getpid()
+
+        return self._client
+
+
+twilio_clients = TwilioClients()
@@ -0,0 +1,57 @@
+from collections import defaultdict
+from threading import Lock
+
+
+# Upper bounds, in seconds, of the histogram buckets timers are counted in
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Stats(object):
+    '''
+    In-process counters and timers. Everything is keyed by a dotted name
+    like "outbox.sent" so callers don't need to register anything up front.
+    A name can carry Prometheus style labels, e.g.
+    'incoming.seconds{command="inquiry"}'.
+    '''
+    def __init__(self, buckets=BUCKETS):
+        self._lock = Lock()
+        self.buckets = buckets
+        self.counters = defaultdict(int)
+        self.timers = {}
+        self.histograms = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            count, total, maximum = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (count + 1,
+                                 total + seconds,
+                                 max(maximum, seconds))
+
+            histogram = self.histograms.get(name)
+
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * len(self.buckets)
+
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[index] += 1
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            return (dict(self.counters),
+                    dict(self.timers),
+                    {name: list(counts) for name, counts in self.histograms.items()})
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timers.clear()
+            self.histograms.clear()
+
+
+stats = Stats()
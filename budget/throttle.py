@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy.exc import IntegrityError
+
+from .database import db
+from .models import RateLimitBucket
+from .stats import stats
+
+
+Verdict = namedtuple('Verdict', ['allowed', 'notify'])
+
+
+def takeToken(tokens, updated, notified, now, rate, burst, window):
+    '''
+    Refill a bucket for the time since it was last updated and try to take
+    a token out of it. Returns the Verdict along with the bucket's new
+    tokens and notified time.
+    '''
+    tokens = min(burst, tokens + (now - updated) * rate)
+
+    if tokens >= 1:
+        return Verdict(True, False), tokens - 1, notified
+
+    if notified is None or now - notified >= window:
+        return Verdict(False, True), tokens, now
+
+    return Verdict(False, False), tokens, notified
+
+
+class MemoryBuckets(object):
+    '''
+    One bucket per phone number in this worker. Each worker gets the full
+    rate, so the effective limit is multiplied by the number of workers.
+    Past max_buckets the least recently used bucket is dropped, which has
+    had the longest to refill and is usually full anyway.
+    '''
+    def __init__(self, max_buckets=10000):
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, phone_number, now, rate, burst, window):
+        with self._lock:
+            tokens, updated, notified = self.buckets.get(phone_number, (burst, now, None))
+
+            verdict, tokens, notified = takeToken(tokens, updated, notified,
+                                                  now, rate, burst, window)
+
+            self.buckets[phone_number] = (tokens, now, notified)
+            self.buckets.move_to_end(phone_number)
+
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+
+        return verdict
+
+    def reset(self):
+        with self._lock:
+            self.buckets.clear()
+
+
+class DatabaseBuckets(object):
+    '''
+    Buckets in the rate_limit_bucket table, so that every worker draws from
+    the same one. Each check is its own short transaction on a separate
+    connection: it locks the sender's row, so checks for one number are
+    serialized across workers, and it's committed even if the request that
+    made it is rolled back.
+    '''
+    def take(self, phone_number, now, rate, burst, window):
+        table = RateLimitBucket.__table__
+
+        while True:
+            with db.engine.begin() as connection:
+                row = connection.execute(table.select()
+                                              .where(table.c.phone_number == phone_number)
+                                              .with_for_update()).first()
+
+                if row is None:
+                    verdict, tokens, notified = takeToken(burst, now, None,
+                                                          now, rate, burst, window)
+                    try:
+                        with connection.begin_nested():
+                            connection.execute(table.insert().values(phone_number=phone_number,
+                                                                     tokens=tokens,
+                                                                     updated=now,
+                                                                     notified=notified))
+                    except IntegrityError:
+                        # Another worker created it first, so lock theirs
+                        continue
+
+                    return verdict
+
+                verdict, tokens, notified = takeToken(row.tokens, row.updated, row.notified,
+                                                      now, rate, burst, window)
+
+                connection.execute(table.update()
+                                        .where(table.c.phone_number == phone_number)
+                                        .values(tokens=tokens,
+                                                updated=now,
+                                                notified=notified))
+
+                return verdict
+
+    def reset(self):
+        with db.engine.begin() as connection:
+            connection.execute(RateLimitBucket.__table__.delete())
+
+
+BACKENDS = {
+    'memory': MemoryBuckets,
+    'database': DatabaseBuckets,
+}
+
+
+class RateLimiter(object):
+    '''
+    Token bucket per sending phone number, checked before a text is handed
+    to IOUHandler. A number gets RATE_LIMIT_BURST messages straight away
+    and then RATE_LIMIT_RATE more per second. Once it runs out it gets one
+    "slow down" reply per RATE_LIMIT_NOTICE_WINDOW seconds and everything
+    else is dropped. RATE_LIMIT_BACKEND is "memory" for a bucket per
+    worker, "database" for buckets shared through the rate_limit_bucket
+    table, or None to turn limiting off.
+    '''
+    def __init__(self, app=None):
+        self.backend = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATE_LIMIT_BACKEND', 'memory')
+        app.config.setdefault('RATE_LIMIT_RATE', 0.2)
+        app.config.setdefault('RATE_LIMIT_BURST', 20)
+        app.config.setdefault('RATE_LIMIT_NOTICE_WINDOW', 60)
+
+        self.rate = app.config['RATE_LIMIT_RATE']
+        self.burst = app.config['RATE_LIMIT_BURST']
+        self.window = app.config['RATE_LIMIT_NOTICE_WINDOW']
+
+        backend = app.config['RATE_LIMIT_BACKEND']
+        self.backend = BACKENDS[backend]() if backend else None
+
+        app.extensions['rate_limiter'] = self
+
+    def check(self, phone_number):
+        if self.backend is None:
+            return Verdict(True, False)
+
+        verdict = self.backend.take(phone_number, time.time(),
+                                    self.rate, self.burst, self.window)
+
+        if verdict.allowed:
+            stats.incr('ratelimit.allowed')
+        else:
+            stats.incr('ratelimit.throttled')
+
+        if verdict.notify:
+            stats.incr('ratelimit.notified')
+
+        return verdict
+
+    def reset(self):
+        if self.backend is not None:
+            self.backend.reset()
+
+
+rate_limiter = RateLimiter()
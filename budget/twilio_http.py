@@ -0,0 +1,62 @@
+import time
+
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .stats import stats
+
+
+class TimedPool(object):
+    '''
+    Records how long each request waits for a connection from the pool,
+    which is how long an outbox worker sits idle because every connection
+    to Twilio is in use.
+    '''
+    def _get_conn(self, timeout=None):
+        started = time.time()
+
+        try:
+            return super(TimedPool, self)._get_conn(timeout)
+        finally:
+            stats.observe('twilio.pool_wait_seconds', time.time() - started)
+
+
+class TimedHTTPConnectionPool(TimedPool, HTTPConnectionPool):
+    pass
+
+
+class TimedHTTPSConnectionPool(TimedPool, HTTPSConnectionPool):
+    pass
+
+
+class PooledHttpClient(TwilioHttpClient):
+    '''
+    TwilioHttpClient with a keep-alive connection pool big enough for every
+    outbox worker to hold a connection open to Twilio at the same time.
+    '''
+    def __init__(self, pool_size, timeout=None):
+        super(PooledHttpClient, self).__init__(pool_connections=True)
+
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_size,
+                              pool_block=True)
+        adapter.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.timeout = timeout
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                auth=None, timeout=None, allow_redirects=False):
+        return super(PooledHttpClient, self).request(method,
+                                                     url,
+                                                     params=params,
+                                                     data=data,
+                                                     headers=headers,
+                                                     auth=auth,
+                                                     timeout=timeout or self.timeout,
+                                                     allow_redirects=allow_redirects)
@@ -0,0 +1,55 @@
+from pytz import utc
+from sqlalchemy import CHAR, DateTime
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.types import TypeDecorator
+
+
+class UUID(TypeDecorator):
+    '''
+    A native UUID on PostgreSQL and CHAR(36) everywhere else. Values are
+    strings either way.
+    '''
+    impl = CHAR(36)
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.UUID())
+
+        return dialect.type_descriptor(CHAR(36))
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else str(value)
+
+
+class DateTimeTZ(TypeDecorator):
+    '''
+    TIMESTAMP WITH TIME ZONE on PostgreSQL. Databases without time zones
+    store UTC and get it back as an aware datetime, so the app sees the same
+    thing everywhere.
+    '''
+    impl = DateTime(timezone=True)
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+
+        if value.tzinfo is not None:
+            value = value.astimezone(utc).replace(tzinfo=None)
+
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=utc)
+
+        return value
+
+
+# Migrations written before these types existed use the PostgreSQL one
+@compiles(postgresql.UUID, 'sqlite')
+def compileUUID(type_, compiler, **kw):
+    return 'CHAR(36)'
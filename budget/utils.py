@@ -1,3 +1,5 @@
+import time
+from collections import OrderedDict
 from datetime import datetime
 
 from pytz import timezone
@@ -8,17 +10,23 @@ from sqlalchemy.orm.exc import NoResultFound, FlushError
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import text
 
-import phonenumbers
-from phonenumbers import PhoneNumberFormat
+from .models import IOU, Person, person_to_person, get_uuid
+from .balances import recordIOU, pairBalance, pairKey
+from .settle import settleUp
+from .cache import sender_cache
+from .money import formatCents
+from .stats import stats
+from .profiler import stage
+from .parser import parseCommands, ParseError, AddPerson, AddIOU, Inquiry, SettleUp
 
-from twilio.rest import Client
-
-from .models import IOU, Person, person_to_person
-
-from .database import db
+from .database import db, afterCommit
+from .replicas import replicas
 
 TIMEZONE = timezone('America/Chicago')
 
+# Where numbers without a country code are from
+PHONE_REGION = 'US'
+
 
 class MessageError(Exception):
     def __init__(self, message, from_number):
@@ -33,31 +41,87 @@ class PermissionError(MessageError):
     pass
 
 
+def normalizePhoneNumber(phone_number):
+    '''
+    Format a US phone number as E.164, raising ValueError if it isn't a
+    valid one.
+    '''
+    import phonenumbers
+    from phonenumbers import PhoneNumberFormat, NumberParseException
+
+    try:
+        parsed = phonenumbers.parse(phone_number, PHONE_REGION)
+    except NumberParseException:
+        raise ValueError(phone_number)
+
+    if not phonenumbers.is_valid_number(parsed):
+        raise ValueError(phone_number)
+
+    return phonenumbers.format_number(parsed, PhoneNumberFormat.E164)
+
+
 class IOUHandler(object):
+    handlers = {
+        AddPerson: 'addPerson',
+        AddIOU: 'addIOU',
+        Inquiry: 'inquiry',
+        SettleUp: 'settleUp',
+    }
+
+    # Handlers that only read, which can go to a replica
+    read_only = {Inquiry, SettleUp}
+
     def __init__(self, message, from_number):
         self.message = message.strip()
         self.from_number = from_number
+        self.kind = None
 
     def handle(self):
-        if self.message.lower().startswith('how much'):
-            return self.inquiry()
-        elif 'owe' in self.message.lower():
-            return self.addIOU()
-        elif self.message.lower().startswith('add'):
-            return self.addPerson()
-
-    def addPerson(self):
+        '''
+        Run every command in the message and return one reply covering all
+        of them. IOUs next to each other are recorded together by addIOUs.
+        '''
+        try:
+            with stage('parse'):
+                commands = parseCommands(self.message)
+        except ParseError as e:
+            raise MessageError(str(e), self.from_number)
+
+        kinds = {self.handlers[type(command)] for command in commands}
+        self.kind = kinds.pop() if len(kinds) == 1 else 'batch'
+
+        responses = []
+        ious = []
+
+        with stage('render'):
+            for command in commands:
+                if isinstance(command, AddIOU):
+                    ious.append(command)
+                    continue
+
+                if ious:
+                    responses.append(self.addIOUs(ious))
+                    ious = []
+
+                handler = getattr(self, self.handlers[type(command)])
+
+                if type(command) in self.read_only:
+                    responses.append(replicas.read(self.from_number, handler, command))
+                else:
+                    responses.append(handler(command))
+
+            if ious:
+                responses.append(self.addIOUs(ious))
+
+        return '\n'.join(responses)
+
+    def addPerson(self, command):
         '''
         Example: "Add Eric 3125555555"
         '''
         if self.fromAdmin():
 
-            try:
-                _, name, number = self.message.split(' ', 2)
-            except ValueError:
-                raise MessageError('"Add person" message should '
-                                   'look like: "Add <name> <phone number>"',
-                                   self.from_number)
+            name, number = command.name, command.number
 
             phone_number = self.validatePhoneNumber(number)
 
@@ -65,11 +129,9 @@ class IOUHandler(object):
                             phone_number=phone_number)
 
             try:
-                db.session.add(person)
-                db.session.commit()
+                with db.session.begin_nested():
+                    db.session.add(person)
             except IntegrityError:
-                db.session.rollback()
-
                 raise MessageError('A person with the phone '\
                                    'number {1} already exists'.format(name, phone_number),
                                    self.from_number)
@@ -79,10 +141,9 @@ class IOUHandler(object):
                                                       alias=name.lower())
 
             try:
-                db.session.execute(friend)
-                db.session.commit()
+                with db.session.begin_nested():
+                    db.session.execute(friend)
             except IntegrityError:
-                db.session.rollback()
                 real_friend = db.session.query(person_to_person)\
                                         .filter(person_to_person.c.alias == name.lower())\
                                         .filter(person_to_person.c.from_phone == self.from_number)\
@@ -92,127 +153,149 @@ class IOUHandler(object):
                                    'with the number {1}'.format(name, real_friend.to_phone),
                                    self.from_number)
 
+            afterCommit(sender_cache.invalidate, self.from_number)
+            replicas.wrote(self.from_number)
+
             return '"{name}" with phone number {number} successfully added'.format(name=name,
                                                                                    number=phone_number)
 
         else:
             raise PermissionError("Sorry, you can't do that", self.from_number)
 
-    def addIOU(self):
+    def addIOU(self, command):
         '''
         Example: "Eric owes Kristi $100"
                  "I owe Kristi $75"
                  "Kristi owes me $50"
         '''
+        return self.addIOUs([command])
 
-        ower_name, owee_name, amount, reason = self.parseMessage()
+    def addIOUs(self, commands):
+        '''
+        Example: "I owe Kristi $20 for lunch; Eric owes me $15 for cab"
 
-        try:
-            amount = amount.replace('$', '')
-            amount = float(amount)
-        except ValueError:
-            raise MessageError('Amount "{}" should be a number'.format(amount),
-                               self.from_number)
+        Every IOU is checked before any of them are written. Then they go in
+        with one multi-row INSERT and pair_balance gets one update per pair.
+        '''
+        date_added = TIMEZONE.localize(datetime.now())
 
-        sender, receiver, sent_from_ower = self.findRelationship(ower_name, owee_name)
+        rows = []
+        pairs = OrderedDict()
 
-        if self.from_number not in [sender.phone_number, receiver.phone_number]:
-            raise MessageError("Sorry, you can't record IOUs"
-                               "that you are not part of", self.from_number)
+        for command in commands:
+            sender, receiver, sent_from_ower = self.findRelationship(command.ower,
+                                                                     command.owee)
 
-        date_added = TIMEZONE.localize(datetime.now())
+            if self.from_number not in [sender.phone_number, receiver.phone_number]:
+                raise MessageError("Sorry, you can't record IOUs"
+                                   "that you are not part of", self.from_number)
 
-        if sent_from_ower:
-            iou = IOU(ower=sender,
-                      owee=receiver,
-                      date_added=date_added,
-                      amount=float(amount),
-                      reason=reason)
-        else:
-            iou = IOU(ower=receiver,
-                      owee=sender,
-                      date_added=date_added,
-                      amount=float(amount),
-                      reason=reason)
+            if sent_from_ower:
+                ower, owee = sender, receiver
+            else:
+                ower, owee = receiver, sender
 
-        db.session.add(iou)
-        db.session.commit()
+            rows.append({
+                'id': get_uuid(),
+                'ower_id': ower.phone_number,
+                'owee_id': owee.phone_number,
+                'date_added': date_added,
+                'amount': command.amount,
+                'pending': True,
+                'reason': command.reason,
+            })
 
-        return self.balance(iou.ower, iou.owee)
+            (low, high), sign = pairKey(ower.phone_number, owee.phone_number)
+            people, amount, count = pairs.get((low, high), ((ower, owee), 0, 0))
+            pairs[(low, high)] = (people, amount + sign * command.amount, count + 1)
 
-    def parseMessage(self):
-        try:
-            if ' for ' in self.message.lower():
-                people, reason = self.message.lower().split(' for ')
-                ower_name, owee = people.replace('owes', 'owe').split('owe')
-            else:
-                ower_name, owee = self.message.lower().replace('owes', 'owe').split('owe')
-                reason = 'General'
-            owee = owee.strip()
-            ower_name = ower_name.strip()
-            owee_name, amount = owee.rsplit(' ', 1)
-        except ValueError:
-            raise MessageError('IOU message should look like: '
-                               '"<name> owes <name> <amount> for <reason>"',
-                               self.from_number)
+        db.session.execute(IOU.__table__.insert().values(rows))
+        replicas.wrote(self.from_number)
 
-        return ower_name, owee_name, amount, reason
+        for (low, high), (people, amount, count) in pairs.items():
+            recordIOU(low, high, amount, date_added, count)
 
-    def inquiry(self):
+        return '\n'.join(self.balance(*people) for people, amount, count in pairs.values())
+
+    def inquiry(self, command):
         """
         Example: "How much does Eric owe Kristi?"
                  "How much do I owe Kristi?"
                  "How much does Kristi owe me?"
         """
 
-        try:
-            _, ower_name, _, owee_name = self.message.lower().rsplit(' ', 3)
-
-        except ValueError:
-            raise MessageError('Balance inquiry should look like '
-                               '"How much does <person 1 name> owe '
-                               '<person 2 name>?"', self.from_number)
-
-        sender, receiver, sent_from_ower = self.findRelationship(ower_name,
-                                                                 owee_name.replace('?', ''))
+        sender, receiver, sent_from_ower = self.findRelationship(command.ower,
+                                                                 command.owee)
 
         if sent_from_ower:
             return self.balance(sender, receiver)
         else:
             return self.balance(receiver, sender)
 
-    def balance(self, ower, owee):
-        owes = IOU.query.filter(IOU.ower == ower)\
-                        .filter(IOU.owee == owee).all()
-        ower_total = sum(o.amount for o in owes)
+    def settleUp(self, command):
+        """
+        Example: "Settle up"
+        """
+
+        positions, transfers = settleUp(self.from_number)
+
+        if not transfers:
+            return 'Everyone is even'
 
-        owed = IOU.query.filter(IOU.ower == owee)\
-                        .filter(IOU.owee == ower).all()
-        owee_total = sum(o.amount for o in owed)
+        # The whole friend graph's payments won't fit in a text, and most of
+        # them are between people the sender doesn't know
+        mine = [transfer for transfer in transfers
+                if self.from_number in (transfer.from_phone, transfer.to_phone)]
+        others = len(transfers) - len(mine)
 
-        balance =  int(ower_total - owee_total)
+        phones = {transfer.from_phone for transfer in mine} | \
+                 {transfer.to_phone for transfer in mine}
+
+        names = dict(db.session.query(Person.phone_number, Person.name)
+                               .filter(Person.phone_number.in_(list(phones))))
+
+        lines = []
+
+        for transfer in mine:
+            lines.append('{ower} pays {owee} {amount}'.format(ower=names[transfer.from_phone].title(),
+                                                              owee=names[transfer.to_phone].title(),
+                                                              amount=formatCents(transfer.amount)))
+
+        if not mine:
+            lines.append("You're even")
+
+        if others:
+            lines.append('{0} other payment{1} settle{2} up everyone else'.format(
+                others, '' if others == 1 else 's', 's' if others == 1 else ''))
+
+        return '\n'.join(lines)
+
+    def balance(self, ower, owee):
+        balance = pairBalance(ower.phone_number, owee.phone_number)
 
         fmt_args = {
             'ower': ower.name.title(),
             'owee': owee.name.title(),
-            'balance': balance,
+            'balance': formatCents(abs(balance)),
         }
 
         if balance == 0:
             message = '{ower} and {owee} are now even'.format(**fmt_args)
         elif balance > 0:
-            message = '{ower} now owes {owee} ${balance}'.format(**fmt_args)
+            message = '{ower} now owes {owee} {balance}'.format(**fmt_args)
         elif balance < 0:
-            fmt_args['balance'] = abs(fmt_args['balance'])
-            message = '{owee} now owes {ower} ${balance}'.format(**fmt_args)
+            message = '{owee} now owes {ower} {balance}'.format(**fmt_args)
 
         return message
 
     def findRelationship(self, ower_name, owee_name):
 
-        sender = Person.query.get(self.from_number)
+        sender = sender_cache.get(self.from_number)
         sent_from_ower = False
 
+        if sender is None:
+            raise PermissionError("Sorry, you can't do that", self.from_number)
+
         if ower_name == owee_name:
             alias = ower_name
         elif ower_name in ['i', sender.name]:
@@ -222,47 +305,42 @@ class IOUHandler(object):
             alias = ower_name
 
         try:
-            relationship = db.session.query(person_to_person)\
-                                     .filter(person_to_person.c.from_phone == self.from_number)\
-                                     .filter(person_to_person.c.alias == alias.lower())\
-                                     .one()
-        except NoResultFound:
+            receiver = sender.friends[alias.lower()]
+        except KeyError:
             raise MessageError('"{0}" not found. '
                                'You can add this person '
                                'by texting back "Add {0} '
                                '<their phone number>'.format(alias),
                                self.from_number)
 
-        receiver = Person.query.get(relationship.to_phone)
-
         return sender, receiver, sent_from_ower
 
 
     def validatePhoneNumber(self, phone_number):
-        parsed = phonenumbers.parse(phone_number, 'US')
-
-        if not phonenumbers.is_valid_number(parsed):
+        try:
+            return normalizePhoneNumber(phone_number)
+        except ValueError:
             raise MessageError('"{}" is not a valid '
                                'phone number'.format(phone_number),
                                self.from_number)
 
-        return phonenumbers.format_number(parsed, PhoneNumberFormat.E164)
-
     def fromAdmin(self):
-        admin = db.session.query(Person)\
-                          .filter(Person.phone_number == self.from_number)\
-                          .first()
+        admin = sender_cache.get(self.from_number)
         if admin:
             return admin.admin
 
 
 def sendTwilioResponse(message, to_number):
 
-    account_id = current_app.config['TWILIO_ACCOUNT_ID']
-    auth_token = current_app.config['TWILIO_AUTH_TOKEN']
     from_number = current_app.config['TWILIO_NUMBER']
 
-    client = Client(account_id, auth_token)
-    message = client.messages.create(to=to_number,
-                                     from_=from_number,
-                                     body=message)
+    client = current_app.extensions['twilio'].client
+    started = time.time()
+
+    try:
+        with stage('sms'):
+            message = client.messages.create(to=to_number,
+                                             from_=from_number,
+                                             body=message)
+    finally:
+        stats.observe('sms.send_seconds', time.time() - started)
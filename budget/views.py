@@ -1,12 +1,22 @@
-from flask import Blueprint, current_app, request, abort
+import time
+
+from flask import Blueprint, Response, current_app, request, abort, g
 
 
 from .models import IOU
-from .utils import IOUHandler, MessageError, PermissionError, sendTwilioResponse
-from .database import db
+from .utils import IOUHandler, MessageError, PermissionError
+from .dispatch import queueResponse
+from .dedup import message_log
+from .throttle import rate_limiter
+from .database import db, unitOfWork
+from .metrics import metrics
+from .profiler import profiler
+from .stats import stats
 
 views = Blueprint('views', __name__)
 
+SLOW_DOWN = "You're sending messages faster than I can keep up. Try again in a minute."
+
 
 @views.route('/pong/')
 def pong():
@@ -19,19 +29,69 @@ def pong():
     return DEPLOYMENT_ID
 
 
+@views.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @views.route('/incoming/', methods=['POST'])
 def incoming():
+    started = time.time()
+    g.command = 'error'
+
+    trace = profiler.begin()
+
+    try:
+        return handleIncoming()
+    finally:
+        stats.observe('incoming.seconds{{command="{}"}}'.format(g.command),
+                      time.time() - started)
+
+        profiler.end(trace,
+                     command=g.command,
+                     message_sid=request.form.get('MessageSid'))
+
+
+def handleIncoming():
 
     message = request.form.get('Body')
     from_number = request.form.get('From')
+    message_sid = request.form.get('MessageSid')
+
+    if not (message and from_number):
+        abort(400)
+
+    verdict = rate_limiter.check(from_number)
+
+    if not verdict.allowed:
+        g.command = 'throttled'
+
+        if verdict.notify:
+            queueResponse(SLOW_DOWN, from_number)
+
+        return 'rate limited'
+
+    with unitOfWork() as unit:
+        if message_sid:
+            previous = message_log.claim(message_sid)
+
+            if previous is not None:
+                g.command = 'duplicate'
+                current_app.logger.info('Already handled %s, replied %r',
+                                        message_sid, previous)
+                return 'iou handled'
 
-    if message and from_number:
         iou = IOUHandler(message, from_number)
         response = iou.handle()
-    else:
-        abort(400)
 
-    sendTwilioResponse(response, from_number)
+        if message_sid:
+            message_log.record(message_sid, response)
+
+        queueResponse(response, from_number)
+
+    g.command = iou.kind
+
+    current_app.logger.debug('Handled %r in %d round trips', message, unit.round_trips)
 
     return 'iou handled'
 
@@ -39,11 +99,22 @@ def incoming():
 @views.app_errorhandler(MessageError)
 def error(exception):
 
-    sendTwilioResponse(exception.message, exception.from_number)
+    stats.incr('incoming.errors{type="MessageError"}')
+
+    db.session.rollback()
+
+    message_sid = request.form.get('MessageSid')
+
+    with unitOfWork():
+        if message_sid:
+            message_log.record(message_sid, exception.message)
+
+        queueResponse(exception.message, exception.from_number)
 
     return 'exception handled'
 
 
 @views.app_errorhandler(PermissionError)
 def permission_error(exception):
+    stats.incr('incoming.errors{type="PermissionError"}')
     abort(401)
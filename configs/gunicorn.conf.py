@@ -0,0 +1,27 @@
+'''
+gunicorn settings that load the app once in the master and fork the
+workers from it, so they share its memory until they write to it:
+
+    gunicorn -c configs/gunicorn.conf.py runserver:app
+
+Each worker handles GUNICORN_THREADS requests at once on a pool of threads,
+so a burst of texts waits on Postgres together instead of one request per
+worker. Size SQLALCHEMY_POOL_SIZE to match. Flask 0.12 and SQLAlchemy 1.3
+have no asyncio support, so threads are how a worker overlaps that I/O.
+benchmarks/startup.py shows what preloading saves and
+benchmarks/load_test.py --compare what the threads do.
+'''
+import os
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 3))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded and before any worker is
+    # forked
+    from budget.preload import preload
+
+    preload(server.app.wsgi())
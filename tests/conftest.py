@@ -2,33 +2,40 @@ import os
 import pytest
 from uuid import uuid4
 
-from pytest_postgresql.factories import (
-    init_postgresql_database, drop_postgresql_database, get_config,
-)
-
 from budget import create_app
 from budget.database import db as _db
-from budget.models import Person, person_to_person
-from budget.utils import Client
+from budget.models import PairBalance, Person, person_to_person
+from budget.cache import sender_cache
+from budget.dedup import message_log
+from budget.throttle import rate_limiter
+from budget.replicas import replicas
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from twilio.rest import Client
+
+from .twilio_stub import FakeTwilioServer
+
+
+# In-memory SQLite unless TEST_DATABASE_URI points somewhere else, e.g.
+# postgresql://postgres:@:5432/budget_test
+DB_CONN = os.environ.get('TEST_DATABASE_URI', 'sqlite://')
 
+ADMIN_TOKEN = 'admin-token'
 
-DB_USER = 'postgres'
-DB_HOST = ''
-DB_PW = ''
-DB_PORT = 5432
-DB_NAME = 'budget_test'
 
-DB_OPTS = dict(
-    user=DB_USER,
-    host=DB_HOST,
-    pw=DB_PW,
-    port=DB_PORT,
-    name=DB_NAME
-)
+def workerUrl(uri):
+    '''
+    Under pytest-xdist every worker gets a database of its own, named after
+    the worker (budget_test_gw0, budget_test_gw1 ...). In-memory SQLite is
+    already private to each worker.
+    '''
+    url = make_url(uri)
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
 
-DB_FMT = 'postgresql://{user}:{pw}@{host}:{port}/{name}'
+    if worker and url.database and url.database != ':memory:':
+        url.database = '{0}_{1}'.format(url.database, worker)
 
-DB_CONN = DB_FMT.format(**DB_OPTS)
+    return url
 
 
 class FakeMessages(object):
@@ -38,10 +45,19 @@ class FakeMessages(object):
 
 @pytest.fixture(scope='session')
 def database(request):
-    pg_host = DB_OPTS.get("host")
-    pg_port = DB_OPTS.get("port")
-    pg_user = DB_OPTS.get("user")
-    pg_db = DB_OPTS.get("name", "tests")
+    url = workerUrl(DB_CONN)
+
+    if url.get_backend_name() != 'postgresql':
+        return str(url)
+
+    from pytest_postgresql.factories import (
+        init_postgresql_database, drop_postgresql_database,
+    )
+
+    pg_host = url.host or ''
+    pg_port = url.port or 5432
+    pg_user = url.username
+    pg_db = url.database or 'tests'
 
     # Create our Database.
     init_postgresql_database(pg_user, pg_host, pg_port, pg_db)
@@ -51,13 +67,16 @@ def database(request):
     def drop_database():
         drop_postgresql_database(pg_user, pg_host, pg_port, pg_db, 9.6)
 
+    return str(url)
+
 
 @pytest.fixture(scope='session')
 def app(request, database):
     """Session-wide test `Flask` application."""
     settings_override = {
         'TESTING': True,
-        'SQLALCHEMY_DATABASE_URI': DB_CONN
+        'SQLALCHEMY_DATABASE_URI': database,
+        'ADMIN_TOKEN': ADMIN_TOKEN,
     }
     app = create_app(__name__, settings_override)
 
@@ -72,41 +91,12 @@ def app(request, database):
     return app
 
 
-@pytest.fixture(scope='function')
-def db(app, request):
-
+@pytest.fixture(scope='session')
+def schema(app, request):
+    """Tables and the people every test starts with, created once."""
     _db.app = app
     _db.create_all()
 
-    def teardown():
-        _db.drop_all()
-
-    request.addfinalizer(teardown)
-
-    return _db
-
-
-# @pytest.fixture(scope='function')
-# def db_session(db, request):
-#     """Creates a new database session for a test."""
-#     connection = db.engine.connect()
-#     transaction = connection.begin()
-#
-#     options = dict(bind=connection, binds={})
-#     session = db.create_scoped_session(options=options)
-#
-#     db.session = session
-#
-#     def teardown():
-#         transaction.rollback()
-#         connection.close()
-#         session.remove()
-#
-#     request.addfinalizer(teardown)
-#     return session
-
-@pytest.fixture(scope='function')
-def setup(db, request):
     eric = Person(name='eric',
                   phone_number='+13125555555',
                   admin=True)
@@ -123,21 +113,73 @@ def setup(db, request):
                                              to_phone='+13125555555',
                                              alias='eric')
 
-    db.session.add(eric)
-    db.session.add(kristi)
+    _db.session.add(eric)
+    _db.session.add(kristi)
 
-    db.session.commit()
+    _db.session.flush()
 
-    db.session.execute(eric_to_kristi)
-    db.session.execute(kristi_to_eric)
+    _db.session.execute(eric_to_kristi)
+    _db.session.execute(kristi_to_eric)
 
-    db.session.commit()
+    _db.session.commit()
+    _db.session.remove()
 
     @request.addfinalizer
-    def remove_users():
-        db.session.delete(eric)
-        db.session.delete(kristi)
-        db.session.commit()
+    def drop_schema():
+        _db.session.remove()
+        _db.drop_all()
+
+    return _db
+
+
+@pytest.fixture(scope='function')
+def db(schema, request):
+    """
+    Runs each test inside a transaction on one connection that's rolled
+    back afterwards. The session works in a savepoint which is started
+    again whenever the code under test commits or rolls it back, so
+    commit() and rollback() in the app behave as usual without anything
+    reaching the database for good.
+
+    Code that goes to db.engine for a connection of its own (the database
+    rate limiter) isn't covered and has to clean up after itself.
+    """
+    connection = schema.engine.connect()
+    connection.begin()
+
+    session = schema.create_scoped_session(options=dict(bind=connection, binds={}))
+    session.begin_nested()
+
+    @event.listens_for(session(), 'after_transaction_end')
+    def restart_savepoint(db_session, ended):
+        if ended.nested and not ended._parent.nested:
+            db_session.expire_all()
+            db_session.begin_nested()
+
+    original = schema.session
+    schema.session = session
+
+    def teardown():
+        # Closing the connection rolls back everything the test did
+        session.remove()
+        connection.close()
+
+        schema.session = original
+
+        rate_limiter.reset()
+        sender_cache.clear()
+        message_log.clear()
+
+    request.addfinalizer(teardown)
+
+    return schema
+
+
+@pytest.fixture(scope='function')
+def setup(db):
+    """eric and kristi, who are friends. They're part of the schema, this
+    just makes sure the test runs in a transaction."""
+    return db
 
 
 @pytest.fixture(scope='function')
@@ -146,3 +188,57 @@ def twilio_mock(mocker):
     mocker.patch.object(Client, 'messages', new=fake_messages)
 
     return fake_messages
+
+
+@pytest.fixture(scope='function')
+def twilio_server(app, request):
+    server = FakeTwilioServer().start()
+    twilio_clients = app.extensions['twilio']
+
+    app.config['TWILIO_API_BASE'] = server.url
+    twilio_clients.reset()
+
+    @request.addfinalizer
+    def stop_server():
+        app.config['TWILIO_API_BASE'] = None
+        twilio_clients.reset()
+        server.stop()
+
+    return server
+
+
+@pytest.fixture(scope='function')
+def replica(app, db, tmpdir, request):
+    """A SQLite file standing in for a read replica. It has eric and kristi
+    but not the primary's IOUs, and says Eric owes Kristi $12.34, so that
+    replies show where they were read from."""
+    app.config['DATABASE_REPLICAS'] = ['sqlite:///{}'.format(tmpdir.join('replica.db'))]
+    app.config['REPLICA_LAG_CHECK_INTERVAL'] = 0
+    replicas.init_app(app)
+
+    engine = db.get_engine(app, 'replica0')
+    db.Model.metadata.create_all(engine)
+
+    engine.execute(Person.__table__.insert(), [
+        {'phone_number': '+13125555555', 'name': 'eric', 'admin': True},
+        {'phone_number': '+13126666666', 'name': 'kristi', 'admin': False},
+    ])
+    engine.execute(person_to_person.insert(), [
+        {'from_phone': '+13125555555', 'to_phone': '+13126666666', 'alias': 'kristi'},
+        {'from_phone': '+13126666666', 'to_phone': '+13125555555', 'alias': 'eric'},
+    ])
+    engine.execute(PairBalance.__table__.insert(), [
+        {'low_phone': '+13125555555', 'high_phone': '+13126666666',
+         'amount': 1234, 'iou_count': 1},
+    ])
+
+    @request.addfinalizer
+    def stop_replica():
+        engine.dispose()
+
+        app.config['DATABASE_REPLICAS'] = []
+        app.config['REPLICA_LAG_CHECK_INTERVAL'] = 1.0
+        app.config['SQLALCHEMY_BINDS'].pop('replica0')
+        replicas.init_app(app)
+
+    return engine
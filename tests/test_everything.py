@@ -3,7 +3,7 @@ from phonenumbers import PhoneNumberFormat
 
 from flask import url_for, current_app
 
-from budget.models import Person, IOU
+from budget.models import Person, IOU, PairBalance
 
 
 def test_add_iou(db, client, setup, twilio_mock):
@@ -14,13 +14,13 @@ def test_add_iou(db, client, setup, twilio_mock):
 
     rv = client.post(url_for('views.incoming'), data=data)
 
-    iou = db.session.query(IOU).filter(IOU.amount == 100.0).first()
+    iou = db.session.query(IOU).filter(IOU.amount == 10000).first()
     eric = db.session.query(Person).filter(Person.name == 'eric').first()
     kristi = db.session.query(Person).filter(Person.name == 'kristi').first()
 
     assert iou.ower == eric
     assert iou.owee == kristi
-    assert iou.amount == 100.0
+    assert iou.amount == 10000
     assert iou.pending
 
     assert twilio_mock.kwargs['to'] == data['From']
@@ -108,8 +108,297 @@ def test_add_iou(db, client, setup, twilio_mock):
 
     assert twilio_mock.kwargs['body'] == 'Kristi now owes Eric $70'
 
-    for iou in IOU.query.all():
-        db.session.delete(iou)
+    pair = PairBalance.query.get(('+13125555555', '+13126666666'))
+
+    assert pair.amount == -7000
+    assert pair.iou_count == 6
+
+
+def test_check_balances(db, client, setup, twilio_mock):
+    from budget.balances import checkBalances
+
+    for body in ['Eric owes Kristi $100', 'Kristi owes Eric $30']:
+        client.post(url_for('views.incoming'),
+                    data={'Body': body, 'From': '+13125555555'})
+
+    assert checkBalances() == []
+
+    pair = PairBalance.query.get(('+13125555555', '+13126666666'))
+    pair.amount = 500
+    db.session.commit()
+
+    mismatches = checkBalances(repair=True)
+
+    assert len(mismatches) == 1
+    assert mismatches[0].expected == (7000, 2)
+    assert mismatches[0].actual == (500, 2)
+
+    assert checkBalances() == []
+
+
+def test_settle_up(db, client, setup, twilio_mock):
+    for body in ['Eric owes Kristi $100', 'Kristi owes Eric $30', 'Settle up']:
+        client.post(url_for('views.incoming'),
+                    data={'Body': body, 'From': '+13126666666'})
+
+    assert twilio_mock.kwargs['body'] == 'Eric pays Kristi $70'
+
+    url = url_for('admin.settle', phone_number='+13126666666')
+
+    assert client.get(url).status_code == 401
+    assert client.get(url, headers={'Authorization': 'Bearer wrong'}).status_code == 401
+
+    rv = client.get(url, headers={'Authorization': 'Bearer admin-token'})
+
+    assert rv.json['positions'] == {'+13125555555': -7000, '+13126666666': 7000}
+    assert rv.json['transfers'] == [{'from_phone': '+13125555555',
+                                     'to_phone': '+13126666666',
+                                     'amount': 7000}]
+
+    # Only the sender's own payments are spelled out
+    for body in ['Add Floop (312) 888-7777', 'Floop owes me $40', 'Settle up']:
+        client.post(url_for('views.incoming'),
+                    data={'Body': body, 'From': '+13125555555'})
+
+    assert twilio_mock.kwargs['body'] == 'Eric pays Kristi $30\n' \
+                                         '1 other payment settles up everyone else'
+
+
+def test_settle_transfers():
+    from budget.settle import settleTransfers
+
+    positions = {
+        'a': -5000,
+        'b': -2500,
+        'c': 2500,
+        'd': 3000,
+        'e': 2000,
+    }
+
+    transfers = settleTransfers(positions)
+
+    assert len(transfers) <= len(positions) - 1
+    assert ('b', 'c', 2500) in transfers
+
+    totals = dict.fromkeys(positions, 0)
+
+    for from_phone, to_phone, amount in transfers:
+        totals[from_phone] += amount
+        totals[to_phone] -= amount
+
+    assert all(positions[p] + totals[p] == 0 for p in positions)
+
+
+def test_sender_cache(db, client, setup, twilio_mock):
+    from budget.stats import stats
+
+    stats.reset()
+
+    data = {
+        'Body': 'How much do I owe Kristi?',
+        'From': '+13125555555'
+    }
+
+    client.post(url_for('views.incoming'), data=data)
+    client.post(url_for('views.incoming'), data=data)
+
+    assert stats.counters['sender_cache.misses'] == 1
+    assert stats.counters['sender_cache.hits'] == 1
+
+    data = {
+        'Body': 'Add Foo +13129999999',
+        'From': '+13125555555'
+    }
+
+    client.post(url_for('views.incoming'), data=data)
+
+    data = {
+        'Body': 'How much does Foo owe me?',
+        'From': '+13125555555'
+    }
+
+    client.post(url_for('views.incoming'), data=data)
+
+    assert twilio_mock.kwargs['body'] == 'Foo and Eric are now even'
+    assert stats.counters['sender_cache.misses'] == 2
+
+
+def test_duplicate_message_sid(db, client, setup, twilio_mock):
+    from budget.dedup import message_log
+    from budget.stats import stats
+
+    stats.reset()
+
+    data = {
+        'Body': 'Eric owes Kristi $100',
+        'From': '+13125555555',
+        'MessageSid': 'SM0000000000000000000000000000001',
+    }
+
+    for _ in range(2):
+        client.post(url_for('views.incoming'), data=data)
+
+    # Another worker wouldn't have it cached, so it has to ask the table
+    message_log.clear()
+    twilio_mock.kwargs = None
+
+    client.post(url_for('views.incoming'), data=data)
+
+    assert IOU.query.count() == 1
+    assert twilio_mock.kwargs is None
+    assert stats.counters['dedup.suppressed'] == 2
+    assert stats.counters['dedup.cache_hits'] == 1
+    assert message_log.claim(data['MessageSid']) == 'Eric now owes Kristi $100'
+
+
+def test_rate_limit(db, client, setup, twilio_mock):
+    from budget.stats import stats
+    from budget.throttle import MemoryBuckets, takeToken
+    from budget.views import SLOW_DOWN
+
+    stats.reset()
+
+    burst = current_app.config['RATE_LIMIT_BURST']
+    data = {'Body': 'How much do I owe Kristi?', 'From': '+13125555555'}
+
+    for _ in range(burst + 1):
+        client.post(url_for('views.incoming'), data=data)
+
+    assert twilio_mock.kwargs['body'] == SLOW_DOWN
+
+    twilio_mock.kwargs = None
+    rv = client.post(url_for('views.incoming'), data=data)
+
+    assert rv.data == b'rate limited'
+    assert twilio_mock.kwargs is None
+    assert stats.counters['ratelimit.allowed'] == burst
+    assert stats.counters['ratelimit.throttled'] == 2
+    assert stats.counters['ratelimit.notified'] == 1
+
+    # Refills at the rate, and warns again once the window has gone by
+    assert takeToken(0, 0, None, 10, 0.2, 5, 60) == ((True, False), 1, None)
+    assert takeToken(0.5, 0, 0, 1, 0.2, 5, 60) == ((False, False), 0.7, 0)
+    assert takeToken(0.5, 0, 0, 60, 0.0, 5, 60) == ((False, True), 0.5, 60)
+
+    # Past max_buckets the least recently used one goes
+    buckets = MemoryBuckets(max_buckets=2)
+
+    for now, phone_number in enumerate(['1', '2', '1', '3']):
+        buckets.take(phone_number, now, 0.2, 5, 60)
+
+    assert list(buckets.buckets) == ['1', '3']
+
+
+def test_multiple_commands(db, client, setup, twilio_mock):
+    from budget.parser import parseCommands, AddIOU, SettleUp
+
+    assert parseCommands('I owe Kristi $20 for lunch\nKristi owes me 5; settle up') == [
+        AddIOU('i', 'kristi', 2000, 'lunch'),
+        AddIOU('kristi', 'me', 500, 'General'),
+        SettleUp(),
+    ]
+
+    data = {
+        'Body': 'I owe Kristi $20 for lunch\nKristi owes me $5 for cab;\nHow much do I owe Kristi?',
+        'From': '+13125555555',
+    }
+
+    client.post(url_for('views.incoming'), data=data)
+
+    assert twilio_mock.kwargs['body'] == 'Eric now owes Kristi $15\nEric now owes Kristi $15'
+
+    pair = PairBalance.query.get(('+13125555555', '+13126666666'))
+
+    assert IOU.query.count() == 2
+    assert (pair.amount, pair.iou_count) == (1500, 2)
+
+    # One bad line means none of them are recorded
+    data['Body'] = 'I owe Kristi $20\nI owe Floop $5'
+
+    client.post(url_for('views.incoming'), data=data)
+
+    assert twilio_mock.kwargs['body'].startswith('"floop" not found.')
+    assert IOU.query.count() == 2
+
+
+def test_metrics(db, client, setup, twilio_mock, tmpdir):
+    import json
+    import os
+
+    from budget.metrics import metrics
+    from budget.stats import stats
+
+    stats.reset()
+
+    client.post(url_for('views.incoming'),
+                data={'Body': 'How much do I owe Kristi?', 'From': '+13125555555'})
+    client.post(url_for('views.incoming'),
+                data={'Body': 'Hello?', 'From': '+13125555555'})
+
+    text = client.get(url_for('views.prometheus_metrics')).data.decode()
+
+    assert '# TYPE budget_incoming_seconds histogram' in text
+    assert 'budget_incoming_seconds_count{command="inquiry"} 1' in text
+    assert 'budget_incoming_seconds_bucket{command="error",le="+Inf"} 1' in text
+    assert 'budget_incoming_errors_total{type="MessageError"} 1' in text
+    assert 'budget_sms_send_seconds_count 2' in text
+    assert 'budget_db_query_seconds_count ' in text
+
+    # Another worker's numbers get added in
+    other = {
+        'pid': os.getppid(),
+        'counters': {'incoming.errors{type="MessageError"}': 2},
+        'timers': {},
+        'histograms': {},
+        'gauges': {},
+    }
+    tmpdir.join('{}.json'.format(os.getppid())).write(json.dumps(other))
+
+    metrics.directory = str(tmpdir)
+
+    try:
+        text = metrics.render()
+    finally:
+        metrics.directory = None
+
+    assert 'budget_incoming_errors_total{type="MessageError"} 3' in text
+    assert tmpdir.join('{}.json'.format(os.getpid())).check()
+
+
+def test_slow_request_log(db, client, setup, twilio_mock, tmpdir, caplog):
+    import json
+    import os
+
+    from budget.profiler import profiler
+
+    control = tmpdir.join('profile.json')
+    control.write(json.dumps({'enabled': True, 'sample_rate': 1.0, 'slow_threshold': 0}))
+
+    profiler.control_file = str(control)
+    profiler.checked = 0
+
+    try:
+        client.post(url_for('views.incoming'),
+                    data={'Body': 'How much do I owe Kristi?', 'From': '+13125555555'})
+
+        # Turned off again without touching the app's config
+        os.remove(str(control))
+        profiler.checked = 0
+
+        client.post(url_for('views.incoming'),
+                    data={'Body': 'How much do I owe Kristi?', 'From': '+13125555555'})
+    finally:
+        profiler.control_file = None
+        profiler.configure({})
+
+    records = [json.loads(r.getMessage()) for r in caplog.records
+               if r.name == 'budget.slow_requests']
+
+    assert len(records) == 1
+    assert records[0]['command'] == 'inquiry'
+    assert set(records[0]['stages']) >= {'parse', 'render', 'db', 'sms'}
+    assert records[0]['sql']
+    assert records[0]['functions']
 
 
 def test_bad_amount(client, setup, twilio_mock):
@@ -125,6 +414,32 @@ def test_bad_amount(client, setup, twilio_mock):
     assert twilio_mock.kwargs['body'] == 'Amount "poop" should be a number'
 
 
+def test_cents(db, client, setup, twilio_mock):
+    for body in ['Eric owes Kristi $20.50', 'Eric owes Kristi 0.1', 'Eric owes Kristi 0.2']:
+        client.post(url_for('views.incoming'),
+                    data={'Body': body, 'From': '+13125555555'})
+
+    assert twilio_mock.kwargs['body'] == 'Eric now owes Kristi $20.80'
+
+    client.post(url_for('views.incoming'),
+                data={'Body': 'Eric owes Kristi $1.005', 'From': '+13125555555'})
+
+    assert twilio_mock.kwargs['body'] == 'Amount "1.005" has fractions of a cent'
+
+    import pytest
+
+    from budget.money import parseCents
+
+    for amount in ['-5', '$-3.00', '0', '1e30']:
+        with pytest.raises(ValueError):
+            parseCents(amount)
+
+    client.post(url_for('views.incoming'),
+                data={'Body': 'Eric owes Kristi $-3.00', 'From': '+13125555555'})
+
+    assert twilio_mock.kwargs['body'] == 'Amount "-3.00" should be more than zero'
+
+
 def test_add_person(db, client, setup, twilio_mock):
 
     good_numbers = [
@@ -159,9 +474,6 @@ def test_add_person(db, client, setup, twilio_mock):
         assert twilio_mock.kwargs['from_'] == current_app.config['TWILIO_NUMBER']
         assert twilio_mock.kwargs['body'] == '"{name}" with phone number {number} successfully added'.format(name=name, number=number)
 
-        db.session.delete(person)
-        db.session.commit()
-
 
 def test_iou_missing_person(db, client, setup, twilio_mock):
 
@@ -253,6 +565,29 @@ def test_duplicate_friend(db, client, setup, twilio_mock):
     assert twilio_mock.kwargs['body'] == 'You already have a friend named '\
                                          'Kristi with the number +13126666666'
 
+    # The person is rolled back along with the alias, not left half added
+    assert Person.query.get('+13122222222') is None
+
+
+def test_unit_of_work(db, client, setup, twilio_mock, mocker):
+    from budget.stats import stats
+
+    stats.reset()
+    commit = mocker.spy(db.session, 'commit')
+
+    data = {
+        'Body': 'Eric owes Kristi $100',
+        'From': '+13125555555',
+        'MessageSid': 'SM0000000000000000000000000000002',
+    }
+
+    client.post(url_for('views.incoming'), data=data)
+
+    assert stats.counters['uow.count'] == 1
+    assert commit.call_count == 1
+    assert 0 < stats.counters['uow.round_trips'] <= stats.counters['db.statements'] + 1
+
+
 def test_bad_inquiry(db, client, setup, twilio_mock):
 
     data = {
@@ -265,3 +600,368 @@ def test_bad_inquiry(db, client, setup, twilio_mock):
     assert twilio_mock.kwargs['body'] == 'Balance inquiry should look like '\
                                          '"How much does <person 1 name> owe '\
                                          '<person 2 name>?"'
+
+
+def test_outbox_retry(app, mocker):
+    from twilio.base.exceptions import TwilioRestException
+
+    from budget.dispatch import Outbox, MemoryBackend, Envelope
+    from budget.stats import stats
+
+    send = mocker.patch('budget.dispatch.sendTwilioResponse',
+                        side_effect=[TwilioRestException(503, '/Messages'),
+                                     TwilioRestException(400, '/Messages')])
+
+    outbox = Outbox()
+    outbox.app = app
+    outbox.backend = MemoryBackend()
+
+    stats.reset()
+
+    envelope = Envelope('Eric now owes Kristi $100', '+13125555555')
+    outbox._deliver(envelope)
+
+    assert outbox.depth() == 1
+    assert envelope.not_before > envelope.enqueued
+    assert stats.counters['outbox.retried'] == 1
+
+    outbox._deliver(envelope)
+
+    assert outbox.depth() == 1
+    assert stats.counters['outbox.failed'] == 1
+    assert send.call_count == 2
+
+
+def test_outbox_trace(app, twilio_mock, caplog):
+    import json
+    import os
+
+    from budget.dispatch import Outbox, MemoryBackend
+    from budget.profiler import profiler
+
+    outbox = Outbox()
+    outbox.app = app
+    outbox.backend = MemoryBackend()
+
+    # As if the worker threads were already running
+    outbox._pid = os.getpid()
+
+    profiler.configure({'enabled': True, 'sample_rate': 0, 'slow_threshold': 0})
+
+    try:
+        trace = profiler.begin()
+        outbox._enqueue('Eric now owes Kristi $100', '+13125555555')
+        profiler.end(trace, command='iou')
+
+        def logged():
+            return [json.loads(r.getMessage()) for r in caplog.records
+                    if r.name == 'budget.slow_requests']
+
+        # Not until the reply has gone out
+        assert logged() == []
+
+        outbox._deliver(outbox.backend.get(0))
+    finally:
+        profiler.configure({})
+
+    assert twilio_mock.kwargs['body'] == 'Eric now owes Kristi $100'
+    assert [record['command'] for record in logged()] == ['iou']
+    assert 'sms' in logged()[0]['stages']
+
+
+def test_twilio_client_pool(app, twilio_server):
+    from budget.stats import stats
+    from budget.utils import sendTwilioResponse
+
+    stats.reset()
+
+    for amount in (10, 20, 30):
+        sendTwilioResponse('Eric now owes Kristi ${}'.format(amount),
+                           '+13126666666')
+
+    assert [m['Body'] for m in twilio_server.messages] == [
+        'Eric now owes Kristi $10',
+        'Eric now owes Kristi $20',
+        'Eric now owes Kristi $30',
+    ]
+    assert twilio_server.messages[0]['To'] == '+13126666666'
+    assert twilio_server.messages[0]['From'] == current_app.config['TWILIO_NUMBER']
+    assert twilio_server.connections == 1
+    assert stats.timers['twilio.pool_wait_seconds'][0] == 3
+
+
+def test_parse_command():
+    from budget.parser import parseCommand, AddIOU, Inquiry, AddPerson
+
+    assert parseCommand('I owe Kristi $20 for Lunch for two') == \
+        AddIOU('i', 'kristi', 2000, 'Lunch for two')
+    assert parseCommand('Kristi owes me 50') == \
+        AddIOU('kristi', 'me', 5000, 'General')
+    assert parseCommand('How much does Eric owe Kristi?') == \
+        Inquiry('eric', 'kristi')
+    assert parseCommand('Add Floop (312) 888-7777') == \
+        AddPerson('Floop', '(312) 888-7777')
+
+
+def test_unknown_command(db, client, setup, twilio_mock):
+
+    data = {
+        'Body': 'Hello?',
+        'From': '+13125555555',
+    }
+
+    client.post(url_for('views.incoming'), data=data)
+
+    assert twilio_mock.kwargs['body'].startswith("Sorry, I don't understand that.")
+
+
+def test_import_ledger(db, setup):
+    import io
+
+    from budget.balances import checkBalances
+    from budget.importer import importLedger
+
+    source = '''type,phone_number,name,from_phone,alias,to_phone,id,ower_id,owee_id,amount,reason
+person,312 999 9999,foo,,,,,,,,
+person,444,bad,,,,,,,,
+alias,,,3125555555,Foo,3129999999,,,,,
+iou,,,,,,,3125555555,3129999999,$20,lunch
+iou,,,,,,0b0e8a0e-0000-4000-8000-000000000001,3129999999,3126666666,15,
+iou,,,,,,,3128888888,3126666666,15,
+iou,,,,,,0b0e8a0e-0000-4000-8000-000000000001,3129999999,3126666666,99,
+'''
+
+    result = importLedger(io.StringIO(source))
+
+    assert (result.people, result.aliases, result.ious) == (1, 1, 2)
+    assert result.rejected == 2
+    assert result.skipped == 1
+    assert IOU.query.filter(IOU.owee_id == '+13126666666').one().amount == 1500
+
+    result = importLedger(io.StringIO(source))
+
+    assert (result.people, result.aliases, result.ious) == (0, 0, 1)
+    assert result.skipped == 2
+
+    assert Person.query.get('+13129999999').name == 'foo'
+    assert IOU.query.filter(IOU.reason == 'lunch').count() == 2
+    assert PairBalance.query.get(('+13125555555', '+13129999999')).amount == 4000
+    assert checkBalances() == []
+
+
+def test_import_jsonl(db, setup):
+    import io
+
+    from budget.importer import importLedger
+
+    source = '''
+{"type": "iou", "ower_id": 3125555555, "owee_id": "3126666666", "amount": 20}
+{"type": "iou", "ower_id": "3125555555", "owee_id": "3126666666", "amount": 7.5, "reason": "cab"}
+{"type": "iou", "ower_id": "3125555555", "owee_id": "3126666666", "amount": 0.001}
+{bad
+["iou"]
+'''
+    errors = []
+
+    result = importLedger(io.StringIO(source), format='jsonl',
+                          on_error=lambda line, e: errors.append(line))
+
+    assert (result.read, result.ious, result.rejected) == (5, 2, 3)
+    assert errors == [3, 4, 5]
+    assert sorted(iou.amount for iou in IOU.query) == [750, 2000]
+
+
+def test_export_ledger(app, db, client, setup, twilio_mock):
+    import base64
+    import csv
+    import io
+    import json
+
+    for body in ['Eric owes Kristi $100', 'Kristi owes Eric $30 for cab']:
+        client.post(url_for('views.incoming'),
+                    data={'Body': body, 'From': '+13125555555'})
+
+    # A client that doesn't preserve request contexts, which would otherwise
+    # get tangled up with the ones stream_with_context pushes
+    exporter = app.test_client()
+
+    assert exporter.get(url_for('admin.export')).status_code == 401
+
+    credentials = base64.b64encode(b'admin:admin-token').decode('ascii')
+    auth = {'Authorization': 'Basic ' + credentials}
+
+    rv = exporter.get(url_for('admin.export', phone='312 555 5555'), headers=auth)
+    rows = list(csv.DictReader(io.StringIO(rv.data.decode('utf-8'))))
+
+    assert rv.mimetype == 'text/csv'
+    assert [(r['type'], r['ower_id'], r['amount'], r['reason']) for r in rows] == [
+        ('iou', '+13125555555', '100.00', 'General'),
+        ('iou', '+13126666666', '30.00', 'cab'),
+    ]
+
+    rv = exporter.get(url_for('admin.export',
+                              phone='+13125555555',
+                              counterpart='+13129999999',
+                              format='ndjson'), headers=auth)
+
+    assert rv.data == b''
+
+    rv = exporter.get(url_for('admin.export', start='2000-01-01', format='ndjson'), headers=auth)
+    records = [json.loads(line) for line in rv.data.decode('utf-8').splitlines()]
+
+    assert [r['amount'] for r in records] == ['100.00', '30.00']
+
+    assert exporter.get(url_for('admin.export', phone='444'), headers=auth).status_code == 400
+    assert exporter.get(url_for('admin.export', counterpart='+13126666666'),
+                        headers=auth).status_code == 400
+
+
+def test_time_ordered_ids(db, client, setup, twilio_mock):
+    from uuid import UUID, uuid4
+
+    from budget.models import get_uuid
+
+    ids = [get_uuid() for _ in range(1000)]
+
+    assert ids == sorted(ids)
+    assert {UUID(id).version for id in ids} == {7}
+
+    # Rows from before keep their random ids
+    old = str(uuid4())
+    db.session.add(IOU(id=old, ower_id='+13125555555', owee_id='+13126666666', amount=100))
+
+    client.post(url_for('views.incoming'),
+                data={'Body': 'Eric owes Kristi $2', 'From': '+13125555555'})
+
+    assert IOU.query.get(old).amount == 100
+    assert UUID(IOU.query.filter(IOU.id != old).one().id).version == 7
+
+
+def test_compact_balances(db, client, setup, twilio_mock):
+    from budget.balances import computePairBalance
+    from budget.checkpoints import compactBalances, verifyCheckpoints
+    from budget.models import BalanceCheckpoint
+
+    for body in ['Eric owes Kristi $100', 'Kristi owes Eric $30', 'Eric owes Kristi $5']:
+        client.post(url_for('views.incoming'),
+                    data={'Body': body, 'From': '+13125555555'})
+
+    # Stopping after the first batch leaves the rest for next time
+    assert compactBalances(batch_size=2, max_batches=1) == (2, 1, 1)
+    assert compactBalances(batch_size=2) == (1, 1, 1)
+    assert compactBalances(batch_size=2) == (0, 0, 0)
+
+    checkpoint = BalanceCheckpoint.query.get(('+13125555555', '+13126666666'))
+
+    assert (checkpoint.amount, checkpoint.iou_count) == (7500, 3)
+    assert IOU.query.filter(IOU.compacted_at == None).count() == 0
+
+    client.post(url_for('views.incoming'),
+                data={'Body': 'Kristi owes Eric $10', 'From': '+13125555555'})
+
+    assert computePairBalance('+13125555555', '+13126666666') == 6500
+    assert computePairBalance('+13126666666', '+13125555555') == -6500
+    assert verifyCheckpoints() == []
+
+    checkpoint.amount = 100
+    db.session.commit()
+
+    assert verifyCheckpoints() == [('+13125555555', '+13126666666', (7500, 3), (100, 3))]
+
+
+def test_archived_balances(db, client, setup, twilio_mock):
+    import pytest
+    from datetime import datetime
+
+    from pytz import utc
+
+    from budget.balances import checkBalances, computePairBalance, computePairBalances
+    from budget.checkpoints import compactBalances, verifyCheckpoints
+    from budget.models import ArchivedBalance, IOUArchive
+    from budget.partitions import (PartitionError, addMonths, archivePartitions,
+                                   createPartitions, monthStart, partitionName)
+
+    for body in ['Eric owes Kristi $100', 'Kristi owes Eric $30']:
+        client.post(url_for('views.incoming'),
+                    data={'Body': body, 'From': '+13125555555'})
+
+    compactBalances()
+
+    # What archivePartitions leaves behind once the month is gone from iou
+    now = datetime.now(utc)
+    db.session.add(IOUArchive(partition='iou_y2017m01',
+                              start=now,
+                              end=now,
+                              iou_count=2,
+                              detached_at=now,
+                              archived_at=now))
+    db.session.flush()
+
+    for row in computePairBalances():
+        db.session.add(ArchivedBalance(partition='iou_y2017m01',
+                                       low_phone=row.low_phone,
+                                       high_phone=row.high_phone,
+                                       amount=row.amount,
+                                       iou_count=row.iou_count,
+                                       last_updated=row.last_updated))
+
+    IOU.query.delete()
+    db.session.commit()
+
+    client.post(url_for('views.incoming'),
+                data={'Body': 'Eric owes Kristi $5', 'From': '+13125555555'})
+
+    assert computePairBalance('+13125555555', '+13126666666') == 7500
+    assert checkBalances() == []
+    assert verifyCheckpoints() == []
+
+    december = monthStart(datetime(2016, 12, 15, 12, tzinfo=utc))
+
+    assert partitionName(december) == 'iou_y2016m12'
+    assert partitionName(addMonths(december, 2)) == 'iou_y2017m02'
+
+    # Only PostgreSQL 11 and later partition iou
+    with pytest.raises(PartitionError):
+        createPartitions()
+
+    with pytest.raises(PartitionError):
+        archivePartitions('.', now)
+
+
+def test_replica_reads(db, client, setup, twilio_mock, replica, mocker):
+    import time
+
+    from budget.replicas import replicas
+
+    lag = mocker.patch('budget.replicas.measureLag', return_value=0.0)
+
+    def send(body, sender='+13125555555'):
+        client.post(url_for('views.incoming'), data={'Body': body, 'From': sender})
+        return twilio_mock.kwargs['body']
+
+    assert send('How much do I owe Kristi?') == 'Eric now owes Kristi $12.34'
+
+    # A second behind, so Eric's next text reads his IOU from the primary
+    lag.return_value = 1.0
+
+    assert send('I owe Kristi $100') == 'Eric now owes Kristi $100'
+    assert send('How much do I owe Kristi?') == 'Eric now owes Kristi $100'
+    assert send('How much do I owe Eric?', '+13126666666') == 'Eric now owes Kristi $12.34'
+
+    # Reads after a write in the same text go to the primary
+    replicas.reset()
+
+    assert send('I owe Kristi $1; how much do I owe Kristi?') == \
+        'Eric now owes Kristi $101\nEric now owes Kristi $101'
+
+    # Too far behind for anybody
+    lag.return_value = 60.0
+
+    assert send('How much do I owe Eric?', '+13126666666') == 'Eric now owes Kristi $101'
+
+    # A broken replica is left alone for a while
+    lag.return_value = 0.0
+    replica.execute('DROP TABLE pair_balance')
+
+    assert send('How much do I owe Eric?', '+13126666666') == 'Eric now owes Kristi $101'
+    assert replicas.replicas[0].down_until > time.time()
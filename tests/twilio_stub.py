@@ -0,0 +1,79 @@
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+
+MESSAGE_FIELDS = [
+    'account_sid', 'api_version', 'body', 'date_created', 'date_updated',
+    'date_sent', 'direction', 'error_code', 'error_message', 'from',
+    'messaging_service_sid', 'num_media', 'num_segments', 'price',
+    'price_unit', 'sid', 'status', 'subresource_uris', 'to', 'uri',
+]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super(StubHandler, self).setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        form = {k: v[0] for k, v in form.items()}
+
+        with self.server.lock:
+            self.server.messages.append(form)
+
+        payload = {field: None for field in MESSAGE_FIELDS}
+        payload.update({
+            'sid': 'SM{:032d}'.format(len(self.server.messages)),
+            'body': form.get('Body'),
+            'from': form.get('From'),
+            'to': form.get('To'),
+            'status': 'queued',
+        })
+        body = json.dumps(payload).encode('utf-8')
+
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeTwilioServer(ThreadingMixIn, HTTPServer):
+    '''
+    Answers Messages.json POSTs the way api.twilio.com does, recording each
+    message and how many TCP connections were opened to deliver them.
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()